@@ -1,7 +1,8 @@
 """
 ASGI config for django_test project.
 
-It exposes the ASGI callable as a module-level variable named ``application``.
+It exposes the ASGI callable as a module-level variable named ``application``, e.g.
+``uvicorn django_test.asgi:application``. The middleware and views run in thread pools, see transactions.asgi.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/3.1/howto/deployment/asgi/
@@ -9,8 +10,17 @@ https://docs.djangoproject.com/en/3.1/howto/deployment/asgi/
 
 import os
 
-from django.core.asgi import get_asgi_application
+import django
+
+from transactions.asgi import TransactionsASGIHandler
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'django_test.settings')
 
-application = get_asgi_application()
+django.setup(set_prefix=False)
+
+from transactions.jobs import resume_import_jobs  # noqa: E402 needs the apps loaded
+
+application = TransactionsASGIHandler()
+
+# Pick up the imports queued or interrupted before the last restart
+resume_import_jobs()
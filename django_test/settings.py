@@ -42,6 +42,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'transactions.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -75,11 +76,80 @@ WSGI_APPLICATION = 'django_test.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/3.1/ref/settings/#databases
 
+# "replica" is a second, read-only connection to the same SQLite file. In WAL mode it reads the last committed
+# snapshot while "default" writes, see transactions.database
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
-    }
+        'CONN_MAX_AGE': 600,
+    },
+    'replica': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / 'db.sqlite3',
+        'CONN_MAX_AGE': 600,
+        'TEST': {
+            'MIRROR': 'default',
+        },
+    },
+}
+
+DATABASE_ROUTERS = ['transactions.database.TransactionsRouter']
+TRANSACTIONS_WRITE_DATABASE = 'default'
+TRANSACTIONS_READ_DATABASE = 'replica'
+
+# Run on every new SQLite connection. WAL lets readers and the writer proceed concurrently, NORMAL only syncs
+# at checkpoints (safe in WAL mode), mmap_size and cache_size (negative: KiB) keep the hot pages in memory and
+# busy_timeout (ms) makes a second writer wait instead of failing with "database is locked"
+TRANSACTIONS_SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'mmap_size': 268435456,
+    'cache_size': -65536,
+    'busy_timeout': 5000,
+    'temp_store': 'MEMORY',
+}
+
+
+# Cache
+# https://docs.djangoproject.com/en/3.1/topics/cache/
+# The "transactions" cache holds GET responses of the transactions API. Entries are keyed on a generation counter
+# kept in the database, so an import in any process invalidates the entries of every process, whatever the backend
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'transactions': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'transactions',
+        'TIMEOUT': 3600,
+        'OPTIONS': {
+            'MAX_ENTRIES': 1000,
+        },
+    },
+}
+
+TRANSACTIONS_CACHE_ALIAS = 'transactions'
+TRANSACTIONS_CACHE_ENABLED = True
+# Responses with more rows than this aren't cached
+TRANSACTIONS_CACHE_MAX_ROWS = 5000
+
+# Per-request metrics of the API, exposed at /api/metrics (transactions.metrics). SQL statements slower than
+# TRANSACTIONS_SLOW_QUERY_SECONDS are logged to the "transactions.slow_queries" logger, None disables the log
+TRANSACTIONS_METRICS_ENABLED = True
+TRANSACTIONS_SLOW_QUERY_SECONDS = 0.5
+
+# "database" computes stats with SQL, "columnar" from an in-memory NumPy snapshot of the transactions
+# (transactions.columnar, requires numpy)
+TRANSACTIONS_STATS_ENGINE = 'database'
+
+# Threads serving the API under ASGI (django_test.asgi, transactions.asgi): "query" runs lists and other cheap
+# requests, "aggregate" runs stats and timeseries
+TRANSACTIONS_ASYNC_WORKERS = {
+    'query': 8,
+    'aggregate': 2,
 }
 
 
@@ -120,3 +190,17 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/3.1/howto/static-files/
 
 STATIC_URL = '/static/'
+
+# Uploaded reports are stored under MEDIA_ROOT/imports until they have been imported
+MEDIA_ROOT = BASE_DIR / 'media'
+
+
+# Transaction imports
+# thread: import in a pool of TRANSACTIONS_IMPORT_WORKERS threads of the web process
+# worker: leave the job queued for "python manage.py process_imports"
+# inline: import inside the upload request
+
+TRANSACTIONS_IMPORT_RUNNER = 'thread'
+TRANSACTIONS_IMPORT_WORKERS = 2
+# Keep uploaded reports after they were imported successfully
+TRANSACTIONS_IMPORT_KEEP_FILES = False
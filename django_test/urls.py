@@ -16,10 +16,17 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path
 
-from transactions.views import TransactionsListView, TransactionsStatsView
+from transactions.metrics import metrics_view
+from transactions.views import (ImportJobView, TransactionsChangesView, TransactionsListView, TransactionsOrdersView,
+                                TransactionsStatsView, TransactionsTimeseriesView)
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/transactions/', TransactionsListView.as_view()),
     path('api/transactions/stats/', TransactionsStatsView.as_view()),
+    path('api/transactions/timeseries/', TransactionsTimeseriesView.as_view()),
+    path('api/transactions/orders/', TransactionsOrdersView.as_view()),
+    path('api/transactions/changes/', TransactionsChangesView.as_view()),
+    path('api/transactions/imports/<int:job_id>/', ImportJobView.as_view()),
+    path('api/metrics', metrics_view),
 ]
@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'django_test.settings')
 
 application = get_wsgi_application()
+
+from transactions.jobs import resume_import_jobs  # noqa: E402 needs the apps loaded
+
+# Pick up the imports queued or interrupted before the last restart
+resume_import_jobs()
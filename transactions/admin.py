@@ -1,6 +1,14 @@
 from django.contrib import admin
 
 # Register your models here.
-from transactions.models import FBATransaction
+from transactions.models import FBATransaction, Location, Product
 
-admin.site.register(FBATransaction)
\ No newline at end of file
+
+@admin.register(FBATransaction)
+class FBATransactionAdmin(admin.ModelAdmin):
+    # there are thousands of locations, a select box of all of them is unusable
+    raw_id_fields = ('product', 'location')
+
+
+admin.site.register(Product)
+admin.site.register(Location)
@@ -0,0 +1,126 @@
+"""
+Archiving of closed months, see manage.py archive_months.
+
+archive_month moves a month's transactions from fba_transactions to fba_transactions_archive with one
+INSERT ... SELECT and one DELETE, ids and columns unchanged, and records summary stats of the month in
+fba_archived_months. The hot table, its indexes and the fingerprint lookups of every import stay the size of the
+recent months. drop_month deletes an archived month's transactions and daily rollups and keeps its summary.
+"""
+import datetime
+from decimal import Decimal
+from typing import List
+
+from django.db import connections, router, transaction
+from django.db.models import Count, Max, Min, Sum
+from django.db.models.functions import TruncMonth
+from django.utils import timezone
+
+from transactions.cache import bump_generation
+from transactions.models import ArchivedMonth, ArchivedTransaction, FBATransaction, FBATransactionDailyRollup
+from transactions.partitions import month_bounds
+from transactions.rollups import apply_to_rollups
+
+CENTS = Decimal('0.01')
+
+
+def parse_month(value: str) -> datetime.date:
+    """
+    Parse a month given as YYYY-MM
+
+    return: Its first day, raises ValueError if it isn't a month
+    """
+    try:
+        return datetime.datetime.strptime(value, '%Y-%m').date()
+    except (TypeError, ValueError):
+        raise ValueError(f'{value} is not a month, expected YYYY-MM')
+
+
+def months_before(before: datetime.date) -> List[datetime.date]:
+    """
+    Months with transactions in fba_transactions that end before the month before starts, oldest first
+    """
+    months = (FBATransaction.objects.filter(date_time__lt=month_bounds(before)[0])
+              .annotate(month=TruncMonth('date_time', tzinfo=timezone.get_default_timezone()))
+              .values_list('month', flat=True).distinct().order_by('month'))
+    return [timezone.localtime(month).date() if isinstance(month, datetime.datetime) else month for month in months]
+
+
+def archive_month(month: datetime.date) -> ArchivedMonth:
+    """
+    Move the transactions of a closed month to the archive. Archiving a month again moves transactions imported
+    into it since
+
+    params:
+    month(date): Any day of the month
+
+    return: The updated ArchivedMonth, raises ValueError if the month hasn't ended yet and IntegrityError, leaving
+        the month where it was, if some of its transactions are already in the archive
+    """
+    start, end = month_bounds(month)
+    if end > timezone.now():
+        raise ValueError(f'{start:%Y-%m} has not ended yet')
+
+    connection = connections[router.db_for_write(FBATransaction)]
+    columns = [field.column for field in ArchivedTransaction._meta.concrete_fields]
+    attnames = [field.attname for field in ArchivedTransaction._meta.concrete_fields]
+    quote = connection.ops.quote_name
+
+    with transaction.atomic(using=connection.alias):
+        hot = FBATransaction.objects.using(connection.alias).filter(date_time__gte=start, date_time__lt=end)
+        select_sql, select_params = hot.order_by().values_list(*attnames).query.sql_with_params()
+        id_sql, id_params = hot.order_by().values('id').query.sql_with_params()
+        with connection.cursor() as cursor:
+            # a conflicting row raises IntegrityError and rolls the whole month back, the DELETE below must only
+            # remove what was copied
+            cursor.execute(
+                f'{connection.ops.insert_statement()} '
+                f'{quote(ArchivedTransaction._meta.db_table)} ({", ".join(map(quote, columns))}) {select_sql}',
+                select_params)
+            cursor.execute(f'DELETE FROM {quote(FBATransaction._meta.db_table)} WHERE id IN ({id_sql})', id_params)
+
+        summary = (ArchivedTransaction.objects.using(connection.alias)
+                   .filter(date_time__gte=start, date_time__lt=end)
+                   .aggregate(count=Count('id'), total_sum=Sum('total'), total_min=Min('total'),
+                              total_max=Max('total')))
+        archived, _ = ArchivedMonth.objects.using(connection.alias).update_or_create(
+            month=start.date(),
+            defaults={
+                'count': summary['count'],
+                # SQLite sums the totals as floating point, round them back to cents
+                'total_sum': (summary['total_sum'] or Decimal(0)).quantize(CENTS),
+                'total_min': summary['total_min'],
+                'total_max': summary['total_max'],
+                'archived_at': timezone.now(),
+                'dropped_at': None,
+            },
+        )
+        bump_generation()
+    return archived
+
+
+def drop_month(month: datetime.date) -> ArchivedMonth:
+    """
+    Delete the transactions and daily rollups of an archived month. Its ArchivedMonth summary is kept, and so are
+    the transactions imported into it after it was archived, which stay rolled up
+
+    params:
+    month(date): Any day of the month
+
+    return: The updated ArchivedMonth, raises ValueError if the month wasn't archived
+    """
+    start, end = month_bounds(month)
+    alias = router.db_for_write(FBATransaction)
+    with transaction.atomic(using=alias):
+        archived = ArchivedMonth.objects.using(alias).select_for_update().filter(month=start.date()).first()
+        if archived is None:
+            raise ValueError(f'{start:%Y-%m} is not archived')
+        ArchivedTransaction.objects.using(alias).filter(date_time__gte=start, date_time__lt=end).delete()
+        FBATransactionDailyRollup.objects.using(alias).filter(day__gte=start.date(), day__lt=end.date()).delete()
+        # rows imported into the month since it was archived are still in fba_transactions, roll them up again
+        late = (FBATransaction.objects.using(alias).filter(date_time__gte=start, date_time__lt=end)
+                .select_related('product', 'location'))
+        apply_to_rollups(late.iterator(chunk_size=2000))
+        archived.dropped_at = timezone.now()
+        archived.save(update_fields=['dropped_at'])
+        bump_generation()
+    return archived
@@ -0,0 +1,138 @@
+"""
+Serving the transactions API under ASGI, see django_test/asgi.py.
+
+Under ASGI Django 3.2 runs every synchronous view, and every hook of the synchronous middleware, in one shared
+thread, so a single slow stats scan holds up every other request. TransactionsASGIHandler instead awaits each
+request in a bounded thread pool, where the middleware and the view run synchronously as they do under WSGI, and
+the event loop keeps accepting and answering other requests meanwhile. Cheap reads (lists, pages, import statuses)
+and aggregations (stats, timeseries) have separate pools, sized by TRANSACTIONS_ASYNC_WORKERS, so a burst of
+expensive aggregations can only ever occupy the aggregate pool while lists keep being served by the query pool.
+Views pick their pool with an asgi_pool attribute.
+
+Streamed responses are produced in the pool one chunk at a time and sent by the event loop in between: a thread
+is only held while a chunk is fetched and encoded, never while a slow client reads it.
+"""
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Callable, Dict
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.handlers.asgi import ASGIHandler
+from django.core.handlers.base import BaseHandler
+from django.db import close_old_connections
+from django.urls import Resolver404, get_resolver
+
+QUERY_POOL = 'query'
+AGGREGATE_POOL = 'aggregate'
+
+# Threads per pool, and so the most requests of each kind served at the same time
+DEFAULT_WORKERS = {
+    QUERY_POOL: 8,
+    AGGREGATE_POOL: 2,
+}
+
+pools: Dict[str, ThreadPoolExecutor] = {}
+pools_lock = threading.Lock()
+
+
+def get_pool(name: str) -> ThreadPoolExecutor:
+    pool = pools.get(name)
+    if pool is None:
+        with pools_lock:
+            pool = pools.get(name)
+            if pool is None:
+                workers = {**DEFAULT_WORKERS, **getattr(settings, 'TRANSACTIONS_ASYNC_WORKERS', {})}
+                pool = pools[name] = ThreadPoolExecutor(workers[name], thread_name_prefix=f'transactions-{name}')
+    return pool
+
+
+def shutdown_pools():
+    """
+    Stop the pool threads, closing the database connections they opened
+    """
+    with pools_lock:
+        for pool in pools.values():
+            pool.shutdown(wait=True)
+        pools.clear()
+
+
+def request_pool(request) -> str:
+    """
+    Name of the pool the view of request runs in: its asgi_pool attribute, QUERY_POOL if it has none
+    """
+    try:
+        match = get_resolver(getattr(request, 'urlconf', None)).resolve(request.path_info)
+    except Resolver404:
+        return QUERY_POOL
+    view = getattr(match.func, 'view_class', match.func)
+    return getattr(view, 'asgi_pool', QUERY_POOL)
+
+
+def in_pool_thread(func: Callable, *args):
+    # pool threads never see request_started/request_finished, recycle connections past CONN_MAX_AGE here
+    close_old_connections()
+    return func(*args)
+
+
+async def run_in_pool(pool_name: str, func: Callable, *args):
+    """
+    Await func(*args) run in the named pool
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_pool(pool_name), functools.partial(in_pool_thread, func, *args))
+
+
+async def pull_chunks(response, pool_name: str) -> AsyncIterator[bytes]:
+    """
+    Produce the chunks of a streamed response one at a time in the pool. The list view fetches its rows with
+    pagination.iter_keyset, which holds no database cursor between chunks, so consecutive chunks may be
+    produced by different threads
+    """
+    chunks = iter(response)
+    while True:
+        chunk = await run_in_pool(pool_name, next, chunks, None)
+        if chunk is None:
+            return
+        yield chunk
+
+
+class TransactionsASGIHandler(ASGIHandler):
+    """
+    ASGIHandler running the synchronous middleware and views in the thread pools
+    """
+
+    def __init__(self):
+        BaseHandler.__init__(self)
+        self.load_middleware(is_async=False)
+
+    async def get_response_async(self, request):
+        pool_name = request_pool(request)
+        response = await run_in_pool(pool_name, self.get_response, request)
+        if response.streaming:
+            response.async_streaming_content = pull_chunks(response, pool_name)
+        return response
+
+    async def send_response(self, response, send):
+        content = getattr(response, 'async_streaming_content', None)
+        if content is None:
+            return await super().send_response(response, send)
+
+        # as ASGIHandler.send_response does for streamed responses, awaiting every chunk
+        headers = []
+        for header, value in response.items():
+            if isinstance(header, str):
+                header = header.encode('ascii')
+            if isinstance(value, str):
+                value = value.encode('latin1')
+            headers.append((bytes(header), bytes(value)))
+        for cookie in response.cookies.values():
+            headers.append((b'Set-Cookie', cookie.output(header='').encode('ascii').strip()))
+        await send({'type': 'http.response.start', 'status': response.status_code, 'headers': headers})
+        async for part in content:
+            for chunk, _ in self.chunk_bytes(part):
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await send({'type': 'http.response.body'})
+        await sync_to_async(response.close, thread_sensitive=True)()
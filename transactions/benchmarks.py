@@ -0,0 +1,303 @@
+import asyncio
+import csv
+import datetime
+import io
+import random
+import statistics
+import threading
+import time
+import tracemalloc
+import zoneinfo
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+from urllib.parse import urlencode
+
+from django.test import Client
+from django.utils import timezone
+
+from transactions.dateparse import parse_timestamp
+
+CSV_COLUMNS = ['date/time', 'type', 'order id', 'sku', 'description', 'quantity', 'order city', 'order state',
+               'order postal', 'total']
+
+
+def format_timestamp(value: datetime.datetime) -> str:
+    """
+    Inverse of parse_timestamp, value has to be in a timezone whose abbreviation parse_timestamp knows
+    """
+    hour = value.hour % 12 or 12
+    meridiem = 'AM' if value.hour < 12 else 'PM'
+    return f'{value:%b} {value.day}, {value.year} {hour}:{value:%M:%S} {meridiem} {value.tzname()}'
+
+
+def synthesize_report(sample_rows: List[Dict], copies: int, seed: int = 0) -> Iterator[Dict]:
+    """
+    Generate copies x the sample report. Each copy is shifted forward in time by the span the sample covers,
+    and SKUs and (city, state, postal) locations are redrawn from the sample's own frequency distributions so
+    filters see realistic selectivity. Order ids are made unique per copy so no row is a duplicate of another
+
+    params:
+    sample_rows(list): Rows of the sample report, e.g. example_transactions.csv
+    copies(int): Number of copies to generate
+    seed(int): Random seed, the same seed always produces the same report
+
+    return: Iterator of report rows
+    """
+    rng = random.Random(seed)
+    timestamps = [parse_timestamp(row['date/time']) for row in sample_rows]
+    span = datetime.timedelta(days=(max(timestamps) - min(timestamps)).days + 1)
+
+    products = Counter((row['sku'], row['description']) for row in sample_rows if row['sku'])
+    locations = Counter((row['order city'], row['order state'], row['order postal'])
+                        for row in sample_rows if row['order city'])
+    product_values, product_weights = list(products), list(products.values())
+    location_values, location_weights = list(locations), list(locations.values())
+
+    pacific = zoneinfo.ZoneInfo('America/Los_Angeles')
+    for copy in range(copies):
+        products_drawn = rng.choices(product_values, product_weights, k=len(sample_rows))
+        locations_drawn = rng.choices(location_values, location_weights, k=len(sample_rows))
+        for row, timestamp, product, location in zip(sample_rows, timestamps, products_drawn, locations_drawn):
+            row = dict(row)
+            row['date/time'] = format_timestamp((timestamp + span * copy).astimezone(pacific))
+            if row['order id']:
+                row['order id'] = f'{row["order id"]}-{copy}'
+            if row['sku']:
+                row['sku'], row['description'] = product
+            if row['order city']:
+                row['order city'], row['order state'], row['order postal'] = location
+            yield row
+
+
+def report_to_csv(rows: Iterator[Dict]) -> bytes:
+    output = io.StringIO()
+    writer = csv.DictWriter(output, fieldnames=CSV_COLUMNS)
+    writer.writeheader()
+    writer.writerows(rows)
+    return output.getvalue().encode('utf-8')
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    """
+    Linearly interpolated percentile of an already sorted list
+    """
+    position = (len(sorted_values) - 1) * pct / 100
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+
+def measure(request: Callable, repeat: int) -> Dict:
+    """
+    Time repeat calls of request and, in one extra traced call, its peak Python memory allocation
+
+    params:
+    request(callable): Performs the request and returns the response
+    repeat(int): Number of timed calls
+
+    return: dict of latency percentiles in milliseconds, peak memory in KiB and the response status
+    """
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        response = request()
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+
+    tracemalloc.start()
+    try:
+        request()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'status': response.status_code,
+        'p50_ms': round(percentile(timings, 50), 3),
+        'p95_ms': round(percentile(timings, 95), 3),
+        'p99_ms': round(percentile(timings, 99), 3),
+        'mean_ms': round(statistics.mean(timings), 3),
+        'peak_memory_kib': round(peak / 1024, 1),
+    }
+
+
+def consume(response):
+    """
+    Read a response body the way a client would, so streamed responses are timed in full
+    """
+    if response.streaming:
+        for _ in response.streaming_content:
+            pass
+    return response
+
+
+def day_range(first: datetime.date, last: datetime.date) -> Dict:
+    """
+    start/end filters covering the days first to last in settings.TIME_ZONE, the days the rollups are kept for,
+    so that stats over them can be answered from the rollups
+    """
+    local_tz = timezone.get_default_timezone()
+    start = datetime.datetime.combine(first, datetime.time(0, 0, 0), tzinfo=local_tz)
+    end = datetime.datetime.combine(last, datetime.time(23, 59, 59), tzinfo=local_tz)
+    return {'start': format_timestamp(start), 'end': format_timestamp(end)}
+
+
+def filter_matrix(sample_rows: List[Dict]) -> List[Dict]:
+    """
+    The filter combinations the list and stats endpoints are benchmarked with, using the most common values of
+    the sample report so that every filter selects a realistic share of rows
+    """
+    skus = [sku for sku, _ in Counter(row['sku'] for row in sample_rows if row['sku']).most_common(20)]
+    city, state = Counter((row['order city'], row['order state'])
+                          for row in sample_rows if row['order city']).most_common(1)[0][0]
+    postal = Counter(row['order postal'] for row in sample_rows if row['order postal']).most_common(1)[0][0]
+    return [
+        {},
+        {'type': 'Order'},
+        {'type': 'Refund'},
+        {'state': state},
+        {'state': state, 'city': city},
+        {'postal': postal},
+        {'skus': skus[0]},
+        {'skus': ','.join(skus[:5])},
+        {'skus': ','.join(skus)},
+        day_range(datetime.date(2020, 11, 3), datetime.date(2020, 11, 3)),
+        day_range(datetime.date(2020, 11, 2), datetime.date(2020, 11, 9)),
+        # not aligned with the rollup days (unless TIME_ZONE is Pacific), read from the transactions
+        {'start': 'Nov 2, 2020 12:00:00 AM PST', 'end': 'Nov 9, 2020 11:59:59 PM PST'},
+        {'type': 'Order', 'state': state, 'start': 'Nov 2, 2020 4:00:00 PM PST'},
+        {'type': 'Order', 'skus': ','.join(skus[:5]),
+         **day_range(datetime.date(2020, 11, 2), datetime.date(2020, 11, 30))},
+    ]
+
+
+# Variants of each endpoint, as extra query parameters on top of the filters
+ENDPOINTS = [
+    ('list', '/api/transactions/', {}),
+    ('list_page', '/api/transactions/', {'limit': 1000}),
+    ('list_stream', '/api/transactions/', {'stream': 'true'}),
+    ('list_ndjson', '/api/transactions/', {'format': 'ndjson'}),
+    ('list_csv', '/api/transactions/', {'format': 'csv'}),
+    ('stats', '/api/transactions/stats/', {}),
+    ('stats_percentiles', '/api/transactions/stats/', {'percentiles': '90,95,99'}),
+]
+
+
+def run_query_matrix(client: Client, matrix: List[Dict], repeat: int) -> List[Dict]:
+    """
+    Measure every endpoint variant against every filter combination
+    """
+    results = []
+    for name, url, extra in ENDPOINTS:
+        for filters in matrix:
+            params = dict(filters, **extra)
+            result = measure(lambda: consume(client.get(url, params)), repeat)
+            result.update({'endpoint': name, 'filters': filters})
+            results.append(result)
+    return results
+
+
+# The mixed load of the concurrency benchmark: cheap list pages requested while expensive aggregations (percentiles
+# over every transaction, which the rollups can't answer) are running
+CHEAP_REQUEST = ('/api/transactions/', {'type': 'Order', 'limit': 20})
+EXPENSIVE_REQUEST = ('/api/transactions/stats/', {'min_total': '-1000000', 'percentiles': '50,90,99'})
+
+
+async def asgi_get(application, path: str, params: Optional[Dict] = None) -> Tuple[int, bytes]:
+    """
+    Send a GET request straight to an ASGI application, as an ASGI server would, and read the whole body
+
+    return: (status code, body)
+    """
+    scope = {
+        'type': 'http',
+        'asgi': {'version': '3.0'},
+        'http_version': '1.1',
+        'method': 'GET',
+        'scheme': 'http',
+        'path': path,
+        'raw_path': path.encode('ascii'),
+        'query_string': urlencode(params or {}).encode('ascii'),
+        'root_path': '',
+        'headers': [(b'host', b'testserver'), (b'user-agent', b'bench')],
+        'client': ('127.0.0.1', 0),
+        'server': ('testserver', 80),
+    }
+    status = None
+    body = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        nonlocal status
+        if message['type'] == 'http.response.start':
+            status = message['status']
+        else:
+            body.append(message.get('body', b''))
+
+    await application(scope, receive, send)
+    return status, b''.join(body)
+
+
+def latency_summary(timings: List[float]) -> Optional[Dict]:
+    if not timings:
+        return None
+    timings = sorted(timings)
+    return {
+        'requests': len(timings),
+        'p50_ms': round(percentile(timings, 50), 3),
+        'p95_ms': round(percentile(timings, 95), 3),
+        'max_ms': round(timings[-1], 3),
+    }
+
+
+def mixed_load_result(started: float, cheap: List[float], expensive: List[float]) -> Dict:
+    return {
+        'seconds': round(time.perf_counter() - started, 3),
+        'cheap': latency_summary(cheap),
+        'expensive': latency_summary(expensive),
+    }
+
+
+def run_mixed_load_wsgi(cheap: int, expensive: int, threads: int) -> Dict:
+    """
+    Send expensive aggregations and then cheap list pages all at once to the synchronous views, served by a pool
+    of threads like a threaded WSGI server. Latencies are measured from the moment everything was sent, so they
+    include the time a request waited for a free thread
+    """
+    local = threading.local()
+
+    def get(path, params):
+        if not hasattr(local, 'client'):
+            local.client = Client()
+        consume(local.client.get(path, params))
+        return (time.perf_counter() - started) * 1000
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(threads) as pool:
+        expensive_futures = [pool.submit(get, *EXPENSIVE_REQUEST) for _ in range(expensive)]
+        cheap_futures = [pool.submit(get, *CHEAP_REQUEST) for _ in range(cheap)]
+        expensive_timings = [future.result() for future in expensive_futures]
+        cheap_timings = [future.result() for future in cheap_futures]
+    return mixed_load_result(started, cheap_timings, expensive_timings)
+
+
+def run_mixed_load_asgi(application, cheap: int, expensive: int) -> Dict:
+    """
+    The same load sent to an ASGI application (see transactions.asgi) from a single event loop
+    """
+
+    async def get(path, params):
+        await asgi_get(application, path, params)
+        return (time.perf_counter() - started) * 1000
+
+    async def run():
+        expensive_tasks = [asyncio.ensure_future(get(*EXPENSIVE_REQUEST)) for _ in range(expensive)]
+        cheap_tasks = [asyncio.ensure_future(get(*CHEAP_REQUEST)) for _ in range(cheap)]
+        return await asyncio.gather(*cheap_tasks), await asyncio.gather(*expensive_tasks)
+
+    started = time.perf_counter()
+    cheap_timings, expensive_timings = asyncio.run(run())
+    return mixed_load_result(started, cheap_timings, expensive_timings)
@@ -0,0 +1,257 @@
+"""
+Bulk loading of historical reports, see manage.py import_transactions.
+
+Reports are split into chunks of rows that are parsed and validated in a process pool (transactions.parsing), while
+a single writer in the main process fingerprints, de-duplicates and inserts them with one executemany per chunk,
+committing every BULK_COMMIT_SIZE rows.
+"""
+import csv
+import json
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Sequence, Tuple
+
+from django.db import connections, router, transaction
+from django.db.models import Max
+
+from transactions.cache import bump_generation
+from transactions.ingest import (IMPORT_WRITE_LOCK, MAX_REPORTED_ERRORS, DimensionCache, Fingerprinter,
+                                existing_fingerprints)
+from transactions.metrics import record_import
+from transactions.models import DIMENSION_FIELDS, FBATransaction, Location, Product
+from transactions.parsing import ParsedRow, parse_chunk
+from transactions.rollups import apply_to_rollups
+from transactions.utils import chunked
+
+# Rows per chunk handed to a parsing process and inserted with one executemany
+BULK_CHUNK_SIZE = 10000
+
+# Rows inserted per transaction
+BULK_COMMIT_SIZE = 100000
+
+# Columns written by the bulk insert, in the order of its parameters
+INSERT_FIELDS = ('date_time', 'order_type', 'order_id', 'product', 'quantity', 'location', 'total', 'fingerprint')
+
+
+class RollupEntry(NamedTuple):
+    """
+    The attributes of an inserted transaction apply_to_rollups needs, without building a model instance
+    """
+
+    date_time: object
+    sku: Optional[str]
+    order_type: Optional[str]
+    order_state: Optional[str]
+    total: object
+
+
+def read_report_chunks(path: str, chunk_size: int) -> Iterator[Tuple[Optional[List[str]], List, int]]:
+    """
+    Split a CSV or JSON (array of row objects) report into chunks of rows without parsing their values
+
+    params:
+    path(str): Report file, read as JSON if it ends in .json and as CSV otherwise
+    chunk_size(int): Rows per chunk
+
+    return: Iterator of (CSV header or None for JSON rows, rows, number of the chunk's first row)
+    """
+    if path.lower().endswith('.json'):
+        with open(path, 'rb') as report:
+            rows = json.load(report)
+        if not isinstance(rows, list):
+            raise ValueError(f'{path}: expected a JSON array of transactions')
+        for start in range(0, len(rows), chunk_size):
+            yield None, rows[start:start + chunk_size], start + 1
+        return
+
+    with open(path, newline='', encoding='utf-8-sig') as report:
+        reader = csv.reader(report)
+        header = next(reader, None)
+        row_number = 1
+        for chunk in chunked(reader, chunk_size):
+            yield header, chunk, row_number
+            row_number += len(chunk)
+
+
+def parse_in_pool(chunks: Iterable[Tuple], workers: int) -> Iterator[Tuple]:
+    """
+    parse_chunk every chunk in a pool of worker processes, yielding the results in report order. At most two
+    chunks per worker are in flight, so reading the reports never runs far ahead of the writer
+    """
+    if workers <= 1:
+        for header, rows, first_row_number in chunks:
+            yield parse_chunk(header, rows, first_row_number, MAX_REPORTED_ERRORS)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for header, rows, first_row_number in chunks:
+            pending.append(pool.submit(parse_chunk, header, rows, first_row_number, MAX_REPORTED_ERRORS))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+class BulkWriter:
+    """
+    The single writer of the bulk import. Fingerprints parsed rows in report order, skips the ones already stored,
+    resolves their products and locations and inserts the rest with one raw executemany per chunk
+    """
+
+    def __init__(self):
+        self.connection = connections[router.db_for_write(FBATransaction)]
+        self.fingerprinter = Fingerprinter()
+        self.products = DimensionCache(Product, DIMENSION_FIELDS['product'])
+        self.locations = DimensionCache(Location, DIMENSION_FIELDS['location'])
+
+        ops = self.connection.ops
+        meta = FBATransaction._meta
+        self.total_field = meta.get_field('total')
+        columns = ', '.join(ops.quote_name(meta.get_field(name).column) for name in INSERT_FIELDS)
+        placeholders = ', '.join(['%s'] * len(INSERT_FIELDS))
+        self.sql = (f'{ops.insert_statement(ignore_conflicts=True)} {ops.quote_name(meta.db_table)} ({columns}) '
+                    f'VALUES ({placeholders}) {ops.ignore_conflicts_suffix_sql(ignore_conflicts=True)}').strip()
+
+    def write(self, rows: Sequence[ParsedRow]) -> int:
+        """
+        Insert the rows that aren't stored yet, inside the caller's transaction, and add the ones actually inserted
+        to the daily rollups
+
+        return: Number of rows inserted
+        """
+        fingerprinted = {}
+        for row in rows:
+            fingerprint = self.fingerprinter.fingerprint(row.date_time, row.order_type, row.order_id, row.sku,
+                                                         row.quantity, row.total)
+            fingerprinted[fingerprint] = row
+        existing = existing_fingerprints(list(fingerprinted))
+        new_rows = [(fingerprint, row) for fingerprint, row in fingerprinted.items() if fingerprint not in existing]
+        if not new_rows:
+            return 0
+
+        product_keys = [(row.sku, row.description) for _, row in new_rows]
+        location_keys = [(row.order_city, row.order_state, row.order_postal) for _, row in new_rows]
+        self.products.resolve(product_keys)
+        self.locations.resolve(location_keys)
+
+        ops = self.connection.ops
+        params = []
+        rollup_entries = []
+        for (fingerprint, row), product_key, location_key in zip(new_rows, product_keys, location_keys):
+            product = self.products.get(product_key)
+            location = self.locations.get(location_key)
+            params.append((
+                ops.adapt_datetimefield_value(row.date_time),
+                row.order_type,
+                row.order_id,
+                product.id if product else None,
+                row.quantity,
+                location.id if location else None,
+                ops.adapt_decimalfield_value(row.total, self.total_field.max_digits, self.total_field.decimal_places),
+                fingerprint,
+            ))
+            rollup_entries.append(RollupEntry(row.date_time, row.sku, row.order_type, row.order_state, row.total))
+
+        with self.connection.cursor() as cursor:
+            last_id = FBATransaction.objects.using(self.connection.alias).aggregate(last_id=Max('id'))['last_id'] or 0
+            cursor.executemany(self.sql, params)
+            inserted = cursor.rowcount
+        if inserted != len(params):
+            # INSERT OR IGNORE skipped rows stored since existing_fingerprints looked, only roll up the ones that
+            # landed. Ids are assigned in insert order so they're the rows above the last id
+            landed = set(FBATransaction.objects.using(self.connection.alias).filter(id__gt=last_id)
+                         .values_list('fingerprint', flat=True))
+            rollup_entries = [entry for (fingerprint, _), entry in zip(new_rows, rollup_entries)
+                              if fingerprint in landed]
+        apply_to_rollups(rollup_entries)
+        return len(rollup_entries)
+
+
+@contextmanager
+def without_secondary_indexes():
+    """
+    Drop the secondary indexes of fba_transactions for the duration of a bulk load and build them again afterwards.
+    Building an index once is much cheaper than updating it for every inserted row. The unique fingerprint index
+    stays, the load needs it to skip duplicates. Can't be used inside a transaction on SQLite
+    """
+    connection = connections[router.db_for_write(FBATransaction)]
+    indexes = FBATransaction._meta.indexes
+    with connection.schema_editor() as editor:
+        for index in indexes:
+            editor.remove_index(FBATransaction, index)
+    try:
+        yield
+    finally:
+        with connection.schema_editor() as editor:
+            for index in indexes:
+                editor.add_index(FBATransaction, index)
+
+
+def bulk_import(paths: Sequence[str], workers: int = 1, chunk_size: int = BULK_CHUNK_SIZE,
+                commit_size: int = BULK_COMMIT_SIZE, drop_indexes: bool = False,
+                progress: Optional[Callable[[Dict], None]] = None) -> Dict:
+    """
+    Load reports straight into the database
+
+    params:
+    paths(sequence): CSV or JSON report files, loaded in order
+    workers(int): Number of parsing processes, 1 parses in this process
+    chunk_size(int): Rows per parsed chunk and executemany
+    commit_size(int): Rows per transaction, rounded up to whole chunks. Parsing carries on in the pool while a
+        chunk is written
+    drop_indexes(bool): Drop the secondary indexes during the load, see without_secondary_indexes
+    progress(callable): Called with the running result after every commit
+
+    return: dict with the number of rows read, inserted, duplicates and rejected, the first MAX_REPORTED_ERRORS
+        reasons rows were rejected, the elapsed seconds and the throughput in rows per second
+    """
+    started = time.monotonic()
+    counts = {'rows': 0, 'inserted': 0, 'rejected': 0}
+    errors = []
+
+    def result():
+        elapsed = time.monotonic() - started
+        return {
+            'rows': counts['rows'],
+            'inserted': counts['inserted'],
+            'duplicates': counts['rows'] - counts['rejected'] - counts['inserted'],
+            'rejected': counts['rejected'],
+            'errors': errors,
+            'elapsed': round(elapsed, 3),
+            'rows_per_second': round(counts['rows'] / elapsed, 1) if elapsed > 0 else None,
+        }
+
+    def load():
+        writer = BulkWriter()
+        for path in paths:
+            results = parse_in_pool(read_report_chunks(path, chunk_size), workers)
+            finished = False
+            while not finished:
+                finished = True
+                uncommitted = 0
+                # the imports of this process take turns, see IMPORT_WRITE_LOCK
+                with IMPORT_WRITE_LOCK, transaction.atomic(using=writer.connection.alias):
+                    for parsed, rejected, chunk_errors in results:
+                        counts['rows'] += len(parsed) + rejected
+                        counts['rejected'] += rejected
+                        errors.extend(f'{path} {error}' for error in chunk_errors[:MAX_REPORTED_ERRORS - len(errors)])
+                        counts['inserted'] += writer.write(parsed)
+                        uncommitted += len(parsed)
+                        if uncommitted >= commit_size:
+                            finished = False
+                            break
+                    bump_generation()
+                if progress:
+                    progress(result())
+
+    if drop_indexes:
+        with without_secondary_indexes():
+            load()
+    else:
+        load()
+    final = result()
+    record_import('bulk', final['rows'], final['inserted'], final['elapsed'])
+    return final
@@ -0,0 +1,122 @@
+import functools
+import hashlib
+import json
+import time
+from typing import Dict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import F, QuerySet
+from rest_framework import status
+from rest_framework.response import Response
+
+from transactions.filters import FILTER_PARAMS, parse_filters
+from transactions.models import DataGeneration
+
+
+def get_cache():
+    return caches[getattr(settings, 'TRANSACTIONS_CACHE_ALIAS', 'transactions')]
+
+
+def start_generation():
+    """
+    Create the generation row if it's missing (deleted, or a flushed test database). It starts from the current time
+    so it can never go back to a value an older entry was cached under
+    """
+    DataGeneration.objects.bulk_create([DataGeneration(id=1, generation=time.time_ns())], ignore_conflicts=True)
+
+
+def get_generation() -> int:
+    """
+    Current data generation. It's kept in the database (DataGeneration) rather than in the cache so that the imports
+    of other processes (process_imports, import_transactions, archive_months) invalidate this process's entries too,
+    whatever the cache backend. It costs one primary key lookup per cached request
+    """
+    generation = DataGeneration.objects.filter(id=1).values_list('generation', flat=True).first()
+    if generation is None:
+        start_generation()
+        generation = DataGeneration.objects.filter(id=1).values_list('generation', flat=True).first()
+    return generation
+
+
+def bump_generation():
+    """
+    Invalidate every cached response, in every process. Called in the transaction changing the transactions, so
+    the new generation is committed together with them
+    """
+    if not DataGeneration.objects.filter(id=1).update(generation=F('generation') + 1):
+        start_generation()
+
+
+def response_cache_key(view_name: str, query_dict: Dict) -> str:
+    """
+    Build the cache key of a GET request: the normalized filters (sorted SKUs, parsed dates) and any other
+    query parameters, scoped to the view and the current data generation
+
+    params:
+    view_name(str): Name of the view the response belongs to
+    query_dict(dict): Query string parameters, raises ValueError if their filters are invalid
+
+    return: Cache key
+    """
+    filters = {
+        name: value.isoformat() if hasattr(value, 'isoformat') else value
+        for name, value in parse_filters(query_dict).items()
+    }
+    getlist = getattr(query_dict, 'getlist', lambda name: [query_dict.get(name)])
+    extras = {name: getlist(name) for name in query_dict if name not in FILTER_PARAMS}
+    normalized = json.dumps([view_name, filters, extras], sort_keys=True, default=str)
+    digest = hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+    return f'transactions:{get_generation()}:{digest}'
+
+
+def row_count(data) -> int:
+    """
+    Number of transactions in the data of a response, either a list of rows or a page of them
+    """
+    if isinstance(data, dict):
+        return len(data.get('results') or [])
+    if isinstance(data, list):
+        return len(data)
+    return 0
+
+
+def cached_response(view_func):
+    """
+    Decorator caching the response data of a GET handler. Responses are tagged with an X-Cache header of HIT or MISS.
+    Streamed responses (stream=true or one of the bulk formats) and responses with more than
+    TRANSACTIONS_CACHE_MAX_ROWS rows are never cached so a few broad queries can't flush everything else out of the
+    cache
+    """
+
+    @functools.wraps(view_func)
+    def wrapper(self, request, *args, **kwargs):
+        request_data = request.GET
+        streamed = (request_data.get('stream') in ('1', 'true')
+                    or getattr(getattr(request, 'accepted_renderer', None), 'streaming', False))
+        if not getattr(settings, 'TRANSACTIONS_CACHE_ENABLED', True) or streamed:
+            return view_func(self, request, *args, **kwargs)
+
+        try:
+            key = response_cache_key(type(self).__name__, request_data)
+        except ValueError:
+            # let the view report the invalid filter
+            return view_func(self, request, *args, **kwargs)
+
+        cache = get_cache()
+        data = cache.get(key)
+        if data is not None:
+            response = Response(data, status=status.HTTP_200_OK)
+            response['X-Cache'] = 'HIT'
+            return response
+
+        response = view_func(self, request, *args, **kwargs)
+        if isinstance(response, Response) and response.status_code == status.HTTP_200_OK:
+            if isinstance(response.data, QuerySet):
+                response.data = list(response.data)
+            if row_count(response.data) <= getattr(settings, 'TRANSACTIONS_CACHE_MAX_ROWS', 5000):
+                cache.set(key, response.data)
+            response['X-Cache'] = 'MISS'
+        return response
+
+    return wrapper
@@ -0,0 +1,64 @@
+"""
+Incremental change feed of the transactions, /api/transactions/changes/.
+
+An import only ever adds rows, and archiving (transactions.archive) moves rows between tables with their ids
+unchanged. So the id doubles as the ingest sequence. The feed is of new rows only: a row edited in place (the admin)
+keeps its id and isn't sent again, and deleted rows aren't reported. On SQLite ids come from AUTOINCREMENT and
+are never reused, even after rows are deleted. SQLite also serializes writes, so rows commit in id order, and a reader
+that sees id N sees every row with a lower id. A consumer keeps the cursor of the last batch and asks for the rows
+after it, so each sync reads only the rows ingested since, with a range scan of the primary key.
+
+A database handing out ids from a sequence outside the write lock (PostgreSQL) can commit a lower id after a higher
+one. There the feed would need a sequence assigned in commit order instead.
+"""
+import base64
+import json
+from typing import Dict, List, Optional
+
+from transactions.filters import transaction_values
+from transactions.partitions import partition_model
+
+
+def encode_change_cursor(row_id: int) -> str:
+    """
+    Build the opaque cursor pointing just after the transaction with the given id
+    """
+    raw = json.dumps({'after': row_id}).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii')
+
+
+def decode_change_cursor(cursor: str) -> int:
+    """
+    Inverse of encode_change_cursor, raises ValueError if the cursor wasn't produced by it
+    """
+    try:
+        row_id = int(json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))['after'])
+    except (TypeError, ValueError, KeyError, UnicodeError, base64.binascii.Error):
+        raise ValueError('invalid cursor')
+    if row_id < 0:
+        raise ValueError('invalid cursor')
+    return row_id
+
+
+def changes_after(since: Optional[str], limit: int) -> Dict:
+    """
+    The next batch of transactions ingested after the since cursor, in ingest order
+
+    params:
+    since(str): Cursor returned as "next" by the previous batch, None to start from the first transaction
+    limit(int): Maximum number of transactions in the batch
+
+    return: dict with the transactions in "results", the cursor to ask for the next batch with in "next" (the same
+        cursor when nothing new was ingested) and whether more transactions are waiting in "has_more"
+    """
+    after = decode_change_cursor(since) if since else 0
+    # archived transactions keep their ids, a consumer that fell behind an archiving finds them in the archive
+    query = partition_model().objects.filter(id__gt=after).order_by('id')
+    rows: List[Dict] = list(transaction_values(query)[:limit + 1])
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    return {
+        'results': rows,
+        'next': encode_change_cursor(rows[-1]['id'] if rows else after),
+        'has_more': has_more,
+    }
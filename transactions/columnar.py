@@ -0,0 +1,256 @@
+"""
+Optional in-memory columnar engine for the stats endpoint.
+
+Keeps a snapshot of all transactions, archived months included, as NumPy arrays: timestamps as int64 microseconds
+since the epoch, totals as int64 cents and the categorical columns dictionary-encoded as int32 codes. Filters are
+evaluated as vectorized boolean masks, so stats over any filter combination take microseconds to milliseconds
+instead of a table scan.
+
+Enable with TRANSACTIONS_STATS_ENGINE = 'columnar', which requires numpy to be installed.
+"""
+import datetime
+import threading
+from decimal import Decimal
+from typing import Dict, Iterable, List, NamedTuple, Optional
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from transactions.cache import get_generation
+from transactions.models import TransactionHistory
+from transactions.search import search_products
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - numpy is optional
+    np = None
+
+DATABASE = 'database'
+COLUMNAR = 'columnar'
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+MICROSECOND = datetime.timedelta(microseconds=1)
+
+# Filter name -> dictionary-encoded column it applies to
+CATEGORICAL_FILTERS = {
+    'type': 'order_type',
+    'city': 'order_city',
+    'state': 'order_state',
+    'postal': 'order_postal',
+    'skus': 'sku',
+}
+# Dictionary-encoded column -> the transaction field or dimension attribute it is loaded from
+CATEGORICAL_COLUMNS = {
+    'order_type': 'order_type',
+    'sku': 'product__sku',
+    'order_state': 'location__state',
+    'order_city': 'location__city',
+    'order_postal': 'location__postal',
+    # for q, matched by the ids of the products found in the search index
+    'product': 'product_id',
+}
+
+LOAD_CHUNK_SIZE = 20000
+
+
+def to_microseconds(value: datetime.datetime) -> int:
+    return (value - EPOCH) // MICROSECOND
+
+
+def cents_to_decimal(value) -> Decimal:
+    # percentiles come back as floats, rounding to 1/10000 of a cent drops the binary noise
+    return Decimal(str(round(float(value), 4))) / 100
+
+
+class Dictionary:
+    """
+    Maps the distinct values of a column to dense integer codes
+    """
+
+    def __init__(self, codes: Optional[Dict] = None):
+        self.codes: Dict = dict(codes or {})
+
+    def encode(self, value) -> int:
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.codes)
+        return code
+
+    def lookup(self, values: Iterable) -> List[int]:
+        """
+        Codes of the given values, values never seen are skipped since no row can match them
+        """
+        return [self.codes[value] for value in values if value in self.codes]
+
+
+class SnapshotState(NamedTuple):
+    """
+    The columns of a snapshot and the dictionaries their codes refer to, replaced as a whole so that a reader
+    always decodes the columns it reads with their own dictionaries
+    """
+
+    dictionaries: Dict[str, Dictionary]
+    columns: Dict
+    last_id: int
+
+
+def empty_state() -> SnapshotState:
+    columns = {
+        'id': np.zeros(0, dtype=np.int64),
+        'date_time': np.zeros(0, dtype=np.int64),
+        'total': np.zeros(0, dtype=np.int64),
+    }
+    for name in CATEGORICAL_COLUMNS:
+        columns[name] = np.zeros(0, dtype=np.int32)
+    return SnapshotState({name: Dictionary() for name in CATEGORICAL_COLUMNS}, columns, 0)
+
+
+class ColumnarSnapshot:
+    """
+    Columnar copy of the transactions (fba_transactions_history), refreshed incrementally (new ids only) whenever
+    the data generation bumped by imports changes. If rows were deleted the snapshot is rebuilt from scratch. Rows
+    updated in place (the admin) are only picked up by a rebuild, see reset(). Refreshes build a new SnapshotState
+    and publish it with one assignment, readers take self.state once and never see it change under them
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.generation = None
+        self.state = empty_state()
+
+    def __len__(self):
+        return len(self.state.columns['id'])
+
+    def refresh(self):
+        """
+        Bring the snapshot up to date with the database if anything was imported since the last refresh
+        """
+        generation = get_generation()
+        if generation == self.generation:
+            return
+
+        with self.lock:
+            if generation == self.generation:
+                return
+            state = self.state
+            if TransactionHistory.objects.filter(id__lte=state.last_id).count() != len(state.columns['id']):
+                state = empty_state()
+            self.state = self.append_new_rows(state)
+            self.generation = generation
+
+    def append_new_rows(self, state: SnapshotState) -> SnapshotState:
+        """
+        A new state with the rows after state.last_id appended, state itself is left untouched
+        """
+        fields = ['id', 'date_time', 'total'] + list(CATEGORICAL_COLUMNS.values())
+        rows = (TransactionHistory.objects.filter(id__gt=state.last_id).order_by('id')
+                .values_list(*fields).iterator(chunk_size=LOAD_CHUNK_SIZE))
+
+        dictionaries = {name: Dictionary(dictionary.codes) for name, dictionary in state.dictionaries.items()}
+        new_columns = {name: [] for name in ['id', 'date_time', 'total', *CATEGORICAL_COLUMNS]}
+        for row_id, date_time, total, *categorical in rows:
+            new_columns['id'].append(row_id)
+            new_columns['date_time'].append(to_microseconds(date_time))
+            new_columns['total'].append(int(total * 100))
+            for name, value in zip(CATEGORICAL_COLUMNS, categorical):
+                new_columns[name].append(dictionaries[name].encode(value))
+
+        if not new_columns['id']:
+            return state
+
+        columns = dict(state.columns)
+        for name, values in new_columns.items():
+            columns[name] = np.concatenate([columns[name], np.asarray(values, dtype=columns[name].dtype)])
+        return SnapshotState(dictionaries, columns, new_columns['id'][-1])
+
+    def mask(self, filters: Dict, state: SnapshotState):
+        """
+        Boolean mask of the rows of state matching filters, as returned by parse_filters
+        """
+        columns = state.columns
+        mask = np.ones(len(columns['id']), dtype=bool)
+        for name, column in CATEGORICAL_FILTERS.items():
+            values = filters.get(name)
+            if not values:
+                continue
+            if isinstance(values, str):
+                values = [values]
+            codes = state.dictionaries[column].lookup(values)
+            mask &= np.isin(columns[column], codes)
+
+        if filters.get('start'):
+            mask &= columns['date_time'] >= to_microseconds(filters['start'])
+        if filters.get('end'):
+            mask &= columns['date_time'] <= to_microseconds(filters['end'])
+        if filters.get('min_total') is not None:
+            mask &= columns['total'] >= float(filters['min_total'] * 100)
+        if filters.get('max_total') is not None:
+            mask &= columns['total'] <= float(filters['max_total'] * 100)
+        if filters.get('q'):
+            codes = state.dictionaries['product'].lookup(search_products(filters['q']).values_list('id', flat=True))
+            mask &= np.isin(columns['product'], codes)
+        return mask
+
+    def stats(self, filters: Dict, percentiles: Iterable[Decimal] = ()) -> Dict:
+        """
+        Same stats as stats.compute_stats, computed over the snapshot
+
+        params:
+        filters(dict): Normalized filters as returned by parse_filters
+        percentiles(iterable): Additional percentiles (0-100) to compute
+
+        return: dict of stats
+        """
+        self.refresh()
+        state = self.state
+        totals = state.columns['total'][self.mask(filters, state)]
+
+        count = len(totals)
+        if not count:
+            stats = {'summed': None, 'mean': None, 'count': 0, 'min': None, 'max': None, 'median': None}
+            if percentiles:
+                stats['percentiles'] = {str(pct): None for pct in percentiles}
+            return stats
+
+        summed = int(totals.sum())
+        stats = {
+            'summed': cents_to_decimal(summed),
+            'mean': cents_to_decimal(summed) / count,
+            'count': count,
+            'min': cents_to_decimal(totals.min()),
+            'max': cents_to_decimal(totals.max()),
+        }
+        requested = [Decimal(50)] + list(percentiles)
+        values = np.percentile(totals, [float(pct) for pct in requested])
+        stats['median'] = cents_to_decimal(values[0])
+        if percentiles:
+            stats['percentiles'] = {str(pct): cents_to_decimal(value) for pct, value in zip(percentiles, values[1:])}
+        return stats
+
+
+_snapshot: Optional[ColumnarSnapshot] = None
+_snapshot_lock = threading.Lock()
+
+
+def stats_engine() -> str:
+    """
+    Engine the stats endpoint should use, from TRANSACTIONS_STATS_ENGINE
+    """
+    engine = getattr(settings, 'TRANSACTIONS_STATS_ENGINE', DATABASE)
+    if engine == COLUMNAR and np is None:
+        raise ImproperlyConfigured('TRANSACTIONS_STATS_ENGINE = "columnar" requires numpy to be installed')
+    return engine
+
+
+def get_snapshot() -> ColumnarSnapshot:
+    """
+    The process wide snapshot, loaded on first use
+    """
+    global _snapshot
+    with _snapshot_lock:
+        if _snapshot is None:
+            _snapshot = ColumnarSnapshot()
+        return _snapshot
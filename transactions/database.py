@@ -0,0 +1,78 @@
+"""
+SQLite connection tuning and read/write routing.
+
+Every new SQLite connection runs the PRAGMAs of TRANSACTIONS_SQLITE_PRAGMAS (WAL journal, relaxed fsync, memory
+mapped reads, a larger page cache and a busy timeout). In WAL mode readers keep reading the last committed
+snapshot while an import writes, so the API no longer stalls behind long imports.
+
+TransactionsRouter sends reads to TRANSACTIONS_READ_DATABASE and writes to TRANSACTIONS_WRITE_DATABASE. With
+SQLite both aliases point at the same file: the read alias is a separate, query_only connection, so list and stats
+queries never queue behind the writer's transaction in the same connection.
+"""
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+DEFAULT_SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,
+}
+
+
+def write_database() -> str:
+    return getattr(settings, 'TRANSACTIONS_WRITE_DATABASE', DEFAULT_DB_ALIAS)
+
+
+def read_database() -> str:
+    """
+    Alias reads are routed to, the write alias unless a separate read alias is configured
+    """
+    alias = getattr(settings, 'TRANSACTIONS_READ_DATABASE', None)
+    if alias and alias in settings.DATABASES:
+        return alias
+    return write_database()
+
+
+@receiver(connection_created)
+def configure_sqlite(sender, connection, **kwargs):
+    """
+    Apply TRANSACTIONS_SQLITE_PRAGMAS to every new SQLite connection, and make connections of the read alias
+    query_only so a write routed there by mistake fails instead of taking the database lock
+    """
+    if connection.vendor != 'sqlite':
+        return
+
+    pragmas = dict(getattr(settings, 'TRANSACTIONS_SQLITE_PRAGMAS', DEFAULT_SQLITE_PRAGMAS))
+    if connection.alias == read_database() != write_database():
+        pragmas['query_only'] = 'ON'
+    with connection.cursor() as cursor:
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name} = {value}')
+
+
+class TransactionsRouter:
+    """
+    Route reads to the read alias and writes, migrations and everything inside a write transaction to the write
+    alias. Reads made while the write alias is in an atomic block (an import checking which fingerprints are
+    stored, a select_for_update) stay on the writer so they see its uncommitted rows
+    """
+
+    def db_for_read(self, model, **hints):
+        writer = write_database()
+        if connections[writer].in_atomic_block:
+            return writer
+        return read_database()
+
+    def db_for_write(self, model, **hints):
+        return write_database()
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # both aliases are the same database
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db == read_database() != write_database():
+            return False
+        return None
@@ -0,0 +1,161 @@
+import datetime
+import re
+import zoneinfo
+from functools import lru_cache
+from typing import Iterable, List, Optional, Tuple
+
+# UTC offsets, in hours, of the timezone abbreviations found in FBA transaction reports. The report already
+# says whether daylight saving was in effect (PDT vs PST) so a fixed offset per abbreviation is exact
+TZ_OFFSETS = {
+    'UTC': 0,
+    'GMT': 0,
+    'EST': -5,
+    'EDT': -4,
+    'CST': -6,
+    'CDT': -5,
+    'MST': -7,
+    'MDT': -6,
+    'PST': -8,
+    'PDT': -7,
+    'AKST': -9,
+    'AKDT': -8,
+    'HST': -10,
+}
+TZINFOS = {
+    abbreviation: datetime.timezone(datetime.timedelta(hours=offset), abbreviation)
+    for abbreviation, offset in TZ_OFFSETS.items()
+}
+
+MONTHS = {
+    'jan': 1, 'feb': 2, 'mar': 3, 'apr': 4, 'may': 5, 'jun': 6,
+    'jul': 7, 'aug': 8, 'sep': 9, 'oct': 10, 'nov': 11, 'dec': 12,
+}
+
+# e.g. "Nov 1, 2020 12:23:30 AM PDT"
+TIMESTAMP_RE = re.compile(
+    r'\s*([A-Za-z]{3})[A-Za-z]*\.?\s+(\d{1,2}),?\s+(\d{4})\s+(\d{1,2}):(\d{2}):(\d{2})\s*([AaPp][Mm])\s+([A-Za-z]{3,4})\s*$'
+)
+
+# The original parser read PDT as -0900 instead of -0700, so it stored PDT timestamps 2 hours late. The reports
+# only had PDT and PST timestamps, which it read correctly
+LEGACY_PDT_ERROR = datetime.timedelta(hours=2)
+PACIFIC = zoneinfo.ZoneInfo('America/Los_Angeles')
+
+# FBA reports have many rows per second and repeat the same start/end filters, so most lookups are hits
+TIMESTAMP_CACHE_SIZE = 65536
+
+
+@lru_cache(maxsize=TIMESTAMP_CACHE_SIZE)
+def parse_timestamp(date_string: str) -> datetime.datetime:
+    """
+    Parse a report timestamp like Nov 1, 2020 12:23:30 AM PDT into an aware datetime.
+    Results are memoized, datetimes being immutable the cached instance can be shared
+
+    params:
+    date_string(str): The timestamp, month names are matched on their first three letters and the comma is optional
+
+    return: Aware datetime in the timezone named by the abbreviation, raises ValueError if it can't be parsed
+    """
+    match = TIMESTAMP_RE.match(date_string)
+    if not match:
+        raise ValueError(f'unrecognized timestamp {date_string!r}')
+
+    month_name, day, year, hour, minute, second, meridiem, tz_name = match.groups()
+    month = MONTHS.get(month_name.lower())
+    if month is None:
+        raise ValueError(f'unrecognized month in {date_string!r}')
+    tzinfo = TZINFOS.get(tz_name.upper())
+    if tzinfo is None:
+        raise ValueError(f'unrecognized timezone in {date_string!r}')
+
+    hour = int(hour)
+    if not 1 <= hour <= 12:
+        raise ValueError(f'invalid hour in {date_string!r}')
+    if meridiem.upper() == 'AM':
+        hour = 0 if hour == 12 else hour
+    else:
+        hour = 12 if hour == 12 else hour + 12
+
+    return datetime.datetime(int(year), month, int(day), hour, int(minute), int(second), tzinfo=tzinfo)
+
+
+def parse_timestamps(date_strings: Iterable[str], strict: bool = True) -> List[Optional[datetime.datetime]]:
+    """
+    Parse a whole column of report timestamps at once
+
+    params:
+    date_strings(iterable): The timestamps to parse
+    strict(bool): Raise ValueError on the first timestamp that can't be parsed, otherwise return None for it
+
+    return: List of aware datetimes in the same order as date_strings
+    """
+    parsed = []
+    for curr_string in date_strings:
+        try:
+            parsed.append(parse_timestamp(curr_string))
+        except (ValueError, TypeError):
+            if strict:
+                raise
+            parsed.append(None)
+    return parsed
+
+
+def convert_string_to_datetime(date_string: str) -> datetime.datetime:
+    """
+    Given a date_string with a format like Nov 1, 2020 12:23:30 AM PDT, convert it to a datetime.
+
+    params:
+    date_string(str): The string to be converted into a datetime expected format Nov 1, 2020 12:23:30 AM PDT
+
+    return: Python datetime object
+    """
+    return parse_timestamp(date_string)
+
+
+def is_pacific_dst(instant: datetime.datetime) -> bool:
+    """
+    Whether daylight saving time was in effect in US Pacific at the given aware datetime
+    """
+    return bool(instant.astimezone(PACIFIC).dst())
+
+
+def legacy_pdt_timestamps(rows: Iterable[Tuple[int, datetime.datetime]]) -> Tuple[List[int], List[int]]:
+    """
+    Find the rows stored by the original parser from a PDT timestamp, which are 2 hours late (LEGACY_PDT_ERROR).
+    A stored time S can only come from PDT if S - 2h falls within Pacific daylight saving time, and only from PST
+    if S falls outside of it. Both hold for the 2 hours following the switch back to PST, where PDT 12:00-1:59 AM and
+    PST 1:00-2:59 AM were stored at the same times. Reports are in chronological order and imported rows get
+    increasing ids, so a run of such rows is split at the first time going backwards: the rows before it are PDT and
+    the rest PST. A run where time never goes backwards can't be told apart and is left as stored
+
+    params:
+    rows(iterable): (id, stored date_time) of the rows stored by the original parser, in id order
+
+    return: Ids of the rows to move 2 hours earlier and ids of the ambiguous rows left as they are
+    """
+    pdt_ids = []
+    unresolved_ids = []
+    ambiguous = []
+
+    def resolve():
+        times = [stored for _, stored in ambiguous]
+        split = next((i for i in range(1, len(times)) if times[i] < times[i - 1]), None)
+        if split is None:
+            unresolved_ids.extend(row_id for row_id, _ in ambiguous)
+        else:
+            pdt_ids.extend(row_id for row_id, _ in ambiguous[:split])
+        ambiguous.clear()
+
+    for row_id, stored in rows:
+        from_pdt = is_pacific_dst(stored - LEGACY_PDT_ERROR)
+        from_pst = not is_pacific_dst(stored)
+        if from_pdt and from_pst:
+            ambiguous.append((row_id, stored))
+            continue
+        if ambiguous:
+            resolve()
+        if from_pdt:
+            pdt_ids.append(row_id)
+    if ambiguous:
+        resolve()
+    return pdt_ids, unresolved_ids
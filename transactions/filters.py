@@ -0,0 +1,219 @@
+import json
+from decimal import Decimal, InvalidOperation
+from typing import Dict, Sequence, Tuple
+
+from django.db import connections, router
+from django.db.models import Case, F, IntegerField, Q, QuerySet, When
+from django.db.models.expressions import RawSQL
+
+from transactions.dateparse import convert_string_to_datetime
+from transactions.models import FBATransaction
+from transactions.partitions import partition_model
+from transactions.search import parse_search, search_products
+
+# Query parameters handled by parse_filters, anything else in the query string is for the view itself
+FILTER_PARAMS = ('type', 'city', 'state', 'postal', 'skus', 'start', 'end', 'min_total', 'max_total', 'q')
+
+# Filters that accept several values, and the (dimension relation, field) each one applies to. A relation of
+# None is a field of FBATransaction itself
+MULTI_VALUE_FILTERS = {
+    'type': (None, 'order_type'),
+    'city': ('location', 'city'),
+    'state': ('location', 'state'),
+    'postal': ('location', 'postal'),
+    'skus': ('product', 'sku'),
+}
+
+# Columns of a listed transaction. The product and location attributes are joined back in under the names
+# they had when they were columns of fba_transactions, so the API output didn't change
+TRANSACTION_FIELDS = ('id', 'date_time', 'order_type', 'order_id', 'quantity', 'total', 'fingerprint')
+DIMENSION_VALUES = {
+    'sku': F('product__sku'),
+    'description': F('product__description'),
+    'order_city': F('location__city'),
+    'order_state': F('location__state'),
+    'order_postal': F('location__postal'),
+}
+TRANSACTION_COLUMNS = TRANSACTION_FIELDS + tuple(DIMENSION_VALUES)
+
+# Value sets longer than this are sent as a single JSON array parameter and expanded by the database,
+# instead of one bound parameter per value
+INLINE_VALUES_LIMIT = 64
+
+
+def parse_values(query_dict: Dict, name: str) -> Tuple[str, ...]:
+    """
+    All values of a multi-value filter, whether sent comma separated (skus=a,b), repeated (skus=a&skus=b) or both
+
+    return: The values de-duplicated and sorted, so equivalent requests produce equal filters
+    """
+    getlist = getattr(query_dict, 'getlist', lambda key: [query_dict.get(key)])
+    values = set()
+    for value in getlist(name):
+        if value:
+            values.update(part for part in value.split(',') if part)
+    return tuple(sorted(values))
+
+
+def parse_total(value: str, name: str) -> Decimal:
+    try:
+        total = Decimal(value)
+    except InvalidOperation:
+        raise ValueError(f'{name} {value} is not a number')
+    if not total.is_finite():
+        raise ValueError(f'{name} {value} is not a number')
+    return total
+
+
+def parse_filters(query_dict: Dict) -> Dict:
+    """
+    Pull the filters do_filtering understands out of query_dict and normalize them, so that equivalent
+    requests produce equal dicts: the values of type/city/state/postal/skus become de-duplicated sorted tuples,
+    start/end are parsed to datetimes, min_total/max_total to Decimals and q to a sorted tuple of search terms
+
+    params:
+    query_dict(dict): Dictionary of filters, usually request.GET
+
+    return: dict containing only the filters that were given, raises ValueError if start/end,
+        min_total/max_total or q can't be parsed
+    """
+    filters = {}
+
+    for name in MULTI_VALUE_FILTERS:
+        values = parse_values(query_dict, name)
+        if values:
+            filters[name] = values
+
+    for name in ('start', 'end'):
+        value = query_dict.get(name)
+        if value:
+            filters[name] = convert_string_to_datetime(value)
+
+    for name in ('min_total', 'max_total'):
+        value = query_dict.get(name)
+        if value:
+            filters[name] = parse_total(value, name)
+
+    value = query_dict.get('q')
+    if value:
+        filters['q'] = parse_search(value)
+
+    return filters
+
+
+def values_in(field: str, values: Sequence, model=FBATransaction) -> Q:
+    """
+    Condition matching rows whose field is one of values.
+    A handful of values is a plain IN list. Larger sets are bound as one JSON array which the database expands
+    itself (IN (SELECT value FROM json_each(%s)) on SQLite), so a catalog of thousands of SKUs neither hits the
+    bound parameter limit nor compiles a giant statement, and the lookup on field can still use its index
+
+    params:
+    field(str): Field of model to match
+    values(sequence): Values to match, or a single value
+    model: Model being queried, to find the database it's read from
+
+    return: Q object
+    """
+    if isinstance(values, str):
+        values = (values,)
+    if len(values) == 1:
+        return Q(**{field: values[0]})
+    connection = connections[router.db_for_read(model)]
+    if len(values) <= INLINE_VALUES_LIMIT or not connection.features.supports_json_field:
+        return Q(**{f'{field}__in': values})
+    if connection.vendor == 'postgresql':
+        expanded = RawSQL('SELECT jsonb_array_elements_text(%s::jsonb)', [json.dumps(list(values))])
+    else:
+        expanded = RawSQL('SELECT value FROM json_each(%s)', [json.dumps(list(values))])
+    return Q(**{f'{field}__in': expanded})
+
+
+def filter_transactions(filters: Dict) -> QuerySet:
+    """
+    Build the FBATransaction query for filters as returned by parse_filters.
+    Take advantage of the lazy query characteristic of django and build the query iteratively
+
+    params:
+    filters(dict): Normalized filters
+
+    return: QuerySet of FBATransaction, or of ArchivedTransaction/TransactionHistory if the start/end range
+        overlaps archived months (see partitions.partition_model)
+    """
+    query = partition_model(filters.get('start'), filters.get('end')).objects.all()
+
+    dimension_conditions = {}
+    for name, (relation, field) in MULTI_VALUE_FILTERS.items():
+        values = filters.get(name)
+        if not values:
+            continue
+        if relation is None:
+            query = query.filter(values_in(field, values))
+        else:
+            model = FBATransaction._meta.get_field(relation).related_model
+            dimension_conditions.setdefault(relation, []).append(values_in(field, values, model))
+
+    # SKUs and locations are matched in the small dimension tables, the transactions are then filtered on the
+    # integer keys of the matching rows: product_id IN (SELECT id FROM fba_products WHERE sku IN (...))
+    for relation, conditions in dimension_conditions.items():
+        model = FBATransaction._meta.get_field(relation).related_model
+        query = query.filter(**{f'{relation}__in': model.objects.filter(*conditions).values('id')})
+
+    parsed_start = filters.get('start')
+    if parsed_start:
+        query = query.filter(date_time__gte=parsed_start)
+
+    parsed_end = filters.get('end')
+    if parsed_end:
+        query = query.filter(date_time__lte=parsed_end)
+
+    min_total = filters.get('min_total')
+    if min_total is not None:
+        query = query.filter(total__gte=min_total)
+
+    max_total = filters.get('max_total')
+    if max_total is not None:
+        query = query.filter(total__lte=max_total)
+
+    # full-text matches are looked up in the products' search index, see transactions.search
+    terms = filters.get('q')
+    if terms:
+        query = query.filter(product__in=search_products(terms).values('id'))
+
+    return query
+
+
+def do_filtering(query_dict: Dict):
+    """
+    Go through the query_dict and perform any of the queries that are specified in it.
+
+    params:
+    query_dict(dict): Dictionary of filters apply
+
+    return: Query result, ordered by how well the product matches if searching with q
+    """
+    filters = parse_filters(query_dict)
+    query = filter_transactions(filters)
+    if filters.get('q'):
+        query = rank_by_search(query, filters['q'])
+    return transaction_values(query)
+
+
+def rank_by_search(query: QuerySet, terms: Tuple[str, ...]) -> QuerySet:
+    """
+    Order transactions matching the search terms best match first (bm25 rank of their product), then by
+    date/time
+    """
+    # the few matching products are ranked once, correlating the rank per transaction would re-run the MATCH for
+    # every row
+    ranked = search_products(terms).order_by('rank').values_list('id', flat=True)
+    search_rank = Case(*(When(product_id=product_id, then=position) for position, product_id in enumerate(ranked)),
+                       output_field=IntegerField())
+    return query.annotate(search_rank=search_rank).order_by('search_rank', 'date_time', 'id')
+
+
+def transaction_values(query: QuerySet) -> QuerySet:
+    """
+    The values() of the transactions in query as returned by the API, keyed by TRANSACTION_COLUMNS
+    """
+    return query.values(*TRANSACTION_FIELDS, **DIMENSION_VALUES)
@@ -0,0 +1,273 @@
+import codecs
+import csv
+import datetime
+import hashlib
+import threading
+import time
+from decimal import Decimal
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Set
+
+from django.db import transaction
+from django.db.models import Q
+
+from transactions.cache import bump_generation
+from transactions.filters import values_in
+from transactions.models import DIMENSION_FIELDS, ArchivedMonth, ArchivedTransaction, FBATransaction
+from transactions.parsing import parse_row
+from transactions.rollups import apply_to_rollups
+from transactions.utils import chunked
+
+# Number of rows written per bulk_create/transaction. Large enough to amortize the commit, small enough
+# that a chunk of model instances stays a few MB regardless of how big the uploaded report is
+IMPORT_BATCH_SIZE = 1000
+
+# Fingerprints looked up per query when checking for already imported rows
+FINGERPRINT_LOOKUP_SIZE = 500
+
+# Number of rejected rows whose reason is reported back
+MAX_REPORTED_ERRORS = 100
+
+CENTS = Decimal('0.01')
+
+# Held around the write transaction of every chunk. SQLite has a single writer: a deferred transaction that read
+# the fingerprints before another import thread committed can't upgrade to a write and fails with "database is
+# locked" however long the busy timeout, so the imports of this process write their chunks one at a time. Rows are
+# still parsed and fingerprinted concurrently
+IMPORT_WRITE_LOCK = threading.Lock()
+
+
+def row_to_transaction(row: Dict) -> FBATransaction:
+    """
+    Map a single row of the FBA transaction report (keyed by the report's column headers) to an unsaved
+    FBATransaction
+
+    params:
+    row(dict): One report row, e.g. from csv.DictReader or the JSON upload
+
+    return: Unsaved FBATransaction, raises ValueError if the row can't be stored
+    """
+    return FBATransaction(**parse_row(row)._asdict())
+
+
+def iter_csv_rows(stream: Iterable[bytes], encoding: str = 'utf-8-sig') -> Iterator[Dict]:
+    """
+    Lazily parse a CSV report from an iterable of byte lines (an HttpRequest body or an UploadedFile) without
+    reading the whole thing into memory
+
+    params:
+    stream(iterable): Yields the raw bytes of the report line by line
+    encoding(str): Encoding of the report, the default also strips a leading BOM
+
+    return: Iterator of dicts keyed by the report's header row
+    """
+    return csv.DictReader(codecs.iterdecode(stream, encoding))
+
+
+def transaction_fingerprint(date_time: datetime.datetime, order_type: Optional[str], order_id: Optional[str],
+                            sku: Optional[str], quantity: Optional[int], total: Decimal, occurrence: int = 0) -> str:
+    """
+    Content hash identifying a report row, used to recognize rows that were already imported from an
+    overlapping report
+
+    params:
+    date_time(datetime): Aware timestamp of the transaction
+    order_type, order_id, sku, quantity, total: The remaining identifying columns
+    occurrence(int): How many identical rows with the same timestamp precede this one in the report
+
+    return: 40 character hex digest
+    """
+    parts = [
+        date_time.astimezone(datetime.timezone.utc).isoformat(),
+        order_type or '',
+        order_id or '',
+        sku or '',
+        '' if quantity is None else str(quantity),
+        str(Decimal(total).quantize(CENTS)),
+        str(occurrence),
+    ]
+    return hashlib.sha1('\x1f'.join(parts).encode('utf-8')).hexdigest()
+
+
+class Fingerprinter:
+    """
+    Assigns fingerprints to transactions in report order.
+
+    Reports do contain genuinely identical rows (e.g. two return fees for the same order in the same second), so
+    identical rows are told apart by their occurrence number. Identical rows share a timestamp and reports are
+    sorted by time, so occurrences only need to be counted until the timestamp changes, which keeps the state
+    small however long the report is
+    """
+
+    def __init__(self):
+        self.current_date_time = None
+        self.occurrences: Dict[tuple, int] = {}
+
+    def __call__(self, entry: FBATransaction) -> str:
+        return self.fingerprint(entry.date_time, entry.order_type, entry.order_id, entry.sku, entry.quantity,
+                                Decimal(entry.total))
+
+    def fingerprint(self, date_time: datetime.datetime, *content) -> str:
+        """
+        Fingerprint of the next row, given as its date/time followed by the identifying columns of
+        transaction_fingerprint
+        """
+        if date_time != self.current_date_time:
+            self.current_date_time = date_time
+            self.occurrences = {}
+
+        occurrence = self.occurrences.get(content, 0)
+        self.occurrences[content] = occurrence + 1
+        return transaction_fingerprint(date_time, *content, occurrence=occurrence)
+
+
+def existing_fingerprints(fingerprints: List[str]) -> Set[str]:
+    """
+    Which of fingerprints are already stored, looked up in slices that stay under SQLite's bound parameter limit.
+    The archive is only searched for the ones not in fba_transactions, and only once a month was archived
+    """
+    existing = set()
+    for curr_slice in chunked(fingerprints, FINGERPRINT_LOOKUP_SIZE):
+        existing.update(FBATransaction.objects.filter(fingerprint__in=curr_slice).values_list('fingerprint', flat=True))
+
+    missing = [fingerprint for fingerprint in fingerprints if fingerprint not in existing]
+    if missing and ArchivedMonth.objects.exists():
+        for curr_slice in chunked(missing, FINGERPRINT_LOOKUP_SIZE):
+            existing.update(ArchivedTransaction.objects.filter(fingerprint__in=curr_slice)
+                            .values_list('fingerprint', flat=True))
+    return existing
+
+
+class DimensionCache:
+    """
+    In-process map of the attribute values of one dimension table (Product or Location) to its rows.
+    Keys not in the map yet are looked up, and created if they don't exist, in one batch per chunk of transactions,
+    so an import costs a few queries per distinct product or location instead of one per row
+    """
+
+    def __init__(self, model, fields: Sequence[str]):
+        self.model = model
+        self.fields = tuple(fields)
+        self.rows: Dict[tuple, object] = {}
+
+    def resolve(self, keys: Iterable[tuple]):
+        """
+        Make sure every key has its row in the map, creating the ones that don't exist yet
+        """
+        missing = {key for key in keys if key not in self.rows and any(value is not None for value in key)}
+        if not missing:
+            return
+        self.load(missing)
+        created = [self.model(**dict(zip(self.fields, key))) for key in missing if key not in self.rows]
+        if created:
+            # SQLite doesn't return the ids of rows created with ignore_conflicts, so read them back
+            self.model.objects.bulk_create(created, ignore_conflicts=True)
+            self.load({key for key in missing if key not in self.rows})
+
+    def load(self, keys: Set[tuple]):
+        # select on the first attribute only, one IN over a single JSON parameter (see filters.values_in),
+        # and match the full keys here. ORing one condition per key makes Django's query building quadratic
+        first = self.fields[0]
+        values = sorted({key[0] for key in keys if key[0] is not None})
+        matches = Q(**{f'{first}__isnull': True}) if any(key[0] is None for key in keys) else Q()
+        if values:
+            matches |= values_in(first, values, self.model)
+        for row in self.model.objects.filter(matches).order_by('id').iterator():
+            key = tuple(getattr(row, name) for name in self.fields)
+            if key in keys:
+                self.rows.setdefault(key, row)
+
+    def get(self, key: tuple):
+        return self.rows.get(key)
+
+
+class DimensionResolver:
+    """
+    Points imported transactions at the product and location rows matching the attributes set on them.
+    Lives for one import, so its caches never outlast the rows they refer to
+    """
+
+    def __init__(self):
+        self.caches = {
+            relation: DimensionCache(FBATransaction._meta.get_field(relation).related_model, fields)
+            for relation, fields in DIMENSION_FIELDS.items()
+        }
+
+    def __call__(self, entries: List[FBATransaction]):
+        for relation, cache in self.caches.items():
+            pending = [(entry, entry.pending_dimensions.pop(relation)) for entry in entries
+                       if relation in entry.pending_dimensions]
+            keys = [tuple(values[name] for name in cache.fields) for _, values in pending]
+            cache.resolve(keys)
+            for (entry, _), key in zip(pending, keys):
+                setattr(entry, relation, cache.get(key))
+
+
+def import_rows(rows: Iterable[Dict], batch_size: int = IMPORT_BATCH_SIZE,
+                progress: Optional[Callable[[Dict], None]] = None) -> Dict:
+    """
+    Store report rows in fixed-size chunks, each chunk written with a single bulk_create inside its own transaction
+    that also adds the chunk to the daily rollups. Concurrent imports take turns writing their chunks, see
+    IMPORT_WRITE_LOCK.
+    Rows whose fingerprint is already stored are skipped, so re-importing an overlapping report only inserts the
+    new rows. The products and locations of the new rows are resolved to their dimension rows by a
+    DimensionResolver kept for the whole import
+
+    params:
+    rows(iterable): Report rows, consumed lazily
+    batch_size(int): Number of rows per bulk insert/transaction
+    progress(callable): Called with the running result after each chunk is committed
+
+    return: dict with the number of rows accepted (of which inserted and duplicates) and rejected,
+        the first MAX_REPORTED_ERRORS reasons rows were rejected and the elapsed time in seconds
+    """
+    started = time.monotonic()
+    accepted = 0
+    inserted = 0
+    rejected = 0
+    errors = []
+    fingerprinter = Fingerprinter()
+    resolve_dimensions = DimensionResolver()
+
+    def result():
+        return {
+            'accepted': accepted,
+            'inserted': inserted,
+            'duplicates': accepted - inserted,
+            'rejected': rejected,
+            'errors': errors,
+            'elapsed': round(time.monotonic() - started, 3),
+        }
+
+    row_number = 0
+    for chunk in chunked(rows, batch_size):
+        entries = {}
+        for curr_row in chunk:
+            row_number += 1
+            try:
+                entry = row_to_transaction(curr_row)
+            except (AttributeError, ValueError, TypeError) as e:
+                rejected += 1
+                if len(errors) < MAX_REPORTED_ERRORS:
+                    errors.append(f'row {row_number}: {e}')
+                continue
+            entry.fingerprint = fingerprinter(entry)
+            entries[entry.fingerprint] = entry
+            accepted += 1
+
+        if entries:
+            with IMPORT_WRITE_LOCK, transaction.atomic():
+                existing = existing_fingerprints(list(entries))
+                new_entries = [entry for fingerprint, entry in entries.items() if fingerprint not in existing]
+                if new_entries:
+                    resolve_dimensions(new_entries)
+                    # no ignore_conflicts: holding the lock, nothing can store these fingerprints since the lookup
+                    # above, and a conflict has to fail the chunk rather than be counted and rolled up as inserted
+                    FBATransaction.objects.bulk_create(new_entries, batch_size=batch_size)
+                    apply_to_rollups(new_entries)
+                    bump_generation()
+            inserted += len(new_entries)
+
+        if progress:
+            progress(result())
+
+    return result()
@@ -0,0 +1,204 @@
+import json
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.base import ContentFile
+from django.db import DatabaseError, close_old_connections, transaction
+from django.utils import timezone
+
+from transactions.ingest import import_rows, iter_csv_rows
+from transactions.metrics import record_import
+from transactions.models import ImportJob
+
+logger = logging.getLogger(__name__)
+
+# How the import of a stored upload is run:
+# thread - in a pool of TRANSACTIONS_IMPORT_WORKERS threads of the web process
+# worker - left queued for "manage.py process_imports" to pick up
+# inline - immediately, inside the request that uploaded it
+THREAD = 'thread'
+WORKER = 'worker'
+INLINE = 'inline'
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def get_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=getattr(settings, 'TRANSACTIONS_IMPORT_WORKERS', 2),
+                                           thread_name_prefix='transactions-import')
+        return _executor
+
+
+def create_import_job(upload, name: str, file_format: str = ImportJob.CSV) -> ImportJob:
+    """
+    Store an uploaded report and queue it for import
+
+    params:
+    upload: File-like object (UploadedFile, request body stream) or bytes to store
+    name(str): File name to store the upload under
+    file_format(str): ImportJob.CSV or ImportJob.JSON
+
+    return: The queued ImportJob
+    """
+    if isinstance(upload, bytes):
+        upload = ContentFile(upload)
+    elif not isinstance(upload, File):
+        upload = File(upload)
+
+    job = ImportJob(file_format=file_format)
+    job.file.save(name, upload, save=False)
+    job.save()
+
+    runner = getattr(settings, 'TRANSACTIONS_IMPORT_RUNNER', THREAD)
+    if runner == INLINE:
+        run_import_job(job.id)
+        job.refresh_from_db()
+    elif runner == THREAD:
+        # the worker thread has its own connection, it can only see the job once it's committed
+        transaction.on_commit(lambda: get_executor().submit(run_import_job_in_thread, job.id))
+    return job
+
+
+def claim_import_job(job_id: int) -> bool:
+    """
+    Atomically move a queued job to running, so that a job is only ever processed once
+    """
+    return ImportJob.objects.filter(id=job_id, status=ImportJob.QUEUED).update(
+        status=ImportJob.RUNNING, started_at=timezone.now()) == 1
+
+
+def next_queued_job() -> Optional[int]:
+    """
+    Claim the oldest queued job, return its id or None if there's nothing to do
+    """
+    while True:
+        job_id = ImportJob.objects.filter(status=ImportJob.QUEUED).order_by('id').values_list('id', flat=True).first()
+        if job_id is None:
+            return None
+        if claim_import_job(job_id):
+            return job_id
+
+
+def requeue_interrupted_jobs() -> int:
+    """
+    Move the jobs left running by a process that stopped back to queued. Importing a report again is safe, the rows
+    it already stored are skipped by their fingerprint
+
+    return: Number of jobs queued again
+    """
+    return ImportJob.objects.filter(status=ImportJob.RUNNING).update(status=ImportJob.QUEUED, started_at=None)
+
+
+def resume_import_jobs() -> List[int]:
+    """
+    With the thread runner nothing else picks up a job once the process that queued or ran it is gone, so the web
+    process calls this on startup (see django_test/wsgi.py and asgi.py). Jobs left running are queued again and
+    every queued job is submitted to the import threads. This assumes a single web process, with several of them
+    use the worker runner and manage.py process_imports --requeue-running
+
+    return: Ids of the jobs submitted
+    """
+    if getattr(settings, 'TRANSACTIONS_IMPORT_RUNNER', THREAD) != THREAD:
+        return []
+    try:
+        requeue_interrupted_jobs()
+        job_ids = list(ImportJob.objects.filter(status=ImportJob.QUEUED).order_by('id').values_list('id', flat=True))
+    except DatabaseError:
+        # not migrated yet
+        logger.warning('could not resume the queued import jobs', exc_info=True)
+        return []
+    finally:
+        close_old_connections()
+    for job_id in job_ids:
+        get_executor().submit(run_import_job_in_thread, job_id)
+    return job_ids
+
+
+def run_import_job(job_id: int, claimed: bool = False):
+    """
+    Import the report stored for a job, recording progress on the job after every chunk
+
+    params:
+    job_id(int): Id of the ImportJob
+    claimed(bool): Whether the caller already moved the job to running with claim_import_job
+    """
+    if not claimed and not claim_import_job(job_id):
+        return
+    job = ImportJob.objects.get(id=job_id)
+
+    def record_progress(result: Dict):
+        ImportJob.objects.filter(id=job_id).update(
+            rows_processed=result.get('accepted') + result.get('rejected'),
+            inserted=result.get('inserted'),
+            duplicates=result.get('duplicates'),
+            rejected=result.get('rejected'),
+            errors=result.get('errors'),
+        )
+
+    try:
+        with job.file.open('rb') as report:
+            if job.file_format == ImportJob.JSON:
+                rows = json.load(report)
+                if not isinstance(rows, list):
+                    raise ValueError('expected a JSON array of transactions')
+            else:
+                rows = iter_csv_rows(report)
+            result = import_rows(rows, progress=record_progress)
+        record_progress(result)
+        record_import('api', result.get('accepted') + result.get('rejected'), result.get('inserted'),
+                      result.get('elapsed'))
+    except Exception as e:
+        logger.exception('import job %s failed', job_id)
+        ImportJob.objects.filter(id=job_id).update(status=ImportJob.FAILED, error=str(e), finished_at=timezone.now())
+        return
+
+    ImportJob.objects.filter(id=job_id).update(status=ImportJob.SUCCEEDED, finished_at=timezone.now())
+    if not getattr(settings, 'TRANSACTIONS_IMPORT_KEEP_FILES', False):
+        job.file.delete(save=False)
+        ImportJob.objects.filter(id=job_id).update(file='')
+
+
+def run_import_job_in_thread(job_id: int):
+    """
+    Entry point of the pool threads, which have to manage their own database connection
+    """
+    close_old_connections()
+    try:
+        run_import_job(job_id)
+    finally:
+        close_old_connections()
+
+
+def job_status(job: ImportJob) -> Dict:
+    """
+    Progress report of a job as returned by the imports endpoint
+    """
+    elapsed = None
+    throughput = None
+    if job.started_at:
+        elapsed = ((job.finished_at or timezone.now()) - job.started_at).total_seconds()
+        throughput = round(job.rows_processed / elapsed, 1) if elapsed > 0 else None
+
+    return {
+        'id': job.id,
+        'status': job.status,
+        'created_at': job.created_at,
+        'started_at': job.started_at,
+        'finished_at': job.finished_at,
+        'rows_processed': job.rows_processed,
+        'inserted': job.inserted,
+        'duplicates': job.duplicates,
+        'rejected': job.rejected,
+        'elapsed': round(elapsed, 3) if elapsed is not None else None,
+        'rows_per_second': throughput,
+        'errors': job.errors,
+        'error': job.error,
+    }
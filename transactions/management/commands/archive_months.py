@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from transactions.archive import archive_month, drop_month, months_before, parse_month
+
+
+class Command(BaseCommand):
+    help = ('Move the transactions of closed months from fba_transactions to fba_transactions_archive, or drop '
+            'archived months. Queries over recent months then never touch the archive')
+
+    def add_arguments(self, parser):
+        parser.add_argument('months', nargs='*', help='Months to archive (or drop), as YYYY-MM')
+        parser.add_argument('--before', help='Archive every month with transactions before this one (YYYY-MM)')
+        parser.add_argument('--drop', action='store_true',
+                            help='Delete the transactions and daily rollups of the given archived months, keeping '
+                                 'their summary in fba_archived_months')
+
+    def handle(self, *args, **options):
+        try:
+            months = [parse_month(month) for month in options['months']]
+            if options['before']:
+                if options['drop']:
+                    raise CommandError('--before cannot be combined with --drop')
+                months.extend(months_before(parse_month(options['before'])))
+        except ValueError as e:
+            raise CommandError(str(e))
+        if not months:
+            raise CommandError('give the months to archive or --before')
+
+        for month in sorted(set(months)):
+            try:
+                if options['drop']:
+                    archived = drop_month(month)
+                    self.stdout.write(f'{month:%Y-%m}: dropped {archived.count} archived transactions')
+                else:
+                    archived = archive_month(month)
+                    self.stdout.write(f'{month:%Y-%m}: {archived.count} transactions archived, '
+                                      f'{archived.total_sum} total')
+            except ValueError as e:
+                raise CommandError(str(e))
@@ -0,0 +1,55 @@
+import csv
+import datetime
+import timeit
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from transactions.dateparse import parse_timestamp, parse_timestamps
+
+
+def legacy_convert_string_to_datetime(date_string: str):
+    """
+    The original replace + strptime implementation, kept here only as the benchmark baseline
+    """
+    date_string = date_string.replace(', ', ' ')
+    date_string = date_string.replace(' PDT', ' -0900')
+    date_string = date_string.replace(' PST', ' -0800')
+    return datetime.datetime.strptime(date_string, '%b %d %Y %I:%M:%S %p %z')
+
+
+class Command(BaseCommand):
+    help = 'Microbenchmark of the report timestamp parser against the original strptime based conversion'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--file', default=str(settings.BASE_DIR / 'example_transactions.csv'),
+                            help='CSV report whose date/time column is parsed')
+        parser.add_argument('--repeat', type=int, default=5, help='Number of timed runs, the best one is reported')
+
+    def handle(self, *args, **options):
+        with open(options['file'], newline='', encoding='utf-8-sig') as report:
+            column = [row['date/time'] for row in csv.DictReader(report)]
+
+        def run_legacy():
+            for curr_string in column:
+                legacy_convert_string_to_datetime(curr_string)
+
+        def run_uncached():
+            for curr_string in column:
+                parse_timestamp.__wrapped__(curr_string)
+
+        def run_cold():
+            parse_timestamp.cache_clear()
+            parse_timestamps(column)
+
+        def run_warm():
+            parse_timestamps(column)
+
+        self.stdout.write(f'{len(column)} timestamps, {len(set(column))} distinct, best of {options["repeat"]}')
+        baseline = None
+        for name, func in [('strptime (original)', run_legacy), ('tokenizer, no cache', run_uncached),
+                           ('batch, cold cache', run_cold), ('batch, warm cache', run_warm)]:
+            best = min(timeit.repeat(func, number=1, repeat=options['repeat']))
+            baseline = baseline or best
+            self.stdout.write(f'{name:<22} {best * 1000:9.2f} ms  {len(column) / best:12.0f} rows/s  '
+                              f'{baseline / best:6.1f}x')
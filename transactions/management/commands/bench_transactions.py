@@ -0,0 +1,153 @@
+import csv
+import datetime
+import json
+import os
+import platform
+import sqlite3
+import tempfile
+import time
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection, connections
+from django.test import Client, override_settings
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from transactions.asgi import DEFAULT_WORKERS, TransactionsASGIHandler, shutdown_pools
+from transactions.benchmarks import (filter_matrix, report_to_csv, run_mixed_load_asgi, run_mixed_load_wsgi,
+                                     run_query_matrix, synthesize_report)
+from transactions.database import read_database
+from transactions.models import FBATransaction
+
+
+ASYNC_WORKERS = {**DEFAULT_WORKERS, **getattr(settings, 'TRANSACTIONS_ASYNC_WORKERS', {})}
+
+
+class Command(BaseCommand):
+    help = ('Load and latency benchmark of the transactions API. Imports a synthesized report of N copies of '
+            'example_transactions.csv through the POST endpoint into a scratch database, then times the list and '
+            'stats endpoints over a matrix of filters, compares how the WSGI and ASGI handlers serve cheap list pages '
+            'while expensive aggregations run, and writes the results to a JSON file')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--copies', type=int, default=5, help='Copies of the sample report to import')
+        parser.add_argument('--repeat', type=int, default=20, help='Timed requests per endpoint and filter set')
+        parser.add_argument('--seed', type=int, default=0, help='Seed of the synthesized report')
+        parser.add_argument('--sample', default=str(settings.BASE_DIR / 'example_transactions.csv'),
+                            help='Report the synthesized one is drawn from')
+        parser.add_argument('--output', default='bench_results.json', help='File the results are written to')
+        parser.add_argument('--in-memory', action='store_true',
+                            help='Use an in-memory scratch database instead of a temporary file')
+        parser.add_argument('--with-cache', action='store_true', help='Leave the response cache enabled')
+        parser.add_argument('--cheap-requests', type=int, default=50,
+                            help='List pages sent at once in the mixed load benchmark, 0 skips it')
+        parser.add_argument('--expensive-requests', type=int, default=4,
+                            help='Stats aggregations sent at once with them')
+        parser.add_argument('--wsgi-threads', type=int, default=sum(ASYNC_WORKERS.values()),
+                            help='Threads serving the WSGI side of the mixed load, by default as many as the ASGI '
+                                 'side has in its pools')
+
+    def handle(self, *args, **options):
+        with open(options['sample'], newline='', encoding='utf-8-sig') as sample:
+            sample_rows = list(csv.DictReader(sample))
+        report = report_to_csv(synthesize_report(sample_rows, options['copies'], options['seed']))
+        row_count = len(sample_rows) * options['copies']
+
+        scratch_dir = tempfile.TemporaryDirectory()
+        if not options['in_memory']:
+            connection.settings_dict.setdefault('TEST', {})['NAME'] = os.path.join(scratch_dir.name, 'bench.sqlite3')
+
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        # point the read alias at the scratch database too, as the test runner does for mirrors
+        reader = connections[read_database()]
+        old_reader_name = reader.settings_dict['NAME']
+        if reader is not connection:
+            reader.close()
+            reader.creation.set_as_test_mirror(connection.settings_dict)
+        try:
+            with override_settings(TRANSACTIONS_IMPORT_RUNNER='inline',
+                                   TRANSACTIONS_CACHE_ENABLED=options['with_cache'],
+                                   MEDIA_ROOT=scratch_dir.name):
+                results = self.run_benchmark(report, row_count, sample_rows, options)
+        finally:
+            if reader is not connection:
+                reader.close()
+                reader.settings_dict['NAME'] = old_reader_name
+            shutdown_pools()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+            scratch_dir.cleanup()
+
+        with open(options['output'], 'w') as output:
+            json.dump(results, output, indent=2)
+        self.stdout.write(f'Results written to {options["output"]}')
+
+    def run_benchmark(self, report: bytes, row_count: int, sample_rows, options):
+        client = Client()
+
+        started = time.perf_counter()
+        response = client.post('/api/transactions/', data=report, content_type='text/csv')
+        ingest_seconds = time.perf_counter() - started
+        ingest = {
+            'rows': row_count,
+            'bytes': len(report),
+            'seconds': round(ingest_seconds, 3),
+            'rows_per_second': round(row_count / ingest_seconds, 1),
+            'inserted': response.data.get('inserted'),
+        }
+        self.stdout.write(f'Ingest: {row_count} rows in {ingest_seconds:.2f}s, {ingest["rows_per_second"]:.0f} rows/s')
+
+        started = time.perf_counter()
+        response = client.post('/api/transactions/', data=report, content_type='text/csv')
+        reimport_seconds = time.perf_counter() - started
+        ingest['reimport_seconds'] = round(reimport_seconds, 3)
+        ingest['reimport_duplicates'] = response.data.get('duplicates')
+        self.stdout.write(f'Re-import of the same report: {reimport_seconds:.2f}s')
+
+        queries = run_query_matrix(client, filter_matrix(sample_rows), options['repeat'])
+        for result in queries:
+            self.stdout.write(f'{result["endpoint"]:<18} p50 {result["p50_ms"]:9.2f} ms  p95 {result["p95_ms"]:9.2f} ms'
+                              f'  p99 {result["p99_ms"]:9.2f} ms  peak {result["peak_memory_kib"]:9.1f} KiB'
+                              f'  {json.dumps(result["filters"])}')
+
+        concurrency = None
+        if options['cheap_requests']:
+            concurrency = self.run_mixed_load(options)
+
+        return {
+            'meta': {
+                'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                'copies': options['copies'],
+                'seed': options['seed'],
+                'repeat': options['repeat'],
+                'rows_stored': FBATransaction.objects.count(),
+                'in_memory': options['in_memory'],
+                'cache': options['with_cache'],
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'sqlite': sqlite3.sqlite_version,
+            },
+            'ingest': ingest,
+            'queries': queries,
+            'concurrency': concurrency,
+        }
+
+    def run_mixed_load(self, options):
+        cheap, expensive = options['cheap_requests'], options['expensive_requests']
+        self.stdout.write(f'Mixed load: {cheap} list pages sent along with {expensive} stats aggregations')
+        results = {
+            'cheap_requests': cheap,
+            'expensive_requests': expensive,
+            'wsgi_threads': options['wsgi_threads'],
+            'async_workers': ASYNC_WORKERS,
+            'wsgi': run_mixed_load_wsgi(cheap, expensive, options['wsgi_threads']),
+            'asgi': run_mixed_load_asgi(TransactionsASGIHandler(), cheap, expensive),
+        }
+        for name in ('wsgi', 'asgi'):
+            result = results[name]
+            self.stdout.write(f'{name.upper()}: {result["seconds"]:.2f}s, list p50 {result["cheap"]["p50_ms"]:9.2f} ms'
+                              f'  p95 {result["cheap"]["p95_ms"]:9.2f} ms, stats p50 '
+                              f'{result["expensive"]["p50_ms"]:9.2f} ms  max {result["expensive"]["max_ms"]:9.2f} ms')
+        return results
@@ -0,0 +1,48 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from transactions.bulk_import import BULK_CHUNK_SIZE, BULK_COMMIT_SIZE, bulk_import
+
+
+class Command(BaseCommand):
+    help = ('Bulk load CSV or JSON transaction reports straight into the database, parsing them in a pool of '
+            'processes. Much faster than uploading them through the API, meant for backfilling history')
+
+    def add_arguments(self, parser):
+        parser.add_argument('files', nargs='+', help='CSV reports, or JSON arrays of rows if the name ends in .json')
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                            help='Number of parsing processes, 1 to parse in this process (default: one per CPU)')
+        parser.add_argument('--chunk-size', type=int, default=BULK_CHUNK_SIZE,
+                            help='Rows per parsed chunk and insert statement')
+        parser.add_argument('--commit-size', type=int, default=BULK_COMMIT_SIZE,
+                            help='Rows inserted per transaction')
+        parser.add_argument('--drop-indexes', action='store_true',
+                            help='Drop the secondary indexes of fba_transactions during the load and rebuild them '
+                                 'afterwards, fastest for loads that are large compared to the table')
+
+    def handle(self, *args, **options):
+        for path in options['files']:
+            if not os.path.isfile(path):
+                raise CommandError(f'{path} does not exist')
+        if options['workers'] < 1 or options['chunk_size'] < 1 or options['commit_size'] < 1:
+            raise CommandError('--workers, --chunk-size and --commit-size must be at least 1')
+
+        def report_progress(result):
+            self.stdout.write(f'{result["rows"]} rows, {result["inserted"]} inserted, '
+                              f'{result["rows_per_second"]} rows/sec')
+
+        result = bulk_import(
+            options['files'],
+            workers=options['workers'],
+            chunk_size=options['chunk_size'],
+            commit_size=options['commit_size'],
+            drop_indexes=options['drop_indexes'],
+            progress=report_progress,
+        )
+
+        for error in result['errors']:
+            self.stderr.write(error)
+        self.stdout.write(self.style.SUCCESS(
+            f'Imported {result["rows"]} rows in {result["elapsed"]}s ({result["rows_per_second"]} rows/sec): '
+            f'{result["inserted"]} inserted, {result["duplicates"]} duplicates, {result["rejected"]} rejected'))
@@ -0,0 +1,31 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from transactions.jobs import next_queued_job, requeue_interrupted_jobs, run_import_job
+
+
+class Command(BaseCommand):
+    help = 'Import the queued transaction reports, for use with TRANSACTIONS_IMPORT_RUNNER = "worker"'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Exit once the queue is empty instead of polling')
+        parser.add_argument('--poll-interval', type=float, default=2.0,
+                            help='Seconds to wait before checking an empty queue again')
+        parser.add_argument('--requeue-running', action='store_true',
+                            help='First queue the jobs left running by a stopped process again. Only use it when no '
+                                 'other process is importing')
+
+    def handle(self, *args, **options):
+        if options['requeue_running']:
+            self.stdout.write(f'Queued {requeue_interrupted_jobs()} interrupted jobs again')
+        while True:
+            job_id = next_queued_job()
+            if job_id is None:
+                if options['once']:
+                    return
+                time.sleep(options['poll_interval'])
+                continue
+
+            self.stdout.write(f'Importing job {job_id}')
+            run_import_job(job_id, claimed=True)
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from transactions.rollups import rebuild_rollups
+
+
+class Command(BaseCommand):
+    help = 'Recompute the daily transaction rollups from scratch, e.g. after transactions were edited by hand'
+
+    def handle(self, *args, **options):
+        created = rebuild_rollups()
+        self.stdout.write(f'Rebuilt {created} daily rollups')
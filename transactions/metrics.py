@@ -0,0 +1,352 @@
+"""
+Per-request instrumentation of the transactions API, exposed at /api/metrics in the Prometheus text format.
+
+MetricsMiddleware records, per endpoint (URL route) and filter shape (the sorted names of the filters given), the
+number of SQL queries, the time spent in SQL, the rows returned, the time spent rendering the response, the
+response size and the total latency, each as a histogram. Streamed responses are measured until their last chunk
+was sent. Imports add to transactions_import_rows_total and transactions_import_seconds_total, whose rate is the
+import throughput, and set transactions_import_rows_per_second to the throughput of the last import.
+
+Statements slower than TRANSACTIONS_SLOW_QUERY_SECONDS are logged to the transactions.slow_queries logger with
+their SQL, parameters and the query string the filters were parsed from.
+
+The metrics are kept in memory per process. Behind several worker processes every scrape sees one of them, run a
+single process or aggregate per instance in Prometheus.
+"""
+import logging
+import math
+import threading
+import time
+from contextlib import ExitStack
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+from django.conf import settings
+from django.db import connections
+from django.db.models import QuerySet
+from django.http import HttpResponse
+
+from transactions.filters import FILTER_PARAMS
+
+slow_query_logger = logging.getLogger('transactions.slow_queries')
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+ROW_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000, 1000000)
+BYTE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000, 100000000)
+
+REQUEST_LABELS = ('endpoint', 'filters')
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def format_value(value) -> str:
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in values)
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(names, escaped)) + '}'
+
+
+class Metric:
+    """
+    A metric family with a fixed set of label names, one series per combination of label values
+    """
+
+    kind = None
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.series: Dict[Tuple, object] = {}
+
+    def expose(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        with self.lock:
+            series = sorted(self.series.items())
+        for label_values, value in series:
+            lines.extend(self.expose_series(label_values, value))
+        return lines
+
+    def expose_series(self, label_values: Tuple, value) -> List[str]:
+        return [f'{self.name}{format_labels(self.labels, label_values)} {format_value(value)}']
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, *label_values):
+        with self.lock:
+            self.series[label_values] = self.series.get(label_values, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, *label_values):
+        with self.lock:
+            self.series[label_values] = value
+
+
+class Histogram(Metric):
+    """
+    Cumulative bucket counts, sum and count of the observed values, as Prometheus histograms are exposed
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (), buckets: Sequence = ()):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets) + (math.inf,)
+
+    def observe(self, value, *label_values):
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = [[0] * len(self.buckets), 0, 0]
+            bucket_counts = series[0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    bucket_counts[index] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def expose_series(self, label_values, value):
+        bucket_counts, summed, count = value
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, bucket_counts):
+            cumulative += bucket_count
+            labels = format_labels(self.labels + ('le',), label_values + (format_value(float(bound)),))
+            lines.append(f'{self.name}_bucket{labels} {cumulative}')
+        labels = format_labels(self.labels, label_values)
+        lines.append(f'{self.name}_sum{labels} {format_value(float(summed))}')
+        lines.append(f'{self.name}_count{labels} {count}')
+        return lines
+
+
+REQUESTS = Counter('transactions_http_requests_total', 'Requests handled', REQUEST_LABELS + ('status',))
+REQUEST_SECONDS = Histogram('transactions_http_request_seconds', 'Total latency of a request, until the last '
+                            'byte of a streamed response', REQUEST_LABELS, LATENCY_BUCKETS)
+QUERY_COUNT = Histogram('transactions_db_queries_per_request', 'SQL statements executed per request',
+                        REQUEST_LABELS, QUERY_COUNT_BUCKETS)
+QUERY_SECONDS = Histogram('transactions_db_seconds_per_request', 'Time spent executing SQL per request',
+                          REQUEST_LABELS, LATENCY_BUCKETS)
+ROWS = Histogram('transactions_rows_per_request', 'Transactions, groups or buckets returned per request',
+                 REQUEST_LABELS, ROW_BUCKETS)
+SERIALIZE_SECONDS = Histogram('transactions_serialize_seconds', 'Time spent rendering the response body, '
+                              'excluding SQL', REQUEST_LABELS, LATENCY_BUCKETS)
+RESPONSE_BYTES = Histogram('transactions_response_bytes', 'Size of the response body', REQUEST_LABELS, BYTE_BUCKETS)
+SLOW_QUERIES = Counter('transactions_slow_queries_total', 'SQL statements slower than '
+                       'TRANSACTIONS_SLOW_QUERY_SECONDS', ('endpoint',))
+IMPORT_ROWS = Counter('transactions_import_rows_total', 'Report rows processed by imports', ('source',))
+IMPORT_INSERTED = Counter('transactions_import_inserted_total', 'Transactions inserted by imports', ('source',))
+IMPORT_SECONDS = Counter('transactions_import_seconds_total', 'Time spent importing', ('source',))
+IMPORT_THROUGHPUT = Gauge('transactions_import_rows_per_second', 'Throughput of the last import', ('source',))
+
+METRICS = (REQUESTS, REQUEST_SECONDS, QUERY_COUNT, QUERY_SECONDS, ROWS, SERIALIZE_SECONDS, RESPONSE_BYTES,
+           SLOW_QUERIES, IMPORT_ROWS, IMPORT_INSERTED, IMPORT_SECONDS, IMPORT_THROUGHPUT)
+
+
+def expose_metrics() -> str:
+    """
+    All metrics in the Prometheus text exposition format
+    """
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.expose())
+    return '\n'.join(lines) + '\n'
+
+
+def record_import(source: str, rows: int, inserted: int, seconds: float):
+    """
+    Add a finished import to the import metrics
+
+    params:
+    source(str): "api" for uploads, "bulk" for manage.py import_transactions
+    rows(int): Rows processed, including duplicates and rejected rows
+    inserted(int): Transactions inserted
+    seconds(float): Duration of the import
+    """
+    IMPORT_ROWS.inc(rows, source)
+    IMPORT_INSERTED.inc(inserted, source)
+    IMPORT_SECONDS.inc(seconds, source)
+    if seconds > 0:
+        IMPORT_THROUGHPUT.set(round(rows / seconds, 1), source)
+
+
+def filter_shape(query_dict) -> str:
+    """
+    Sorted names of the filters in a query string, e.g. "skus+start+type", or "none"
+    """
+    names = sorted(name for name in FILTER_PARAMS if query_dict.get(name))
+    return '+'.join(names) or 'none'
+
+
+def response_rows(data) -> int:
+    """
+    Number of rows in the data of a DRF response: transactions, stats groups or timeseries buckets
+    """
+    if isinstance(data, dict):
+        for key in ('results', 'groups', 'buckets'):
+            if isinstance(data.get(key), list):
+                return len(data[key])
+        return 1
+    if isinstance(data, (list, QuerySet)):
+        return len(data)
+    return 0
+
+
+class RequestMetrics:
+    """
+    Measurements of a single request, collected by an execute_wrapper on every database connection
+    """
+
+    def __init__(self, request):
+        self.request = request
+        self.filters = filter_shape(request.GET)
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.rows = 0
+        self.render_started = None
+        self.serialize_seconds = 0.0
+        self.slow_query_seconds = getattr(settings, 'TRANSACTIONS_SLOW_QUERY_SECONDS', None)
+
+    @property
+    def endpoint(self) -> str:
+        """
+        Route of the URL pattern the request matched, known once the URL was resolved
+        """
+        match = getattr(self.request, 'resolver_match', None)
+        return '/' + match.route if match is not None else 'unmatched'
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - started
+            self.queries += 1
+            self.query_seconds += elapsed
+            if self.slow_query_seconds is not None and elapsed >= self.slow_query_seconds:
+                self.log_slow_query(sql, params, many, elapsed)
+
+    def log_slow_query(self, sql: str, params, many: bool, elapsed: float):
+        SLOW_QUERIES.inc(1, self.endpoint)
+        slow_query_logger.warning(
+            'slow query (%.3fs) on %s with filters %s: %s; params %s', elapsed, self.endpoint,
+            {name: self.request.GET.getlist(name) for name in self.request.GET}, sql,
+            '(executemany)' if many else params)
+
+    def instrument(self) -> ExitStack:
+        """
+        Context manager routing every statement of this thread through self, on all configured databases
+        """
+        stack = ExitStack()
+        for alias in connections:
+            stack.enter_context(connections[alias].execute_wrapper(self))
+        return stack
+
+    def record(self, status_code: int, response_bytes: int):
+        labels = (self.endpoint, self.filters)
+        REQUESTS.inc(1, *labels, str(status_code))
+        REQUEST_SECONDS.observe(time.perf_counter() - self.started, *labels)
+        QUERY_COUNT.observe(self.queries, *labels)
+        QUERY_SECONDS.observe(self.query_seconds, *labels)
+        ROWS.observe(self.rows, *labels)
+        SERIALIZE_SECONDS.observe(self.serialize_seconds, *labels)
+        RESPONSE_BYTES.observe(response_bytes, *labels)
+
+
+def count_rows(request, rows: Iterable) -> Iterator:
+    """
+    Pass the rows of a streamed response through, counting them in the request's metrics
+    """
+    request_metrics: Optional[RequestMetrics] = getattr(request, 'transactions_metrics', None)
+    for row in rows:
+        if request_metrics is not None:
+            request_metrics.rows += 1
+        yield row
+
+
+class MetricsMiddleware:
+    """
+    Records the request metrics of every /api/ request. Should be the first middleware so its latency covers the
+    others
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not getattr(settings, 'TRANSACTIONS_METRICS_ENABLED', True) or not request.path.startswith('/api/'):
+            return self.get_response(request)
+
+        request_metrics = RequestMetrics(request)
+        request.transactions_metrics = request_metrics
+        with request_metrics.instrument():
+            response = self.get_response(request)
+
+        if response.streaming:
+            response.streaming_content = self.measure_stream(request_metrics, response, response.streaming_content)
+            return response
+
+        data = getattr(response, 'data', None)
+        if data is not None:
+            request_metrics.rows = max(request_metrics.rows, response_rows(data))
+        request_metrics.record(response.status_code, len(response.content))
+        return response
+
+    def process_template_response(self, request, response):
+        # DRF responses are rendered after the view returns, time it from here to the post render callback
+        request_metrics = getattr(request, 'transactions_metrics', None)
+        if request_metrics is not None:
+            render_queries = request_metrics.query_seconds
+            render_started = time.perf_counter()
+
+            def rendered(response):
+                request_metrics.serialize_seconds += (time.perf_counter() - render_started
+                                                      - (request_metrics.query_seconds - render_queries))
+
+            response.add_post_render_callback(rendered)
+        return response
+
+    @staticmethod
+    def measure_stream(request_metrics: RequestMetrics, response, content: Iterable[bytes]) -> Iterator[bytes]:
+        """
+        Iterate the streamed body with the SQL instrumentation in place, then record the request. Time spent
+        producing the chunks other than in SQL counts as serialization. Each chunk is instrumented on its own,
+        under ASGI consecutive chunks may be produced by different threads (see transactions.asgi)
+        """
+        response_bytes = 0
+        producing = 0.0
+        query_seconds = request_metrics.query_seconds
+        content = iter(content)
+        while True:
+            started = time.perf_counter()
+            with request_metrics.instrument():
+                chunk = next(content, None)
+            producing += time.perf_counter() - started
+            if chunk is None:
+                break
+            response_bytes += len(chunk)
+            yield chunk
+        request_metrics.serialize_seconds = max(producing - (request_metrics.query_seconds - query_seconds), 0.0)
+        request_metrics.record(response.status_code, response_bytes)
+
+
+def metrics_view(request):
+    """
+    The metrics of this process in the Prometheus text format
+    """
+    return HttpResponse(expose_metrics(), content_type=PROMETHEUS_CONTENT_TYPE)
@@ -0,0 +1,37 @@
+# Generated by Django 3.2.25 on 2026-10-18 17:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transactions', '0002_alter_fbatransaction_date_time'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='fbatransaction',
+            index=models.Index(fields=['date_time'], name='fba_date_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='fbatransaction',
+            index=models.Index(fields=['sku', 'date_time'], name='fba_sku_date_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='fbatransaction',
+            index=models.Index(fields=['order_type', 'date_time'], name='fba_type_date_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='fbatransaction',
+            index=models.Index(fields=['order_state', 'order_city', 'date_time'], name='fba_state_city_date_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='fbatransaction',
+            index=models.Index(fields=['order_city', 'date_time'], name='fba_city_date_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='fbatransaction',
+            index=models.Index(fields=['order_postal', 'date_time'], name='fba_postal_date_time_idx'),
+        ),
+    ]
@@ -0,0 +1,73 @@
+# Generated by Django 3.2.25 on 2026-10-18 17:50
+
+from django.db import migrations, models
+from django.db.models import Count, DecimalField, ExpressionWrapper, F, Max, Min, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+
+def backfill_rollups(apps, schema_editor):
+    """
+    Roll up the transactions stored before the rollups existed, with one grouped query
+    """
+    FBATransaction = apps.get_model('transactions', 'FBATransaction')
+    FBATransactionDailyRollup = apps.get_model('transactions', 'FBATransactionDailyRollup')
+
+    grouped = (
+        FBATransaction.objects
+        .annotate(day=TruncDate('date_time', tzinfo=timezone.get_default_timezone()))
+        .values('day', 'sku', 'order_type', 'order_state')
+        .annotate(
+            row_count=Count('id'),
+            total_sum=Sum('total'),
+            total_sum_squares=Sum(ExpressionWrapper(F('total') * F('total'),
+                                                    output_field=DecimalField(decimal_places=4, max_digits=32))),
+            total_min=Min('total'),
+            total_max=Max('total'),
+        )
+        .order_by()
+    )
+    FBATransactionDailyRollup.objects.bulk_create((
+        FBATransactionDailyRollup(day=row['day'], sku=row['sku'], order_type=row['order_type'],
+                                  order_state=row['order_state'], count=row['row_count'], total_sum=row['total_sum'],
+                                  total_sum_squares=row['total_sum_squares'], total_min=row['total_min'],
+                                  total_max=row['total_max'])
+        for row in grouped.iterator()
+    ), batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transactions', '0003_fbatransaction_filter_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FBATransactionDailyRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('sku', models.CharField(blank=True, max_length=32, null=True)),
+                ('order_type', models.CharField(blank=True, max_length=32, null=True)),
+                ('order_state', models.CharField(blank=True, max_length=32, null=True)),
+                ('count', models.IntegerField(default=0)),
+                ('total_sum', models.DecimalField(decimal_places=2, default=0, max_digits=20)),
+                ('total_sum_squares', models.DecimalField(decimal_places=4, default=0, max_digits=32)),
+                ('total_min', models.DecimalField(decimal_places=2, max_digits=16, null=True)),
+                ('total_max', models.DecimalField(decimal_places=2, max_digits=16, null=True)),
+            ],
+            options={
+                'db_table': 'fba_transaction_daily_rollups',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='fbatransactiondailyrollup',
+            index=models.Index(fields=['sku', 'day'], name='fba_rollup_sku_day_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='fbatransactiondailyrollup',
+            constraint=models.UniqueConstraint(fields=('day', 'sku', 'order_type', 'order_state'), name='fba_rollup_key'),
+        ),
+        migrations.RunPython(backfill_rollups, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,72 @@
+# Generated by Django 3.2.25 on 2026-10-18 17:53
+
+import datetime
+import hashlib
+from decimal import Decimal
+
+from django.db import migrations, models
+
+
+def transaction_fingerprint(date_time, order_type, order_id, sku, quantity, total, occurrence=0):
+    """
+    transactions.ingest.transaction_fingerprint as of this migration, frozen here so the backfill doesn't depend on
+    the app code
+    """
+    parts = [
+        date_time.astimezone(datetime.timezone.utc).isoformat(),
+        order_type or '',
+        order_id or '',
+        sku or '',
+        '' if quantity is None else str(quantity),
+        str(Decimal(total).quantize(Decimal('0.01'))),
+        str(occurrence),
+    ]
+    return hashlib.sha1('\x1f'.join(parts).encode('utf-8')).hexdigest()
+
+
+def backfill_fingerprints(apps, schema_editor):
+    """
+    Fingerprint the transactions imported before fingerprints existed. Rows are walked in timestamp order and
+    identical rows numbered the same way the import does, so nothing already stored is treated as a duplicate.
+    0013_correct_legacy_pdt_timestamps computes them again once it has corrected the PDT timestamps
+    """
+    FBATransaction = apps.get_model('transactions', 'FBATransaction')
+
+    current_date_time = None
+    occurrences = {}
+    batch = []
+    for entry in FBATransaction.objects.order_by('date_time', 'id').iterator(chunk_size=2000):
+        if entry.date_time != current_date_time:
+            current_date_time = entry.date_time
+            occurrences = {}
+        content = (entry.order_type, entry.order_id, entry.sku, entry.quantity, entry.total)
+        occurrence = occurrences.get(content, 0)
+        occurrences[content] = occurrence + 1
+
+        entry.fingerprint = transaction_fingerprint(entry.date_time, *content, occurrence=occurrence)
+        batch.append(entry)
+        if len(batch) >= 1000:
+            FBATransaction.objects.bulk_update(batch, ['fingerprint'])
+            batch = []
+    FBATransaction.objects.bulk_update(batch, ['fingerprint'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transactions', '0004_fbatransactiondailyrollup'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='fbatransaction',
+            name='fingerprint',
+            field=models.CharField(editable=False, max_length=40, null=True),
+        ),
+        migrations.RunPython(backfill_fingerprints, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='fbatransaction',
+            name='fingerprint',
+            field=models.CharField(editable=False, max_length=40, null=True, unique=True),
+        ),
+    ]
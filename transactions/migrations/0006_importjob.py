@@ -0,0 +1,38 @@
+# Generated by Django 3.2.25 on 2026-10-18 17:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transactions', '0005_fbatransaction_fingerprint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('queued', 'queued'), ('running', 'running'), ('succeeded', 'succeeded'), ('failed', 'failed')], default='queued', max_length=16)),
+                ('file', models.FileField(max_length=255, upload_to='imports/')),
+                ('file_format', models.CharField(choices=[('csv', 'csv'), ('json', 'json')], default='csv', max_length=8)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('started_at', models.DateTimeField(null=True)),
+                ('finished_at', models.DateTimeField(null=True)),
+                ('rows_processed', models.IntegerField(default=0)),
+                ('inserted', models.IntegerField(default=0)),
+                ('duplicates', models.IntegerField(default=0)),
+                ('rejected', models.IntegerField(default=0)),
+                ('errors', models.JSONField(default=list)),
+                ('error', models.TextField(blank=True, null=True)),
+            ],
+            options={
+                'db_table': 'fba_import_jobs',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='importjob',
+            index=models.Index(fields=['status', 'id'], name='fba_import_job_status_idx'),
+        ),
+    ]
@@ -0,0 +1,140 @@
+# Generated by Django 3.2.25 on 2026-10-18 18:10
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def backfill_dimensions(apps, schema_editor):
+    """
+    Move the product and location columns of the existing transactions into the dimension tables: one row per
+    distinct (sku, description) and (city, state, postal), and point every transaction at its rows
+    """
+    FBATransaction = apps.get_model('transactions', 'FBATransaction')
+    Product = apps.get_model('transactions', 'Product')
+    Location = apps.get_model('transactions', 'Location')
+
+    product_keys = FBATransaction.objects.values_list('sku', 'description').distinct()
+    Product.objects.bulk_create([Product(sku=sku, description=description) for sku, description in product_keys
+                                 if sku is not None or description is not None], batch_size=1000)
+    products = {(product.sku, product.description): product.id for product in Product.objects.all()}
+
+    location_keys = FBATransaction.objects.values_list('order_city', 'order_state', 'order_postal').distinct()
+    Location.objects.bulk_create([Location(city=city, state=state, postal=postal)
+                                  for city, state, postal in location_keys
+                                  if city is not None or state is not None or postal is not None], batch_size=1000)
+    locations = {(location.city, location.state, location.postal): location.id for location in Location.objects.all()}
+
+    batch = []
+    rows = FBATransaction.objects.order_by('id').values_list(
+        'id', 'sku', 'description', 'order_city', 'order_state', 'order_postal').iterator(chunk_size=2000)
+    for row_id, sku, description, city, state, postal in rows:
+        batch.append(FBATransaction(id=row_id, product_id=products.get((sku, description)),
+                                    location_id=locations.get((city, state, postal))))
+        if len(batch) >= 1000:
+            FBATransaction.objects.bulk_update(batch, ['product', 'location'])
+            batch = []
+    FBATransaction.objects.bulk_update(batch, ['product', 'location'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transactions', '0006_importjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Location',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('city', models.CharField(blank=True, max_length=64, null=True)),
+                ('state', models.CharField(blank=True, max_length=32, null=True)),
+                ('postal', models.CharField(blank=True, max_length=16, null=True)),
+            ],
+            options={
+                'db_table': 'fba_locations',
+            },
+        ),
+        migrations.CreateModel(
+            name='Product',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sku', models.CharField(blank=True, max_length=32, null=True)),
+                ('description', models.TextField(blank=True, null=True)),
+            ],
+            options={
+                'db_table': 'fba_products',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='product',
+            constraint=models.UniqueConstraint(fields=('sku', 'description'), name='fba_product_key'),
+        ),
+        migrations.AddIndex(
+            model_name='location',
+            index=models.Index(fields=['state'], name='fba_location_state_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='location',
+            index=models.Index(fields=['postal'], name='fba_location_postal_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='location',
+            constraint=models.UniqueConstraint(fields=('city', 'state', 'postal'), name='fba_location_key'),
+        ),
+        migrations.AddField(
+            model_name='fbatransaction',
+            name='location',
+            field=models.ForeignKey(blank=True, db_index=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='transactions', to='transactions.location'),
+        ),
+        migrations.AddField(
+            model_name='fbatransaction',
+            name='product',
+            field=models.ForeignKey(blank=True, db_index=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='transactions', to='transactions.product'),
+        ),
+        migrations.RunPython(backfill_dimensions, migrations.RunPython.noop),
+        migrations.RemoveIndex(
+            model_name='fbatransaction',
+            name='fba_sku_date_time_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='fbatransaction',
+            name='fba_state_city_date_time_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='fbatransaction',
+            name='fba_city_date_time_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='fbatransaction',
+            name='fba_postal_date_time_idx',
+        ),
+        migrations.RemoveField(
+            model_name='fbatransaction',
+            name='description',
+        ),
+        migrations.RemoveField(
+            model_name='fbatransaction',
+            name='order_city',
+        ),
+        migrations.RemoveField(
+            model_name='fbatransaction',
+            name='order_postal',
+        ),
+        migrations.RemoveField(
+            model_name='fbatransaction',
+            name='order_state',
+        ),
+        migrations.RemoveField(
+            model_name='fbatransaction',
+            name='sku',
+        ),
+        migrations.AddIndex(
+            model_name='fbatransaction',
+            index=models.Index(fields=['product', 'date_time'], name='fba_product_date_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='fbatransaction',
+            index=models.Index(fields=['location', 'date_time'], name='fba_location_date_time_idx'),
+        ),
+    ]
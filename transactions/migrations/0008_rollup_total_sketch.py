@@ -0,0 +1,68 @@
+# Generated by Django 3.2.25 on 2026-10-18 18:40
+
+import math
+
+from django.db import migrations, models
+from django.utils import timezone
+
+# The sketch encoding of transactions.sketches as of this migration (relative accuracy 0.005), frozen here so that
+# later changes to the sketches don't change what this migration writes
+GAMMA = (1 + 0.005) / (1 - 0.005)
+LOG_GAMMA = math.log(GAMMA)
+ZERO_THRESHOLD = 1e-9
+
+
+def add_to_sketch(sketch, value):
+    """
+    Count a value in a sketch in its stored JSON form, {'zero': int, 'positive': {index: count}, 'negative': ...}
+    """
+    value = float(value)
+    if abs(value) <= ZERO_THRESHOLD:
+        sketch['zero'] += 1
+        return
+    buckets = sketch['positive'] if value > 0 else sketch['negative']
+    index = str(math.ceil(math.log(abs(value)) / LOG_GAMMA))
+    buckets[index] = buckets.get(index, 0) + 1
+
+
+def backfill_sketches(apps, schema_editor):
+    """
+    Build the quantile sketch of every existing rollup row from the totals of its transactions
+    """
+    FBATransaction = apps.get_model('transactions', 'FBATransaction')
+    FBATransactionDailyRollup = apps.get_model('transactions', 'FBATransactionDailyRollup')
+
+    sketches = {}
+    rows = FBATransaction.objects.values_list(
+        'date_time', 'product__sku', 'order_type', 'location__state', 'total').iterator(chunk_size=10000)
+    for date_time, sku, order_type, order_state, total in rows:
+        key = timezone.localdate(date_time), sku, order_type, order_state
+        add_to_sketch(sketches.setdefault(key, {'zero': 0, 'positive': {}, 'negative': {}}), total)
+
+    batch = []
+    for rollup in FBATransactionDailyRollup.objects.all().iterator(chunk_size=2000):
+        sketch = sketches.get((rollup.day, rollup.sku, rollup.order_type, rollup.order_state))
+        if sketch is None:
+            continue
+        rollup.total_sketch = sketch
+        batch.append(rollup)
+        if len(batch) >= 1000:
+            FBATransactionDailyRollup.objects.bulk_update(batch, ['total_sketch'])
+            batch = []
+    FBATransactionDailyRollup.objects.bulk_update(batch, ['total_sketch'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transactions', '0007_dimension_tables'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='fbatransactiondailyrollup',
+            name='total_sketch',
+            field=models.JSONField(default=dict),
+        ),
+        migrations.RunPython(backfill_sketches, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,88 @@
+# Generated by Django 3.2.25 on 2026-10-18 18:37
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+HISTORY_COLUMNS = 'id, date_time, type, order_id, product_id, quantity, location_id, total, fingerprint'
+
+CREATE_HISTORY_VIEW = (
+    f'CREATE VIEW fba_transactions_history AS '
+    f'SELECT {HISTORY_COLUMNS} FROM fba_transactions '
+    f'UNION ALL SELECT {HISTORY_COLUMNS} FROM fba_transactions_archive'
+)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transactions', '0008_rollup_total_sketch'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TransactionHistory',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date_time', models.DateTimeField(db_column='date_time')),
+                ('order_type', models.CharField(choices=[('Adjustment', 'Adjustment'), ('FBA Customer Return Fee', 'FBA Customer Return Fee'), ('FBA Inventory Fee', 'FBA Inventory Fee'), ('Order', 'Order'), ('Order_Retrocharge', 'Order_Retrocharge'), ('Refund', 'Refund'), ('Transfer', 'Transfer')], db_column='type', max_length=32, null=True)),
+                ('order_id', models.CharField(max_length=32, null=True)),
+                ('quantity', models.IntegerField(null=True)),
+                ('total', models.DecimalField(decimal_places=2, max_digits=16)),
+                ('fingerprint', models.CharField(max_length=40, null=True)),
+            ],
+            options={
+                'db_table': 'fba_transactions_history',
+                'managed': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='ArchivedMonth',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField(unique=True)),
+                ('count', models.IntegerField(default=0)),
+                ('total_sum', models.DecimalField(decimal_places=2, default=0, max_digits=20)),
+                ('total_min', models.DecimalField(decimal_places=2, max_digits=16, null=True)),
+                ('total_max', models.DecimalField(decimal_places=2, max_digits=16, null=True)),
+                ('archived_at', models.DateTimeField()),
+                ('dropped_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'db_table': 'fba_archived_months',
+            },
+        ),
+        migrations.CreateModel(
+            name='ArchivedTransaction',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date_time', models.DateTimeField(db_column='date_time')),
+                ('order_type', models.CharField(blank=True, choices=[('Adjustment', 'Adjustment'), ('FBA Customer Return Fee', 'FBA Customer Return Fee'), ('FBA Inventory Fee', 'FBA Inventory Fee'), ('Order', 'Order'), ('Order_Retrocharge', 'Order_Retrocharge'), ('Refund', 'Refund'), ('Transfer', 'Transfer')], db_column='type', max_length=32, null=True)),
+                ('order_id', models.CharField(blank=True, max_length=32, null=True)),
+                ('quantity', models.IntegerField(null=True)),
+                ('total', models.DecimalField(decimal_places=2, max_digits=16)),
+                ('fingerprint', models.CharField(editable=False, max_length=40, null=True, unique=True)),
+                ('location', models.ForeignKey(blank=True, db_index=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='archived_transactions', to='transactions.location')),
+                ('product', models.ForeignKey(blank=True, db_index=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='archived_transactions', to='transactions.product')),
+            ],
+            options={
+                'db_table': 'fba_transactions_archive',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='archivedtransaction',
+            index=models.Index(fields=['date_time'], name='fba_archive_date_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='archivedtransaction',
+            index=models.Index(fields=['product', 'date_time'], name='fba_archive_product_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='archivedtransaction',
+            index=models.Index(fields=['order_type', 'date_time'], name='fba_archive_type_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='archivedtransaction',
+            index=models.Index(fields=['location', 'date_time'], name='fba_archive_location_idx'),
+        ),
+        migrations.RunSQL(CREATE_HISTORY_VIEW, 'DROP VIEW fba_transactions_history'),
+    ]
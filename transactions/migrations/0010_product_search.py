@@ -0,0 +1,77 @@
+# Generated by Django 3.2.25 on 2026-10-18 18:43
+
+from django.db import migrations, models
+
+# External content FTS5 table over fba_products: the index stores only the tokens, the text stays in fba_products
+CREATE_SEARCH_INDEX = [
+    """
+    CREATE VIRTUAL TABLE fba_products_fts USING fts5(
+        sku, description, content='fba_products', content_rowid='id', tokenize='unicode61 remove_diacritics 2',
+        prefix='2 3'
+    )
+    """,
+    """
+    CREATE TRIGGER fba_products_fts_insert AFTER INSERT ON fba_products BEGIN
+        INSERT INTO fba_products_fts (rowid, sku, description) VALUES (new.id, new.sku, new.description);
+    END
+    """,
+    """
+    CREATE TRIGGER fba_products_fts_delete AFTER DELETE ON fba_products BEGIN
+        INSERT INTO fba_products_fts (fba_products_fts, rowid, sku, description)
+        VALUES ('delete', old.id, old.sku, old.description);
+    END
+    """,
+    """
+    CREATE TRIGGER fba_products_fts_update AFTER UPDATE ON fba_products BEGIN
+        INSERT INTO fba_products_fts (fba_products_fts, rowid, sku, description)
+        VALUES ('delete', old.id, old.sku, old.description);
+        INSERT INTO fba_products_fts (rowid, sku, description) VALUES (new.id, new.sku, new.description);
+    END
+    """,
+    # index the existing products
+    "INSERT INTO fba_products_fts (fba_products_fts) VALUES ('rebuild')",
+]
+
+DROP_SEARCH_INDEX = [
+    'DROP TRIGGER fba_products_fts_insert',
+    'DROP TRIGGER fba_products_fts_delete',
+    'DROP TRIGGER fba_products_fts_update',
+    'DROP TABLE fba_products_fts',
+]
+
+
+def create_search_index(apps, schema_editor):
+    # only SQLite has FTS5, transactions.search falls back to icontains lookups elsewhere
+    if schema_editor.connection.vendor == 'sqlite':
+        for statement in CREATE_SEARCH_INDEX:
+            schema_editor.execute(statement)
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        for statement in DROP_SEARCH_INDEX:
+            schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transactions', '0009_month_archive'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductSearch',
+            fields=[
+                ('id', models.IntegerField(db_column='rowid', primary_key=True, serialize=False)),
+                ('sku', models.TextField(null=True)),
+                ('description', models.TextField(null=True)),
+                ('rank', models.FloatField(null=True)),
+            ],
+            options={
+                'db_table': 'fba_products_fts',
+                'managed': False,
+            },
+        ),
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
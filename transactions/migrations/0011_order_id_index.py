@@ -0,0 +1,21 @@
+# Generated by Django 3.2.25 on 2026-10-18 19:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transactions', '0010_product_search'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='archivedtransaction',
+            index=models.Index(fields=['order_id', 'order_type', 'total'], name='fba_archive_order_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='fbatransaction',
+            index=models.Index(fields=['order_id', 'order_type', 'total'], name='fba_order_id_idx'),
+        ),
+    ]
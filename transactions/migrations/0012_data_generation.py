@@ -0,0 +1,34 @@
+# Generated by Django 3.2.25 on 2026-10-18 20:20
+
+import time
+
+from django.db import migrations, models
+
+
+def start_generation(apps, schema_editor):
+    """
+    Start the shared generation from the current time, above any counter a process kept in its cache until now
+    """
+    DataGeneration = apps.get_model('transactions', 'DataGeneration')
+    DataGeneration.objects.create(id=1, generation=time.time_ns())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transactions', '0011_order_id_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DataGeneration',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('generation', models.BigIntegerField()),
+            ],
+            options={
+                'db_table': 'fba_data_generation',
+            },
+        ),
+        migrations.RunPython(start_generation, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,201 @@
+# Generated by Django 3.2.25 on 2026-10-18 21:05
+
+import datetime
+import hashlib
+import logging
+import math
+import zoneinfo
+from decimal import Decimal
+
+from django.db import migrations
+from django.db.migrations.recorder import MigrationRecorder
+from django.db.models import Count, DecimalField, ExpressionWrapper, F, Max, Min, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+# Migration modules are loaded when migrate starts, so migrations applied after this were applied by the same run
+LOADED_AT = datetime.datetime.now(datetime.timezone.utc)
+
+# The original parser read PDT as -0900 instead of -0700, so it stored PDT timestamps 2 hours late
+LEGACY_PDT_ERROR = datetime.timedelta(hours=2)
+PACIFIC = zoneinfo.ZoneInfo('America/Los_Angeles')
+
+# The sketch encoding of transactions.sketches as of this migration (relative accuracy 0.005)
+GAMMA = (1 + 0.005) / (1 - 0.005)
+LOG_GAMMA = math.log(GAMMA)
+ZERO_THRESHOLD = 1e-9
+
+# The functions below are copies of transactions.dateparse.legacy_pdt_timestamps, transactions.ingest
+# .transaction_fingerprint and the sketches as of this migration, so later changes to them don't change what it does
+
+
+def is_pacific_dst(instant):
+    return bool(instant.astimezone(PACIFIC).dst())
+
+
+def legacy_pdt_timestamps(rows):
+    """
+    Ids of the rows stored from a PDT timestamp, and of the ambiguous rows left as stored, given (id, date_time)
+    in id order. S comes from PDT if S - 2h is in Pacific daylight time and from PST if S isn't. Both hold for the
+    2 hours after the switch back to PST, such runs are split where time goes backwards: PDT before, PST after
+    """
+    pdt_ids = []
+    unresolved_ids = []
+    ambiguous = []
+
+    def resolve():
+        times = [stored for _, stored in ambiguous]
+        split = next((i for i in range(1, len(times)) if times[i] < times[i - 1]), None)
+        if split is None:
+            unresolved_ids.extend(row_id for row_id, _ in ambiguous)
+        else:
+            pdt_ids.extend(row_id for row_id, _ in ambiguous[:split])
+        ambiguous.clear()
+
+    for row_id, stored in rows:
+        from_pdt = is_pacific_dst(stored - LEGACY_PDT_ERROR)
+        from_pst = not is_pacific_dst(stored)
+        if from_pdt and from_pst:
+            ambiguous.append((row_id, stored))
+            continue
+        if ambiguous:
+            resolve()
+        if from_pdt:
+            pdt_ids.append(row_id)
+    if ambiguous:
+        resolve()
+    return pdt_ids, unresolved_ids
+
+
+def transaction_fingerprint(date_time, order_type, order_id, sku, quantity, total, occurrence=0):
+    parts = [
+        date_time.astimezone(datetime.timezone.utc).isoformat(),
+        order_type or '',
+        order_id or '',
+        sku or '',
+        '' if quantity is None else str(quantity),
+        str(Decimal(total).quantize(Decimal('0.01'))),
+        str(occurrence),
+    ]
+    return hashlib.sha1('\x1f'.join(parts).encode('utf-8')).hexdigest()
+
+
+def add_to_sketch(sketch, value):
+    value = float(value)
+    if abs(value) <= ZERO_THRESHOLD:
+        sketch['zero'] += 1
+        return
+    buckets = sketch['positive'] if value > 0 else sketch['negative']
+    index = str(math.ceil(math.log(abs(value)) / LOG_GAMMA))
+    buckets[index] = buckets.get(index, 0) + 1
+
+
+def refingerprint(FBATransaction):
+    """
+    Fingerprint every transaction again from its corrected timestamp, numbering identical rows like the import
+    """
+    # cleared first, a row may take the fingerprint another one had until now
+    FBATransaction.objects.update(fingerprint=None)
+    current_date_time = None
+    occurrences = {}
+    batch = []
+    rows = FBATransaction.objects.select_related('product').order_by('date_time', 'id').iterator(chunk_size=2000)
+    for entry in rows:
+        if entry.date_time != current_date_time:
+            current_date_time = entry.date_time
+            occurrences = {}
+        sku = entry.product.sku if entry.product else None
+        content = (entry.order_type, entry.order_id, sku, entry.quantity, entry.total)
+        occurrence = occurrences.get(content, 0)
+        occurrences[content] = occurrence + 1
+
+        entry.fingerprint = transaction_fingerprint(entry.date_time, *content, occurrence=occurrence)
+        batch.append(entry)
+        if len(batch) >= 1000:
+            FBATransaction.objects.bulk_update(batch, ['fingerprint'])
+            batch = []
+    FBATransaction.objects.bulk_update(batch, ['fingerprint'])
+
+
+def rebuild_rollups(FBATransaction, FBATransactionDailyRollup):
+    """
+    Roll up the transactions again on their corrected days, with their sketches
+    """
+    local_tz = timezone.get_default_timezone()
+    sketches = {}
+    rows = FBATransaction.objects.values_list(
+        'date_time', 'product__sku', 'order_type', 'location__state', 'total').iterator(chunk_size=10000)
+    for date_time, sku, order_type, order_state, total in rows:
+        key = timezone.localdate(date_time, local_tz), sku, order_type, order_state
+        add_to_sketch(sketches.setdefault(key, {'zero': 0, 'positive': {}, 'negative': {}}), total)
+
+    grouped = (
+        FBATransaction.objects
+        .annotate(day=TruncDate('date_time', tzinfo=local_tz))
+        .values('day', 'product__sku', 'order_type', 'location__state')
+        .annotate(
+            row_count=Count('id'),
+            total_sum=Sum('total'),
+            total_sum_squares=Sum(ExpressionWrapper(F('total') * F('total'),
+                                                    output_field=DecimalField(decimal_places=4, max_digits=32))),
+            total_min=Min('total'),
+            total_max=Max('total'),
+        )
+        .order_by()
+    )
+    FBATransactionDailyRollup.objects.all().delete()
+    FBATransactionDailyRollup.objects.bulk_create((
+        FBATransactionDailyRollup(
+            day=row['day'], sku=row['product__sku'], order_type=row['order_type'],
+            order_state=row['location__state'], count=row['row_count'], total_sum=row['total_sum'],
+            total_sum_squares=row['total_sum_squares'], total_min=row['total_min'], total_max=row['total_max'],
+            total_sketch=sketches[row['day'], row['product__sku'], row['order_type'], row['location__state']])
+        for row in grouped.iterator()
+    ), batch_size=1000)
+
+
+def correct_legacy_pdt_timestamps(apps, schema_editor):
+    """
+    Move the PDT timestamps stored by the original parser 2 hours earlier, then compute the fingerprints and the
+    daily rollups derived from them again. Only done when this run of migrate upgrades the database from the
+    original schema: once 0003 was applied before, rows stored since by the current parser can't be told apart
+    """
+    FBATransaction = apps.get_model('transactions', 'FBATransaction')
+    FBATransactionDailyRollup = apps.get_model('transactions', 'FBATransactionDailyRollup')
+    if not FBATransaction.objects.exists():
+        return
+
+    applied = (MigrationRecorder(schema_editor.connection).migration_qs
+               .filter(app='transactions', name='0003_fbatransaction_filter_indexes')
+               .values_list('applied', flat=True).first())
+    if applied is None or applied < LOADED_AT:
+        logger.warning('the database was migrated past the original schema by an earlier run, its PDT timestamps '
+                       'were left as stored')
+        return
+
+    rows = FBATransaction.objects.order_by('id').values_list('id', 'date_time').iterator(chunk_size=2000)
+    pdt_ids, unresolved_ids = legacy_pdt_timestamps(rows)
+    if unresolved_ids:
+        logger.warning('could not tell whether %d transactions stored around the switch back to PST were PDT or '
+                       'PST, they were left as stored: ids %s', len(unresolved_ids), unresolved_ids)
+    if not pdt_ids:
+        return
+
+    for start in range(0, len(pdt_ids), 500):
+        FBATransaction.objects.filter(id__in=pdt_ids[start:start + 500]).update(
+            date_time=F('date_time') - LEGACY_PDT_ERROR)
+    refingerprint(FBATransaction)
+    rebuild_rollups(FBATransaction, FBATransactionDailyRollup)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transactions', '0012_data_generation'),
+    ]
+
+    operations = [
+        migrations.RunPython(correct_legacy_pdt_timestamps, migrations.RunPython.noop),
+    ]
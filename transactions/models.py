@@ -1,16 +1,160 @@
-from django.db import models
+import copy
+
+from django.db import models, router, transaction
 
 
 # Create your models here.
 # https://docs.djangoproject.com/en/3.1/topics/db/models/
 # After writing model definition, run "./manage.py makemigrations" and then "./manage.py migrate"
+class Product(models.Model):
+    """
+    A distinct (SKU, description) pair of the report. Transactions reference it by id instead of repeating the text
+    """
+
+    class Meta:
+        db_table = "fba_products"
+        constraints = [
+            models.UniqueConstraint(fields=['sku', 'description'], name='fba_product_key'),
+        ]
+
+    sku = models.CharField(max_length=32, blank=True, null=True)
+    description = models.TextField(blank=True, null=True)
+
+    def __str__(self):
+        return self.sku or self.description or ''
+
+
+class ProductSearch(models.Model):
+    """
+    SQLite FTS5 index of the SKU and description of every product (fba_products_fts), kept in sync with
+    fba_products by triggers, see transactions.search. rank is the bm25 rank of a MATCH, lower is better
+    """
+
+    class Meta:
+        db_table = "fba_products_fts"
+        managed = False
+
+    id = models.IntegerField(primary_key=True, db_column='rowid')
+    sku = models.TextField(null=True)
+    description = models.TextField(null=True)
+    rank = models.FloatField(null=True)
+
+
+class Location(models.Model):
+    """
+    A distinct (city, state, postal code) a transaction shipped to, referenced by id from the transactions
+    """
+
+    class Meta:
+        db_table = "fba_locations"
+        constraints = [
+            models.UniqueConstraint(fields=['city', 'state', 'postal'], name='fba_location_key'),
+        ]
+        indexes = [
+            models.Index(fields=['state'], name='fba_location_state_idx'),
+            models.Index(fields=['postal'], name='fba_location_postal_idx'),
+        ]
+
+    city = models.CharField(max_length=64, blank=True, null=True)
+    state = models.CharField(max_length=32, blank=True, null=True)
+    postal = models.CharField(max_length=16, blank=True, null=True)
+
+    def __str__(self):
+        return ', '.join(value for value in (self.city, self.state, self.postal) if value)
+
+
+# Attributes of the dimension tables each FBATransaction relation points to
+DIMENSION_FIELDS = {
+    'product': ('sku', 'description'),
+    'location': ('city', 'state', 'postal'),
+}
+
+
+def dimension_attribute(relation: str, attribute: str) -> property:
+    """
+    Expose an attribute of one of the dimension tables as if it were still a column of FBATransaction, so
+    FBATransaction(sku=..., order_city=...) and entry.sku keep working. Values set are held on the transaction
+    until save() (or the import, see dimensions.DimensionResolver) finds or creates the matching dimension row
+    """
+
+    def getter(self):
+        pending = self.pending_dimensions.get(relation)
+        if pending is not None:
+            return pending[attribute]
+        related = getattr(self, relation)
+        return getattr(related, attribute) if related is not None else None
+
+    def setter(self, value):
+        pending = self.pending_dimensions.get(relation)
+        if pending is None:
+            related = getattr(self, relation)
+            pending = self.pending_dimensions[relation] = {
+                name: getattr(related, name) if related is not None else None for name in DIMENSION_FIELDS[relation]
+            }
+        pending[attribute] = value
+
+    return property(getter, setter)
+
+
+# FBATransaction attributes that used to be columns -> the dimension lookup they're stored under now
+DIMENSION_LOOKUPS = {
+    'sku': 'product__sku',
+    'description': 'product__description',
+    'order_city': 'location__city',
+    'order_state': 'location__state',
+    'order_postal': 'location__postal',
+}
+
+
+def translate_lookup(lookup: str) -> str:
+    name, separator, rest = lookup.partition('__')
+    if name in DIMENSION_LOOKUPS:
+        return DIMENSION_LOOKUPS[name] + separator + rest
+    return lookup
+
+
+def translate_q(q: models.Q) -> models.Q:
+    translated = copy.copy(q)
+    translated.children = [
+        translate_q(child) if isinstance(child, models.Q) else (translate_lookup(child[0]), child[1])
+        for child in q.children
+    ]
+    return translated
+
+
+class FBATransactionQuerySet(models.QuerySet):
+    """
+    Accepts the former column names in filter(), exclude() and get(), e.g. filter(sku=...) or
+    get(order_state__in=...), and looks them up on the dimension tables
+    """
+
+    def _filter_or_exclude(self, negate, args, kwargs):
+        args = [translate_q(arg) if isinstance(arg, models.Q) else arg for arg in args]
+        kwargs = {translate_lookup(lookup): value for lookup, value in kwargs.items()}
+        return super()._filter_or_exclude(negate, args, kwargs)
+
+
 class FBATransaction(models.Model):
     """
     A single transaction from the FBA transaction report download
+
+    The product (sku, description) and location (city, state, postal) of the report are stored once in the
+    fba_products and fba_locations dimension tables and referenced by integer keys
     """
 
     class Meta:
         db_table = "fba_transactions"
+        # One index per filter do_filtering accepts, each ending in date_time so the start/end range
+        # and the keyset pagination order can be served from the same index. The SKU and location filters
+        # are resolved to product/location ids first, so they share the two integer keyed indexes
+        indexes = [
+            models.Index(fields=['date_time'], name='fba_date_time_idx'),
+            models.Index(fields=['product', 'date_time'], name='fba_product_date_time_idx'),
+            models.Index(fields=['order_type', 'date_time'], name='fba_type_date_time_idx'),
+            models.Index(fields=['location', 'date_time'], name='fba_location_date_time_idx'),
+            # covers the per-order sums of transactions.orders, read in order_id order without the table
+            models.Index(fields=['order_id', 'order_type', 'total'], name='fba_order_id_idx'),
+        ]
 
     date_time = models.DateTimeField(null=False, blank=False, db_column='date_time')
 
@@ -40,11 +184,206 @@ class FBATransaction(models.Model):
     )
 
     order_id = models.CharField(max_length=32, blank=True, null=True)
-    sku = models.CharField(max_length=32, blank=True, null=True)
-    description = models.TextField(blank=True, null=True)  # never seen to be null
+    # the composite indexes above lead with these, they don't need one of their own
+    product = models.ForeignKey(Product, on_delete=models.PROTECT, blank=True, null=True, db_index=False,
+                                related_name='transactions')
     quantity = models.IntegerField(null=True)
-    order_city = models.CharField(max_length=64, blank=True, null=True)
-    order_state = models.CharField(max_length=32, blank=True, null=True)
-    order_postal = models.CharField(max_length=16, blank=True, null=True)
+    location = models.ForeignKey(Location, on_delete=models.PROTECT, blank=True, null=True, db_index=False,
+                                 related_name='transactions')
     total = models.DecimalField(null=False, decimal_places=2, max_digits=16)
 
+    # Hash of the identifying columns set by the import (see ingest.transaction_fingerprint), so that
+    # re-importing an overlapping report doesn't store the same transaction twice
+    fingerprint = models.CharField(max_length=40, unique=True, null=True, editable=False)
+
+    objects = FBATransactionQuerySet.as_manager()
+
+    sku = dimension_attribute('product', 'sku')
+    description = dimension_attribute('product', 'description')  # never seen to be null
+    order_city = dimension_attribute('location', 'city')
+    order_state = dimension_attribute('location', 'state')
+    order_postal = dimension_attribute('location', 'postal')
+
+    @property
+    def pending_dimensions(self) -> dict:
+        """
+        Dimension attributes set on this transaction that haven't been resolved to a dimension row yet
+        """
+        return self.__dict__.setdefault('_pending_dimensions', {})
+
+    def resolve_dimensions(self):
+        """
+        Point product and location at the dimension rows matching the attributes set on this transaction,
+        creating them if needed
+        """
+        for relation, values in self.pending_dimensions.items():
+            model = self._meta.get_field(relation).related_model
+            related = None
+            if any(value is not None for value in values.values()):
+                # not get_or_create, NULLs aren't unique so concurrent imports may have stored a key twice
+                related = model.objects.filter(**values).order_by('id').first() or model.objects.create(**values)
+            setattr(self, relation, related)
+        self.pending_dimensions.clear()
+
+    def save(self, *args, **kwargs):
+        # the rollups are updated by the pre_save and post_save signals (see transactions.signals), in the same
+        # transaction as the row
+        with transaction.atomic(using=kwargs.get('using') or router.db_for_write(type(self), instance=self)):
+            self.resolve_dimensions()
+            super().save(*args, **kwargs)
+
+
+class ArchivedTransaction(models.Model):
+    """
+    A transaction of a closed month, moved out of fba_transactions by manage.py archive_months (see
+    transactions.archive) so the hot table and its indexes only hold recent months. Keeps its id and columns,
+    and is never written to otherwise
+    """
+
+    class Meta:
+        db_table = "fba_transactions_archive"
+        indexes = [
+            models.Index(fields=['date_time'], name='fba_archive_date_time_idx'),
+            models.Index(fields=['product', 'date_time'], name='fba_archive_product_idx'),
+            models.Index(fields=['order_type', 'date_time'], name='fba_archive_type_idx'),
+            models.Index(fields=['location', 'date_time'], name='fba_archive_location_idx'),
+            models.Index(fields=['order_id', 'order_type', 'total'], name='fba_archive_order_id_idx'),
+        ]
+
+    date_time = models.DateTimeField(null=False, blank=False, db_column='date_time')
+    order_type = models.CharField(max_length=32, choices=FBATransaction.ORDER_TYPE_CHOICES, blank=True, null=True,
+                                  db_column='type')
+    order_id = models.CharField(max_length=32, blank=True, null=True)
+    product = models.ForeignKey(Product, on_delete=models.PROTECT, blank=True, null=True, db_index=False,
+                                related_name='archived_transactions')
+    quantity = models.IntegerField(null=True)
+    location = models.ForeignKey(Location, on_delete=models.PROTECT, blank=True, null=True, db_index=False,
+                                 related_name='archived_transactions')
+    total = models.DecimalField(null=False, decimal_places=2, max_digits=16)
+    fingerprint = models.CharField(max_length=40, unique=True, null=True, editable=False)
+
+
+class TransactionHistory(models.Model):
+    """
+    Read-only view of fba_transactions and fba_transactions_archive combined (UNION ALL), queried when a date range
+    spans both. The database applies the filters to each table with its own indexes
+    """
+
+    class Meta:
+        db_table = "fba_transactions_history"
+        managed = False
+
+    date_time = models.DateTimeField(db_column='date_time')
+    order_type = models.CharField(max_length=32, choices=FBATransaction.ORDER_TYPE_CHOICES, null=True,
+                                  db_column='type')
+    order_id = models.CharField(max_length=32, null=True)
+    product = models.ForeignKey(Product, on_delete=models.DO_NOTHING, null=True, db_constraint=False,
+                                related_name='+')
+    quantity = models.IntegerField(null=True)
+    location = models.ForeignKey(Location, on_delete=models.DO_NOTHING, null=True, db_constraint=False,
+                                 related_name='+')
+    total = models.DecimalField(decimal_places=2, max_digits=16)
+    fingerprint = models.CharField(max_length=40, null=True)
+
+
+class ArchivedMonth(models.Model):
+    """
+    A month whose transactions were moved to fba_transactions_archive, with summary stats of them. Its
+    transactions may later be dropped, the summary (and the month's daily rollups until then) stays
+    """
+
+    class Meta:
+        db_table = "fba_archived_months"
+
+    month = models.DateField(unique=True)  # first day of the month, in settings.TIME_ZONE
+    count = models.IntegerField(default=0)
+    total_sum = models.DecimalField(decimal_places=2, max_digits=20, default=0)
+    total_min = models.DecimalField(null=True, decimal_places=2, max_digits=16)
+    total_max = models.DecimalField(null=True, decimal_places=2, max_digits=16)
+    archived_at = models.DateTimeField()
+    dropped_at = models.DateTimeField(null=True, blank=True)
+
+
+class FBATransactionDailyRollup(models.Model):
+    """
+    Pre-aggregated totals of FBATransactions per day and (sku, order type, order state), maintained by the
+    import so that stats over whole days can be answered without touching fba_transactions
+    """
+
+    class Meta:
+        db_table = "fba_transaction_daily_rollups"
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'sku', 'order_type', 'order_state'], name='fba_rollup_key'),
+        ]
+        indexes = [
+            models.Index(fields=['sku', 'day'], name='fba_rollup_sku_day_idx'),
+        ]
+
+    day = models.DateField(null=False)  # in settings.TIME_ZONE
+    sku = models.CharField(max_length=32, blank=True, null=True)
+    order_type = models.CharField(max_length=32, blank=True, null=True)
+    order_state = models.CharField(max_length=32, blank=True, null=True)
+
+    count = models.IntegerField(default=0)
+    total_sum = models.DecimalField(decimal_places=2, max_digits=20, default=0)
+    total_sum_squares = models.DecimalField(decimal_places=4, max_digits=32, default=0)
+    total_min = models.DecimalField(null=True, decimal_places=2, max_digits=16)
+    total_max = models.DecimalField(null=True, decimal_places=2, max_digits=16)
+    # QuantileSketch of the totals, for approximate percentiles (see transactions.sketches)
+    total_sketch = models.JSONField(default=dict)
+
+
+class DataGeneration(models.Model):
+    """
+    Single row counting the changes to the transactions. It lives in the database so that every process sees the
+    imports of every other, cached API responses and the columnar snapshot are keyed on it (see transactions.cache)
+    """
+
+    class Meta:
+        db_table = "fba_data_generation"
+
+    generation = models.BigIntegerField()
+
+
+class ImportJob(models.Model):
+    """
+    An uploaded transaction report waiting to be, or being, imported in the background
+    """
+
+    class Meta:
+        db_table = "fba_import_jobs"
+        indexes = [
+            models.Index(fields=['status', 'id'], name='fba_import_job_status_idx'),
+        ]
+
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (QUEUED, QUEUED),
+        (RUNNING, RUNNING),
+        (SUCCEEDED, SUCCEEDED),
+        (FAILED, FAILED),
+    ]
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=QUEUED)
+
+    CSV = 'csv'
+    JSON = 'json'
+    FORMAT_CHOICES = [
+        (CSV, CSV),
+        (JSON, JSON),
+    ]
+    file = models.FileField(upload_to='imports/', max_length=255)
+    file_format = models.CharField(max_length=8, choices=FORMAT_CHOICES, default=CSV)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True)
+    finished_at = models.DateTimeField(null=True)
+
+    rows_processed = models.IntegerField(default=0)
+    inserted = models.IntegerField(default=0)
+    duplicates = models.IntegerField(default=0)
+    rejected = models.IntegerField(default=0)
+    errors = models.JSONField(default=list)  # reasons rows were rejected, capped at ingest.MAX_REPORTED_ERRORS
+    error = models.TextField(blank=True, null=True)  # why the whole import failed
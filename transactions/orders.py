@@ -0,0 +1,90 @@
+"""
+Per-order reconciliation, /api/transactions/orders/.
+
+The outcome of an order is spread over the transactions sharing its order_id: the Order itself, its Refunds, the
+fees charged for it and Adjustments. order_totals sums them per order in one grouped query. The query walks the
+(order_id, type, total) index in order_id order, so the unfiltered report reads only the index and never sorts.
+Pages are keyset paginated on order_id: the cursor condition is a range of the same index, and grouping by order_id
+never splits an order across pages.
+"""
+import base64
+import json
+from decimal import Decimal
+from typing import Dict, List, Optional
+
+from django.db.models import Count, Q, Sum
+
+from transactions.filters import filter_transactions
+from transactions.models import FBATransaction
+
+CENTS = Decimal('0.01')
+
+# Transaction types charged on an order besides the sale itself
+FEE_TYPES = (FBATransaction.ORDER_RETROCHARGE, FBATransaction.RETURN_FEE, FBATransaction.INVENTORY_FEE)
+
+# Amounts of an order, each the sum of the totals of some of its transactions. net sums all of them, including
+# transactions of types none of the others cover
+AMOUNTS = {
+    'gross': Q(order_type=FBATransaction.ORDER),
+    'refunded': Q(order_type=FBATransaction.REFUND),
+    'fees': Q(order_type__in=FEE_TYPES),
+    'adjustments': Q(order_type=FBATransaction.ADJUSTMENT),
+    'net': None,
+}
+
+
+def encode_order_cursor(order_id: str) -> str:
+    """
+    Build the opaque cursor pointing just after the order with the given id
+    """
+    raw = json.dumps({'after': order_id}).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii')
+
+
+def decode_order_cursor(cursor: str) -> str:
+    """
+    Inverse of encode_order_cursor, raises ValueError if the cursor wasn't produced by it
+    """
+    try:
+        order_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))['after']
+    except (TypeError, ValueError, KeyError, UnicodeError, base64.binascii.Error):
+        raise ValueError('invalid cursor')
+    if not isinstance(order_id, str):
+        raise ValueError('invalid cursor')
+    return order_id
+
+
+def order_totals(filters: Dict, limit: int, cursor: Optional[str] = None) -> Dict:
+    """
+    One page of the orders with transactions matching filters, ordered by order_id, with the count of their
+    matching transactions and their gross, refunded, fees, adjustments and net amounts. Amounts keep the sign
+    of the report, so refunds and fees are negative
+
+    params:
+    filters(dict): Filters as returned by parse_filters, they select the transactions that are summed
+    limit(int): Maximum number of orders in the page
+    cursor(str): Opaque cursor returned as "next" by the previous page
+
+    return: dict with the orders of the page in "results" and the cursor of the next page in "next", None on the
+        last page
+    """
+    # greater than '' also leaves out the transactions without an order id
+    after = decode_order_cursor(cursor) if cursor else ''
+    amounts = {name: Sum('total', filter=condition) for name, condition in AMOUNTS.items()}
+    query = (filter_transactions(filters).filter(order_id__gt=after).order_by('order_id')
+             .values('order_id').annotate(transactions=Count('id'), **amounts))
+
+    rows: List[Dict] = list(query[:limit + 1])
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_order_cursor(rows[-1]['order_id'])
+    for row in rows:
+        for name in AMOUNTS:
+            # SQLite sums the totals as floating point, round them back to cents
+            row[name] = (row[name] or Decimal(0)).quantize(CENTS)
+
+    return {
+        'results': rows,
+        'next': next_cursor,
+    }
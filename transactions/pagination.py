@@ -0,0 +1,133 @@
+import base64
+import datetime
+import json
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from django.db.models import Q, QuerySet
+from rest_framework.utils.encoders import JSONEncoder
+
+# Page size used when a cursor is sent without a limit, and the most rows a single page may contain
+DEFAULT_PAGE_SIZE = 1000
+MAX_PAGE_SIZE = 10000
+
+# Rows fetched from the database cursor at a time when streaming
+STREAM_CHUNK_SIZE = 2000
+
+
+def encode_cursor(date_time: datetime.datetime, row_id: int) -> str:
+    """
+    Build the opaque cursor pointing just after the row with the given (date_time, id) key
+    """
+    raw = json.dumps([date_time.isoformat(), row_id]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii')
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime.datetime, int]:
+    """
+    Inverse of encode_cursor, raises ValueError if the cursor wasn't produced by it
+    """
+    try:
+        date_time, row_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return datetime.datetime.fromisoformat(date_time), int(row_id)
+    except (TypeError, ValueError, UnicodeError, base64.binascii.Error):
+        raise ValueError('invalid cursor')
+
+
+def parse_limit(limit: Optional[str]) -> int:
+    """
+    Parse the limit query parameter, raises ValueError if it isn't a positive integer
+    """
+    if not limit:
+        return DEFAULT_PAGE_SIZE
+    limit = int(limit)
+    if limit < 1:
+        raise ValueError('limit must be positive')
+    return min(limit, MAX_PAGE_SIZE)
+
+
+def keyset_order(query: QuerySet, cursor: Optional[str] = None) -> QuerySet:
+    """
+    Order query by (date_time, id) and, given a cursor, only keep the rows after it.
+    Unlike OFFSET this lets the database seek straight to the start of the page using the date_time index
+
+    params:
+    query(QuerySet): Filtered transactions
+    cursor(str): Opaque cursor returned as "next" by the previous page
+
+    return: Ordered QuerySet
+    """
+    if cursor:
+        query = rows_after(query, *decode_cursor(cursor))
+    return query.order_by('date_time', 'id')
+
+
+def rows_after(query: QuerySet, date_time: datetime.datetime, row_id: int) -> QuerySet:
+    """
+    The rows of query following the row with the given (date_time, id) key
+    """
+    return query.filter(Q(date_time__gt=date_time) | Q(date_time=date_time, id__gt=row_id))
+
+
+def iter_keyset(query: QuerySet, cursor: Optional[str] = None, chunk_size: int = STREAM_CHUNK_SIZE) -> Iterator:
+    """
+    Iterate query in (date_time, id) order, starting after cursor, fetching chunk_size rows per keyset query.
+    Unlike QuerySet.iterator() no database cursor stays open between the chunks, so a slow client doesn't keep
+    a read transaction open and consecutive chunks can be fetched by different threads (see transactions.asgi)
+
+    params:
+    query(QuerySet): values() query, or values_list() query whose rows start with the id and date_time
+    cursor(str): Opaque cursor returned as "next" by a page
+    chunk_size(int): Rows fetched per query
+
+    return: Iterator of rows, raises ValueError straight away if the cursor is invalid
+    """
+    return iter_chunks(keyset_order(query, cursor), chunk_size)
+
+
+def iter_chunks(ordered: QuerySet, chunk_size: int) -> Iterator:
+    rows = list(ordered[:chunk_size])
+    while rows:
+        yield from rows
+        if len(rows) < chunk_size:
+            return
+        last_row = rows[-1]
+        row_id, date_time = (last_row['id'], last_row['date_time']) if isinstance(last_row, dict) else last_row[:2]
+        rows = list(rows_after(ordered, date_time, row_id)[:chunk_size])
+
+
+def paginate(query: QuerySet, limit: int, cursor: Optional[str] = None) -> Dict:
+    """
+    Fetch one page of a values() query using keyset pagination on (date_time, id)
+
+    params:
+    query(QuerySet): Filtered transactions as returned by do_filtering
+    limit(int): Maximum number of rows in the page
+    cursor(str): Opaque cursor returned as "next" by the previous page
+
+    return: dict with the rows of the page in "results" and the cursor of the next page in "next", None on the last page
+    """
+    rows: List[Dict] = list(keyset_order(query, cursor)[:limit + 1])
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last_row = rows[-1]
+        next_cursor = encode_cursor(last_row.get('date_time'), last_row.get('id'))
+
+    return {
+        'results': rows,
+        'next': next_cursor,
+    }
+
+
+def iter_json_array(rows: Iterable[Dict]) -> Iterator[str]:
+    """
+    Incrementally encode rows as a JSON array, one row per chunk, so a StreamingHttpResponse never holds more
+    than the current database fetch in memory
+    """
+    encoder = JSONEncoder(separators=(',', ':'))
+    yield '['
+    separator = ''
+    for curr_row in rows:
+        yield separator + encoder.encode(curr_row)
+        separator = ','
+    yield ']'
@@ -0,0 +1,90 @@
+"""
+Mapping of FBA transaction report rows to typed values.
+
+Kept free of Django imports so it can run in the worker processes of the bulk import
+(manage.py import_transactions) as well as in the web process.
+"""
+import datetime
+from decimal import Decimal, InvalidOperation
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+from transactions.dateparse import parse_timestamp
+
+
+class ParsedRow(NamedTuple):
+    """
+    One report row, named after the FBATransaction attributes it is stored as
+    """
+
+    date_time: datetime.datetime
+    order_type: Optional[str]
+    order_id: Optional[str]
+    sku: Optional[str]
+    description: Optional[str]
+    quantity: Optional[int]
+    order_city: Optional[str]
+    order_state: Optional[str]
+    order_postal: Optional[str]
+    total: Decimal
+
+
+def parse_row(row: Dict) -> ParsedRow:
+    """
+    Map a single row of the FBA transaction report (keyed by the report's column headers) to typed values
+
+    params:
+    row(dict): One report row, e.g. from csv.DictReader or the JSON upload
+
+    return: ParsedRow, raises ValueError if the row can't be stored
+    """
+    curr_date = row.get('date/time')
+    if not curr_date:
+        raise ValueError('missing date/time')
+
+    quantity = row.get('quantity')
+    total = row.get('total')
+    if not total:
+        raise ValueError('missing total')
+    try:
+        total = Decimal(total)
+    except InvalidOperation:
+        raise ValueError(f'invalid total {total!r}')
+
+    return ParsedRow(
+        date_time=parse_timestamp(curr_date),
+        order_type=row.get('type'),
+        order_id=row.get('order id'),
+        sku=row.get('sku'),
+        description=row.get('description'),
+        quantity=int(quantity) if quantity else None,
+        order_city=row.get('order city'),
+        order_state=row.get('order state'),
+        order_postal=row.get('order postal'),
+        total=total,
+    )
+
+
+def parse_chunk(header: Optional[Sequence[str]], rows: List, first_row_number: int,
+                max_errors: int) -> Tuple[List[ParsedRow], int, List[str]]:
+    """
+    Parse and validate a chunk of report rows
+
+    params:
+    header(sequence): Column headers when rows are CSV value lists, None when they already are dicts
+    rows(list): The rows of the chunk
+    first_row_number(int): Number of the first row in its report, for error messages
+    max_errors(int): Most rejected rows to describe
+
+    return: (parsed rows, number of rejected rows, reasons rows were rejected)
+    """
+    parsed = []
+    rejected = 0
+    errors = []
+    for row_number, row in enumerate(rows, first_row_number):
+        try:
+            parsed.append(parse_row(dict(zip(header, row)) if header is not None else row))
+        except (AttributeError, ValueError, TypeError) as e:
+            rejected += 1
+            if len(errors) < max_errors:
+                errors.append(f'row {row_number}: {e}')
+    return parsed, rejected, errors
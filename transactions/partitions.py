@@ -0,0 +1,80 @@
+"""
+Month partitions of the transactions: recent months live in fba_transactions, closed months can be moved to
+fba_transactions_archive (manage.py archive_months, see transactions.archive). fba_transactions_history is a view of
+both.
+
+partition_model picks the table a query has to read for a date range, so queries over recent months never touch
+the archive and queries over archived months don't walk the hot table's indexes.
+"""
+import datetime
+from typing import List, Optional, Tuple
+
+from django.utils import timezone
+
+from transactions.models import ArchivedMonth, ArchivedTransaction, FBATransaction, TransactionHistory
+
+
+def month_bounds(month: datetime.date) -> Tuple[datetime.datetime, datetime.datetime]:
+    """
+    First instant of month and of the following month, in settings.TIME_ZONE like the rollup days
+    """
+    tzinfo = timezone.get_default_timezone()
+    first = datetime.datetime(month.year, month.month, 1)
+    following = datetime.datetime(month.year + month.month // 12, month.month % 12 + 1, 1)
+    return timezone.make_aware(first, tzinfo), timezone.make_aware(following, tzinfo)
+
+
+def archived_months() -> List[Tuple[datetime.datetime, datetime.datetime, bool]]:
+    """
+    (start, end, dropped) of every archived month, oldest first
+    """
+    return [(*month_bounds(month), dropped_at is not None)
+            for month, dropped_at in ArchivedMonth.objects.order_by('month').values_list('month', 'dropped_at')]
+
+
+def overlaps(start: Optional[datetime.datetime], end: Optional[datetime.datetime],
+             lower: datetime.datetime, upper: datetime.datetime) -> bool:
+    """
+    Whether the inclusive range start-end (either open) overlaps the half-open range lower-upper
+    """
+    return (start is None or start < upper) and (end is None or end >= lower)
+
+
+def covered(start: Optional[datetime.datetime], end: Optional[datetime.datetime],
+            months: List[Tuple[datetime.datetime, datetime.datetime, bool]]) -> bool:
+    """
+    Whether the inclusive range start-end lies entirely within consecutive archived months
+    """
+    if start is None or end is None:
+        return False
+    lower = upper = None
+    for month_start, month_end, _ in months:
+        if upper != month_start:
+            lower = month_start
+        upper = month_end
+        if lower <= start and end < upper:
+            return True
+    return False
+
+
+def partition_model(start: Optional[datetime.datetime] = None, end: Optional[datetime.datetime] = None):
+    """
+    The model to query for transactions between start and end (inclusive, either may be None)
+
+    return: FBATransaction if no archived month overlaps the range, ArchivedTransaction if archived months cover it
+        and no transaction was imported into it since, TransactionHistory (both) otherwise
+    """
+    months = archived_months()
+    if not months:
+        return FBATransaction
+
+    use_archive = any(not dropped and overlaps(start, end, lower, upper) for lower, upper, dropped in months)
+    if not use_archive:
+        return FBATransaction
+
+    use_hot = not covered(start, end, months)
+    if not use_hot:
+        # rows imported into an archived month after it was archived stay in the hot table until it is archived
+        # again, one index probe finds out
+        use_hot = FBATransaction.objects.filter(date_time__gte=start, date_time__lte=end).exists()
+    return TransactionHistory if use_hot else ArchivedTransaction
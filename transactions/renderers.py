@@ -0,0 +1,200 @@
+"""
+Compact output formats for bulk pulls of the list endpoint: newline delimited JSON, CSV and Apache Arrow IPC.
+
+The renderers take part in DRF's content negotiation (Accept header or ?format=ndjson|csv|arrow) and render any
+small response (errors, import job statuses) on their own. Lists of transactions are not rendered through them:
+the list view streams them straight from a values_list() cursor with stream_rows(), see TransactionsListView.get.
+"""
+import abc
+import csv
+import datetime
+import io
+from decimal import Decimal
+from typing import Dict, Iterable, Iterator, List, Sequence
+
+from rest_framework.renderers import BaseRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+from transactions.models import FBATransaction
+from transactions.utils import chunked
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc
+except ImportError:  # pragma: no cover - pyarrow is optional
+    pa = None
+
+# Rows encoded per chunk of a streamed response
+RENDER_CHUNK_SIZE = 2000
+
+
+def as_rows(data) -> List[Dict]:
+    """
+    The rows of a non-streamed response: a page's results, a list of rows or a single object such as an error
+    """
+    if isinstance(data, dict):
+        if 'results' in data:
+            return data['results']
+        return [data]
+    return list(data or [])
+
+
+def split_columns(rows: List[Dict]):
+    columns = list(rows[0]) if rows else []
+    return columns, ([row.get(name) for name in columns] for row in rows)
+
+
+class StreamingRenderer(BaseRenderer, abc.ABC):
+    """
+    Base of the bulk formats. stream() encodes an iterable of value tuples chunk by chunk, render() reuses it for
+    ordinary responses
+    """
+
+    charset = 'utf-8'
+    # tells cached_response to leave these requests alone, the list view streams them instead of returning data
+    streaming = True
+
+    @abc.abstractmethod
+    def stream(self, columns: Sequence[str], rows: Iterable[Sequence], schema=None) -> Iterator[bytes]:
+        """
+        Encode rows chunk by chunk
+
+        params:
+        columns(sequence): Names of the values in each row
+        rows(iterable): Value tuples
+        schema: Arrow schema of the columns, only used by ArrowRenderer
+
+        return: Iterator of encoded chunks
+        """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        columns, rows = split_columns(as_rows(data))
+        return b''.join(self.stream(columns, rows))
+
+
+class NDJSONRenderer(StreamingRenderer):
+    """
+    One compact JSON object per line, what pandas.read_json(lines=True) and most log tooling read
+    """
+
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
+
+    def stream(self, columns, rows, schema=None):
+        encoder = JSONEncoder(separators=(',', ':'))
+        for chunk in chunked(rows, RENDER_CHUNK_SIZE):
+            yield ''.join(encoder.encode(dict(zip(columns, row))) + '\n' for row in chunk).encode(self.charset)
+
+
+class CSVRenderer(StreamingRenderer):
+    """
+    A header line with the column names followed by one line per row
+    """
+
+    media_type = 'text/csv'
+    format = 'csv'
+
+    def stream(self, columns, rows, schema=None):
+        output = io.StringIO()
+        writer = csv.writer(output)
+        writer.writerow(columns)
+        for chunk in chunked(rows, RENDER_CHUNK_SIZE):
+            writer.writerows([self.csv_value(value) for value in row] for row in chunk)
+            yield output.getvalue().encode(self.charset)
+            output.seek(0)
+            output.truncate(0)
+        if output.tell():
+            yield output.getvalue().encode(self.charset)
+
+    @staticmethod
+    def csv_value(value):
+        if isinstance(value, datetime.datetime):
+            return value.isoformat()
+        return value
+
+
+class ArrowRenderer(StreamingRenderer):
+    """
+    Apache Arrow IPC stream, one record batch per chunk of rows. Requires pyarrow
+    """
+
+    media_type = 'application/vnd.apache.arrow.stream'
+    format = 'arrow'
+    charset = None
+
+    def stream(self, columns, rows, schema=None):
+        if schema is None:
+            rows = list(rows)
+            schema = pa.schema([(name, infer_arrow_type(row[index] for row in rows))
+                                for index, name in enumerate(columns)])
+
+        sink = io.BytesIO()
+        with pa.ipc.new_stream(sink, schema) as writer:
+            for chunk in chunked(rows, RENDER_CHUNK_SIZE):
+                arrays = [pa.array([row[index] for row in chunk], type=field.type)
+                          for index, field in enumerate(schema)]
+                writer.write_batch(pa.record_batch(arrays, schema=schema))
+                yield sink.getvalue()
+                sink.seek(0)
+                sink.truncate(0)
+        yield sink.getvalue()
+
+
+def infer_arrow_type(values: Iterable):
+    """
+    Arrow type of the non-null values of a column of a small response, strings if they're all null
+    """
+    for value in values:
+        if value is None:
+            continue
+        if isinstance(value, bool):
+            return pa.bool_()
+        if isinstance(value, int):
+            return pa.int64()
+        if isinstance(value, float):
+            return pa.float64()
+        if isinstance(value, Decimal):
+            return pa.decimal128(38, 10)
+        if isinstance(value, datetime.datetime):
+            return pa.timestamp('us', tz='UTC')
+        return pa.string()
+    return pa.string()
+
+
+def transaction_schema(columns: Sequence[str]):
+    """
+    Arrow schema of the transaction columns, derived from the FBATransaction fields so totals keep their
+    exact decimal value and timestamps their timezone
+    """
+    types = {}
+    for field in FBATransaction._meta.concrete_fields:
+        internal_type = field.get_internal_type()
+        if internal_type == 'DateTimeField':
+            types[field.attname] = pa.timestamp('us', tz='UTC')
+        elif internal_type == 'DecimalField':
+            types[field.attname] = pa.decimal128(field.max_digits, field.decimal_places)
+        elif internal_type in ('AutoField', 'BigAutoField', 'IntegerField', 'BigIntegerField', 'ForeignKey'):
+            types[field.attname] = pa.int64()
+        else:
+            types[field.attname] = pa.string()
+    return pa.schema([(name, types.get(name, pa.string())) for name in columns])
+
+
+STREAMING_RENDERERS = [NDJSONRenderer, CSVRenderer] + ([ArrowRenderer] if pa is not None else [])
+
+
+def stream_rows(renderer: StreamingRenderer, columns: Sequence[str], rows: Iterable[Sequence]) -> Iterator[bytes]:
+    """
+    Encode the value tuples of a transaction query in renderer's format as they're fetched
+
+    params:
+    renderer(StreamingRenderer): The negotiated renderer
+    columns(sequence): Names of the values in each row
+    rows(iterable): Value tuples, e.g. a values_list() iterator
+
+    return: Iterator of encoded chunks for a StreamingHttpResponse
+    """
+    schema = transaction_schema(columns) if isinstance(renderer, ArrowRenderer) else None
+    return renderer.stream(columns, rows, schema=schema)
@@ -0,0 +1,331 @@
+import datetime
+from decimal import Decimal
+from typing import Dict, Iterable, Optional
+
+from django.db import connections, transaction
+from django.db.models import Count, DecimalField, ExpressionWrapper, F, Max, Min, QuerySet, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from transactions.cache import bump_generation
+from transactions.filters import values_in
+from transactions.models import FBATransaction, FBATransactionDailyRollup, TransactionHistory
+from transactions.sketches import QuantileSketch, merge_sketches
+
+# Filters that map onto rollup dimensions, any other filter means the raw table has to be queried
+ROLLUP_FILTERS = {'type', 'state', 'skus', 'start', 'end'}
+
+SQUARES_FIELD = DecimalField(decimal_places=4, max_digits=32)
+
+# Transactions fetched per round trip when building sketches from scratch
+SKETCH_CHUNK_SIZE = 10000
+
+CENTS = Decimal('0.01')
+
+
+def rollup_key(entry: FBATransaction):
+    """
+    Key of the rollup row an FBATransaction is counted in
+    """
+    return timezone.localdate(entry.date_time), entry.sku, entry.order_type, entry.order_state
+
+
+def stored_total(entry: FBATransaction) -> Decimal:
+    """
+    The total of entry as stored, a total set as a float or string is only rounded to cents by the database
+    """
+    return Decimal(str(entry.total)).quantize(CENTS)
+
+
+def key_transactions(key) -> QuerySet:
+    """
+    The transactions, hot or archived, counted in the rollup row with the given key
+    """
+    day, sku, order_type, order_state = key
+    tzinfo = timezone.get_default_timezone()
+    start = timezone.make_aware(datetime.datetime.combine(day, datetime.time()), tzinfo)
+    end = timezone.make_aware(datetime.datetime.combine(day + datetime.timedelta(days=1), datetime.time()), tzinfo)
+    return TransactionHistory.objects.filter(date_time__gte=start, date_time__lt=end, product__sku=sku,
+                                             order_type=order_type, location__state=order_state)
+
+
+def apply_to_rollups(entries: Iterable[FBATransaction]):
+    """
+    Add newly inserted transactions to the daily rollups. Meant to be called inside the transaction that inserted
+    them, so the rollups are never out of step with fba_transactions
+
+    params:
+    entries(iterable): The FBATransactions just inserted
+    """
+    deltas: Dict = {}
+    for entry in entries:
+        key = rollup_key(entry)
+        total = stored_total(entry)
+        delta = deltas.get(key)
+        if delta is None:
+            deltas[key] = [1, total, total * total, total, total, QuantileSketch.of([total])]
+        else:
+            delta[0] += 1
+            delta[1] += total
+            delta[2] += total * total
+            delta[3] = min(delta[3], total)
+            delta[4] = max(delta[4], total)
+            delta[5].add(total)
+
+    if not deltas:
+        return
+
+    days = {key[0] for key in deltas}
+    existing = {
+        (rollup.day, rollup.sku, rollup.order_type, rollup.order_state): rollup
+        for rollup in FBATransactionDailyRollup.objects.select_for_update().filter(day__in=days)
+    }
+
+    to_create = []
+    to_update = []
+    for key, (count, total_sum, total_sum_squares, total_min, total_max, sketch) in deltas.items():
+        rollup = existing.get(key)
+        if rollup is None:
+            day, sku, order_type, order_state = key
+            to_create.append(FBATransactionDailyRollup(
+                day=day,
+                sku=sku,
+                order_type=order_type,
+                order_state=order_state,
+                count=count,
+                total_sum=total_sum,
+                total_sum_squares=total_sum_squares,
+                total_min=total_min,
+                total_max=total_max,
+                total_sketch=sketch.to_json(),
+            ))
+        else:
+            rollup.count += count
+            rollup.total_sum += total_sum
+            rollup.total_sum_squares += total_sum_squares
+            rollup.total_min = total_min if rollup.total_min is None else min(rollup.total_min, total_min)
+            rollup.total_max = total_max if rollup.total_max is None else max(rollup.total_max, total_max)
+            sketch.merge(QuantileSketch.from_json(rollup.total_sketch))
+            rollup.total_sketch = sketch.to_json()
+            to_update.append(rollup)
+
+    FBATransactionDailyRollup.objects.bulk_create(to_create)
+    FBATransactionDailyRollup.objects.bulk_update(
+        to_update, ['count', 'total_sum', 'total_sum_squares', 'total_min', 'total_max', 'total_sketch'])
+
+
+def remove_from_rollups(entries: Iterable[FBATransaction]):
+    """
+    Take transactions out of the daily rollups, the stored version of transactions about to be updated or
+    transactions just deleted. Meant to be called inside the transaction that changes them. Counts, sums and
+    sketch buckets are decremented, the min and max are only read again from the raw rows when one of the
+    removed totals was the min or max
+
+    params:
+    entries(iterable): The FBATransactions, with the values they are counted in the rollups with
+    """
+    removed: Dict = {}
+    for entry in entries:
+        removed.setdefault(rollup_key(entry), []).append(entry)
+
+    for key, key_entries in removed.items():
+        day, sku, order_type, order_state = key
+        rollup = (FBATransactionDailyRollup.objects.select_for_update()
+                  .filter(day=day, sku=sku, order_type=order_type, order_state=order_state).first())
+        if rollup is None:
+            continue
+        totals = [stored_total(entry) for entry in key_entries]
+        rollup.count -= len(totals)
+        if rollup.count <= 0:
+            rollup.delete()
+            continue
+
+        rollup.total_sum -= sum(totals)
+        rollup.total_sum_squares -= sum(total * total for total in totals)
+        sketch = QuantileSketch.from_json(rollup.total_sketch)
+        for total in totals:
+            sketch.remove(total)
+        rollup.total_sketch = sketch.to_json()
+        if rollup.total_min in totals or rollup.total_max in totals:
+            bounds = (key_transactions(key).exclude(id__in=[entry.id for entry in key_entries])
+                      .aggregate(total_min=Min('total'), total_max=Max('total')))
+            rollup.total_min, rollup.total_max = bounds['total_min'], bounds['total_max']
+        rollup.save(update_fields=['count', 'total_sum', 'total_sum_squares', 'total_min', 'total_max',
+                                   'total_sketch'])
+
+
+def build_sketches(transactions: QuerySet) -> Dict:
+    """
+    QuantileSketches of the totals of transactions per rollup key, from one pass over their totals
+
+    return: dict of rollup key (day, sku, order type, order state) -> QuantileSketch
+    """
+    sketches: Dict = {}
+    rows = (transactions.order_by()
+            .values_list('date_time', 'product__sku', 'order_type', 'location__state', 'total')
+            .iterator(chunk_size=SKETCH_CHUNK_SIZE))
+    for date_time, sku, order_type, order_state, total in rows:
+        key = timezone.localdate(date_time), sku, order_type, order_state
+        sketch = sketches.get(key)
+        if sketch is None:
+            sketch = sketches[key] = QuantileSketch()
+        sketch.add(total)
+    return sketches
+
+
+def rebuild_rollups() -> int:
+    """
+    Throw away the daily rollups and recompute them from fba_transactions and the archive with one grouped query,
+    plus one pass over the totals for the quantile sketches. Cached responses computed from the old rollups are
+    invalidated
+
+    return: Number of rollup rows created
+    """
+    grouped = (
+        TransactionHistory.objects
+        .annotate(
+            day=TruncDate('date_time', tzinfo=timezone.get_default_timezone()),
+            product_sku=F('product__sku'),
+            location_state=F('location__state'),
+        )
+        .values('day', 'product_sku', 'order_type', 'location_state')
+        .annotate(
+            row_count=Count('id'),
+            total_sum=Sum('total'),
+            total_sum_squares=Sum(ExpressionWrapper(F('total') * F('total'), output_field=SQUARES_FIELD)),
+            total_min=Min('total'),
+            total_max=Max('total'),
+        )
+        .order_by()
+    )
+
+    with transaction.atomic():
+        FBATransactionDailyRollup.objects.all().delete()
+        sketches = build_sketches(TransactionHistory.objects.all())
+        rollups = [
+            FBATransactionDailyRollup(
+                day=row['day'],
+                sku=row['product_sku'],
+                order_type=row['order_type'],
+                order_state=row['location_state'],
+                count=row['row_count'],
+                total_sum=row['total_sum'],
+                total_sum_squares=row['total_sum_squares'],
+                total_min=row['total_min'],
+                total_max=row['total_max'],
+                total_sketch=sketches[row['day'], row['product_sku'], row['order_type'],
+                                      row['location_state']].to_json(),
+            )
+            for row in grouped.iterator()
+        ]
+        FBATransactionDailyRollup.objects.bulk_create(rollups, batch_size=1000)
+        bump_generation()
+    return len(rollups)
+
+
+def is_day_start(value: datetime.datetime) -> bool:
+    """
+    Whether value is midnight in settings.TIME_ZONE, the timezone rollup days are in
+    """
+    return timezone.localtime(value).time() == datetime.time(0, 0, 0)
+
+
+def is_day_end(value: datetime.datetime) -> bool:
+    """
+    Whether value is the last second of a day in settings.TIME_ZONE. end is inclusive and report timestamps
+    have a resolution of one second
+    """
+    return timezone.localtime(value).time() == datetime.time(23, 59, 59)
+
+
+def rollup_query(filters: Dict) -> Optional[QuerySet]:
+    """
+    Translate filters, as returned by parse_filters, into a query over the daily rollups.
+    That is only possible when every filter is a rollup dimension and start/end fall on day boundaries
+
+    params:
+    filters(dict): Normalized filters
+
+    return: QuerySet of FBATransactionDailyRollup, None if the filters can only be answered from the raw table
+    """
+    if not set(filters) <= ROLLUP_FILTERS:
+        return None
+
+    start = filters.get('start')
+    end = filters.get('end')
+    if start and not is_day_start(start):
+        return None
+    if end and not is_day_end(end):
+        return None
+
+    query = FBATransactionDailyRollup.objects.all()
+    if filters.get('type'):
+        query = query.filter(values_in('order_type', filters['type'], FBATransactionDailyRollup))
+    if filters.get('state'):
+        query = query.filter(values_in('order_state', filters['state'], FBATransactionDailyRollup))
+    if filters.get('skus'):
+        query = query.filter(values_in('sku', filters['skus'], FBATransactionDailyRollup))
+    if start:
+        query = query.filter(day__gte=timezone.localdate(start))
+    if end:
+        query = query.filter(day__lte=timezone.localdate(end))
+    return query
+
+
+def rollup_stats(query: QuerySet) -> Dict:
+    """
+    Combine the rollup rows in query into the same sum/mean/count/min/max stats compute_stats returns
+
+    params:
+    query(QuerySet): FBATransactionDailyRollups as returned by rollup_query
+
+    return: dict of stats
+    """
+    stats = query.aggregate(
+        summed=Sum('total_sum'),
+        count=Sum('count'),
+        min=Min('total_min'),
+        max=Max('total_max'),
+    )
+    count = stats.get('count') or 0
+    stats['count'] = count
+    stats['mean'] = stats.get('summed') / count if count else None
+    return stats
+
+
+def rollup_sketch(query: QuerySet) -> QuantileSketch:
+    """
+    Merge the quantile sketches of the rollup rows in query. On SQLite and PostgreSQL the bucket counts are summed
+    inside the database (json_each/jsonb_each_text grouped by bucket), so only the merged buckets are fetched
+    however many rollup rows match
+
+    params:
+    query(QuerySet): FBATransactionDailyRollups as returned by rollup_query
+
+    return: QuantileSketch of every total counted in query
+    """
+    connection = connections[query.db]
+    if connection.vendor == 'sqlite':
+        each, extract_zero = 'json_each(r.total_sketch, \'$.{}\')', 'json_extract(r.total_sketch, \'$.zero\')'
+    elif connection.vendor == 'postgresql':
+        each, extract_zero = 'jsonb_each_text(r.total_sketch -> \'{}\')', '(r.total_sketch ->> \'zero\')::bigint'
+    else:
+        return merge_sketches(query.values_list('total_sketch', flat=True).iterator(chunk_size=SKETCH_CHUNK_SIZE))
+
+    sql, params = query.order_by().values('total_sketch').query.sql_with_params()
+    merged = QuantileSketch()
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'WITH r AS ({sql}) '
+            f'SELECT \'positive\', CAST(b.key AS INTEGER), SUM(CAST(b.value AS INTEGER)) '
+            f'FROM r, {each.format("positive")} AS b GROUP BY b.key '
+            f'UNION ALL SELECT \'negative\', CAST(b.key AS INTEGER), SUM(CAST(b.value AS INTEGER)) '
+            f'FROM r, {each.format("negative")} AS b GROUP BY b.key '
+            f'UNION ALL SELECT \'zero\', 0, SUM({extract_zero}) FROM r',
+            params)
+        for store, index, count in cursor.fetchall():
+            if store == 'zero':
+                merged.zero = int(count or 0)
+            else:
+                getattr(merged, store)[int(index)] = int(count)
+    return merged
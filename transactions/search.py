@@ -0,0 +1,57 @@
+"""
+Full-text search of the transactions by the SKU and description of their product, the q= filter.
+
+On SQLite the products are indexed in the FTS5 table fba_products_fts (see ProductSearch). Triggers on fba_products
+keep it in sync however a product is created, so every import indexes its new products in the same transaction.
+Since the text lives in the small products table, a search matches a handful of products in the index and the
+transactions are then filtered on product_id IN (...) with the product index, instead of a LIKE scan over every
+transaction. Other databases fall back to icontains lookups on the products, unranked.
+"""
+import re
+from typing import Tuple
+
+from django.db import connections, router
+from django.db.models import FloatField, Q, QuerySet, Value
+
+from transactions.models import Product, ProductSearch
+
+# Characters that are part of a search term, anything else separates terms
+TERM = re.compile(r'[^\W_]+\*?')
+
+
+def parse_search(value: str) -> Tuple[str, ...]:
+    """
+    Split the q= filter into terms: words of letters and digits, lowercased. A term ending in * matches any word
+    starting with it
+
+    return: The terms de-duplicated and sorted, every one of them has to match. Raises ValueError if value has
+        no terms
+    """
+    terms = tuple(sorted({term.lower() for term in TERM.findall(value or '')}))
+    if not terms:
+        raise ValueError(f'q {value} has no words to search for')
+    return terms
+
+
+def match_expression(terms: Tuple[str, ...]) -> str:
+    """
+    FTS5 query matching rows that contain all terms. Every term is quoted, so the search text can't inject FTS5
+    operators
+    """
+    return ' AND '.join(f'"{term[:-1]}"*' if term.endswith('*') else f'"{term}"' for term in terms)
+
+
+def search_products(terms: Tuple[str, ...]) -> QuerySet:
+    """
+    Products whose SKU or description contain all terms, with their rank
+
+    return: QuerySet with id and rank of the matching products
+    """
+    if connections[router.db_for_read(Product)].vendor == 'sqlite':
+        return ProductSearch.objects.extra(where=['fba_products_fts MATCH %s'], params=[match_expression(terms)])
+
+    conditions = Q()
+    for term in terms:
+        term = term.rstrip('*')
+        conditions &= Q(sku__icontains=term) | Q(description__icontains=term)
+    return Product.objects.filter(conditions).annotate(rank=Value(0.0, output_field=FloatField()))
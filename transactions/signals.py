@@ -0,0 +1,41 @@
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from transactions.cache import bump_generation
+from transactions.models import FBATransaction
+from transactions.rollups import apply_to_rollups, remove_from_rollups
+
+
+@receiver(post_save, sender=FBATransaction)
+@receiver(post_delete, sender=FBATransaction)
+def invalidate_cached_responses(sender, **kwargs):
+    """
+    Transactions saved or deleted one at a time (the admin, the shell) invalidate the response cache the same way
+    an import does
+    """
+    bump_generation()
+
+
+@receiver(pre_save, sender=FBATransaction)
+def remove_stored_from_rollups(sender, instance, raw=False, **kwargs):
+    """
+    A transaction about to be updated is taken out of the daily rollups with the values it was stored with, and
+    counted again with its new ones once saved. Imports bulk insert without signals and update the rollups
+    themselves (see ingest.import_rows)
+    """
+    if raw or instance.pk is None:
+        return
+    stored = FBATransaction.objects.select_related('product', 'location').filter(pk=instance.pk).first()
+    if stored is not None:
+        remove_from_rollups([stored])
+
+
+@receiver(post_save, sender=FBATransaction)
+def add_saved_to_rollups(sender, instance, raw=False, **kwargs):
+    if not raw:
+        apply_to_rollups([instance])
+
+
+@receiver(post_delete, sender=FBATransaction)
+def remove_deleted_from_rollups(sender, instance, **kwargs):
+    remove_from_rollups([instance])
@@ -0,0 +1,158 @@
+"""
+Mergeable quantile sketches of transaction totals, stored on the daily rollups for approximate percentiles.
+
+QuantileSketch follows DDSketch (Masson et al., VLDB 2019): every value is counted in a logarithmically sized
+bucket, bucket i of the positive values covering (gamma^(i-1), gamma^i] with gamma = (1 + a) / (1 - a). Any
+quantile read back from the bucket counts is within a relative error of a (RELATIVE_ACCURACY) of the true value,
+however many sketches were merged: merging just adds the counts of equal buckets. Negative totals (refunds, fees)
+are counted in a mirrored set of buckets and zeros separately.
+"""
+import math
+from decimal import Decimal
+from typing import Dict, Iterable, Optional
+
+# Relative error of every quantile read from a sketch. Changing it requires manage.py rebuild_rollups
+RELATIVE_ACCURACY = 0.005
+
+GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+LOG_GAMMA = math.log(GAMMA)
+
+# Totals are in cents, anything smaller in magnitude is counted as zero
+ZERO_THRESHOLD = 1e-9
+
+
+def bucket_index(magnitude: float) -> int:
+    return math.ceil(math.log(magnitude) / LOG_GAMMA)
+
+
+def bucket_value(index: int) -> float:
+    # the point of the bucket with the same relative distance to both of its bounds
+    return 2 * GAMMA ** index / (GAMMA + 1)
+
+
+class QuantileSketch:
+    """
+    Bucket counts of the positive and negative values and the number of zeros
+    """
+
+    def __init__(self, positive: Optional[Dict[int, int]] = None, negative: Optional[Dict[int, int]] = None,
+                 zero: int = 0):
+        self.positive = positive or {}
+        self.negative = negative or {}
+        self.zero = zero
+
+    def __len__(self):
+        return self.zero + sum(self.positive.values()) + sum(self.negative.values())
+
+    def add(self, value):
+        value = float(value)
+        if value > ZERO_THRESHOLD:
+            index = bucket_index(value)
+            self.positive[index] = self.positive.get(index, 0) + 1
+        elif value < -ZERO_THRESHOLD:
+            index = bucket_index(-value)
+            self.negative[index] = self.negative.get(index, 0) + 1
+        else:
+            self.zero += 1
+
+    def remove(self, value):
+        """
+        Uncount a value that was added before
+        """
+        value = float(value)
+        if abs(value) <= ZERO_THRESHOLD:
+            self.zero = max(self.zero - 1, 0)
+            return
+        buckets = self.positive if value > 0 else self.negative
+        index = bucket_index(abs(value))
+        count = buckets.get(index, 0) - 1
+        if count > 0:
+            buckets[index] = count
+        else:
+            buckets.pop(index, None)
+
+    def merge(self, other: 'QuantileSketch'):
+        for index, count in other.positive.items():
+            self.positive[index] = self.positive.get(index, 0) + count
+        for index, count in other.negative.items():
+            self.negative[index] = self.negative.get(index, 0) + count
+        self.zero += other.zero
+
+    def value_at_rank(self, rank: int) -> float:
+        """
+        Estimate of the value at a 0-based rank in ascending order
+        """
+        for index in sorted(self.negative, reverse=True):
+            rank -= self.negative[index]
+            if rank < 0:
+                return -bucket_value(index)
+        rank -= self.zero
+        if rank < 0:
+            return 0.0
+        for index in sorted(self.positive):
+            rank -= self.positive[index]
+            if rank < 0:
+                return bucket_value(index)
+        raise IndexError('rank out of range')
+
+    def quantile(self, pct) -> Optional[float]:
+        """
+        Estimate of a percentile (0-100), interpolated between the two nearest ranks like stats.percentile
+
+        return: The estimate, None if the sketch is empty
+        """
+        count = len(self)
+        if not count:
+            return None
+        position = float(pct) * (count - 1) / 100
+        lower = int(position)
+        fraction = position - lower
+        value = self.value_at_rank(lower)
+        if fraction == 0 or lower + 1 >= count:
+            return value
+        return value + (self.value_at_rank(lower + 1) - value) * fraction
+
+    def to_json(self) -> Dict:
+        """
+        JSON representation stored in FBATransactionDailyRollup.total_sketch, object keys have to be strings
+        """
+        return {
+            'zero': self.zero,
+            'positive': {str(index): count for index, count in self.positive.items()},
+            'negative': {str(index): count for index, count in self.negative.items()},
+        }
+
+    @classmethod
+    def from_json(cls, data: Optional[Dict]) -> 'QuantileSketch':
+        data = data or {}
+        return cls(
+            positive={int(index): count for index, count in (data.get('positive') or {}).items()},
+            negative={int(index): count for index, count in (data.get('negative') or {}).items()},
+            zero=data.get('zero') or 0,
+        )
+
+    @classmethod
+    def of(cls, values: Iterable) -> 'QuantileSketch':
+        sketch = cls()
+        for value in values:
+            sketch.add(value)
+        return sketch
+
+
+def merge_sketches(sketches: Iterable[Optional[Dict]]) -> QuantileSketch:
+    """
+    Merge stored sketches (as returned by to_json) into one
+    """
+    merged = QuantileSketch()
+    for data in sketches:
+        merged.merge(QuantileSketch.from_json(data))
+    return merged
+
+
+def to_cents(value: Optional[float]) -> Optional[Decimal]:
+    """
+    A sketch estimate as a Decimal of cents like the exact stats
+    """
+    if value is None:
+        return None
+    return Decimal(repr(value)).quantize(Decimal('0.01'))
@@ -0,0 +1,315 @@
+import datetime
+from decimal import Decimal, InvalidOperation
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from django.db import connections
+from django.db.models import Avg, Count, F, Max, Min, QuerySet, Sum, Window
+from django.db.models.functions import RowNumber, Trunc
+from django.utils import timezone
+
+from transactions.rollups import rollup_sketch, rollup_stats
+from transactions.sketches import RELATIVE_ACCURACY, to_cents
+
+CENTS = Decimal('0.01')
+MEAN_PLACES = Decimal('0.000001')
+
+
+def percentile(query: QuerySet, pct: Decimal, count: int):
+    """
+    Compute a percentile of the transaction totals in query without loading the rows.
+    The database sorts the totals and only the one or two rows either side of the requested rank are fetched
+    (ORDER BY total LIMIT 2 OFFSET k), interpolating linearly between them the same way statistics.median does
+
+    params:
+    query(QuerySet): Filtered transactions
+    pct(Decimal): Percentile to compute, 0-100
+    count(int): Number of rows in query, as already computed by the aggregate query
+
+    return: The percentile as a Decimal, None if query is empty
+    """
+    if not count:
+        return None
+
+    position = Decimal(pct) * (count - 1) / 100
+    lower = int(position)
+    fraction = position - lower
+
+    neighbours = list(query.order_by('total').values_list('total', flat=True)[lower:lower + 2])
+    if fraction == 0 or len(neighbours) == 1:
+        return neighbours[0]
+    return neighbours[0] + (neighbours[1] - neighbours[0]) * fraction
+
+
+def compute_stats(query: QuerySet, percentiles: Iterable[Decimal] = (), rollups: Optional[QuerySet] = None,
+                  approx: bool = False) -> Dict:
+    """
+    Compute the summary stats of the transaction totals in query inside the database.
+    Sum/mean/count/min/max are a single aggregate query and each of the median and the requested percentiles
+    is one ORDER BY total LIMIT 2 OFFSET k query. No index covers total, so each of those sorts the matching rows
+    in the database: memory in Python doesn't depend on how many rows match, but the cost grows with them. approx
+    avoids the sorts
+
+    params:
+    query(QuerySet): Filtered transactions
+    percentiles(iterable): Additional percentiles (0-100) to compute
+    rollups(QuerySet): Daily rollups covering exactly the rows in query, when given sum/mean/count/min/max are
+        read from them instead of the transactions
+    approx(bool): Estimate the median and percentiles from the quantile sketches of rollups instead of sorting
+        the totals. Only possible with rollups, otherwise they are computed exactly. Adds error_bound to the stats,
+        the relative error of the estimates (0 when exact)
+
+    return: dict of stats, all None if nothing matched
+    """
+    if rollups is not None:
+        stats = rollup_stats(rollups)
+    else:
+        stats = query.aggregate(
+            summed=Sum('total'),
+            mean=Avg('total'),
+            count=Count('id'),
+            min=Min('total'),
+            max=Max('total'),
+        )
+    # SQLite sums the totals as floating point, round the money columns back to cents
+    for name in ('summed', 'min', 'max'):
+        if stats.get(name) is not None:
+            stats[name] = stats[name].quantize(CENTS)
+
+    count = stats.get('count')
+    if approx and rollups is not None:
+        sketch = rollup_sketch(rollups)
+        stats['median'] = to_cents(sketch.quantile(50))
+        if percentiles:
+            stats['percentiles'] = {str(pct): to_cents(sketch.quantile(pct)) for pct in percentiles}
+        stats['error_bound'] = RELATIVE_ACCURACY
+        return stats
+
+    stats['median'] = percentile(query, Decimal(50), count)
+    if percentiles:
+        stats['percentiles'] = {str(pct): percentile(query, pct, count) for pct in percentiles}
+    if approx:
+        stats['error_bound'] = 0
+    return stats
+
+
+def parse_approx(approx: Optional[str], max_error: Optional[str]) -> bool:
+    """
+    Parse the approx and max_error query parameters of the stats endpoint
+
+    params:
+    approx(str): true or 1 to accept estimated percentiles
+    max_error(str): Largest relative error acceptable, e.g. 0.01. The sketches answer within RELATIVE_ACCURACY
+
+    return: Whether approximate percentiles were requested, raises ValueError if max_error is invalid or tighter
+        than the sketches can guarantee
+    """
+    if approx not in ('1', 'true'):
+        if max_error:
+            raise ValueError('max_error requires approx=true')
+        return False
+    if max_error:
+        try:
+            bound = Decimal(max_error)
+        except InvalidOperation:
+            raise ValueError(f'max_error {max_error} is not a number')
+        if not bound.is_finite() or bound < Decimal(str(RELATIVE_ACCURACY)):
+            raise ValueError(f'approx=true estimates within a relative error of {RELATIVE_ACCURACY}, '
+                             f'max_error must be at least that')
+    return True
+
+
+def parse_percentiles(percentiles: str):
+    """
+    Parse a comma separated list of percentiles such as "90,95,99.9"
+
+    params:
+    percentiles(str): Value of the percentiles query parameter
+
+    return: List of Decimals, raises ValueError if any of them isn't a number between 0 and 100
+    """
+    if not percentiles:
+        return []
+
+    parsed = []
+    for curr_pct in percentiles.split(','):
+        try:
+            pct = Decimal(curr_pct.strip())
+        except InvalidOperation:
+            raise ValueError(f'percentile {curr_pct} is not a number')
+        if not pct.is_finite() or not 0 <= pct <= 100:
+            raise ValueError(f'percentile {curr_pct} is not between 0 and 100')
+        parsed.append(pct)
+    return parsed
+
+
+# group_by name -> FBATransaction field (or dimension attribute) it groups on
+GROUP_FIELDS = {
+    'sku': 'product__sku',
+    'type': 'order_type',
+    'state': 'location__state',
+    'city': 'location__city',
+    'postal': 'location__postal',
+}
+# group_by name -> Trunc kind of the time buckets
+TIME_BUCKETS = {
+    'hour': 'hour',
+    'day': 'day',
+    'week': 'week',
+    'month': 'month',
+}
+GROUP_METRICS = ('count', 'summed', 'mean', 'median', 'min', 'max')
+
+
+def parse_group_by(group_by: str) -> List[str]:
+    """
+    Parse a comma separated list of group_by dimensions such as "state,sku" or "sku,month"
+
+    params:
+    group_by(str): Value of the group_by query parameter
+
+    return: List of dimension names in the order given, raises ValueError on an unknown or repeated dimension or
+        more than one time bucket
+    """
+    if not group_by:
+        return []
+
+    dimensions = [name.strip() for name in group_by.split(',')]
+    for name in dimensions:
+        if name not in GROUP_FIELDS and name not in TIME_BUCKETS:
+            raise ValueError(f'cannot group by {name}')
+    if len(set(dimensions)) != len(dimensions):
+        raise ValueError('group_by dimensions must not repeat')
+    if len([name for name in dimensions if name in TIME_BUCKETS]) > 1:
+        raise ValueError('group_by accepts at most one time bucket')
+    return dimensions
+
+
+def parse_order_by(order_by: str, dimensions: List[str]) -> List[Tuple[str, bool]]:
+    """
+    Parse the order_by parameter of a breakdown, e.g. "-summed" or "state,-count"
+
+    params:
+    order_by(str): Comma separated metrics or dimensions, prefixed with - for descending
+    dimensions(list): The group_by dimensions, which can be ordered by as well
+
+    return: List of (name, descending) tuples, raises ValueError on an unknown name
+    """
+    if not order_by:
+        # time series read oldest first, anything else biggest first
+        buckets = [name for name in dimensions if name in TIME_BUCKETS]
+        return [(buckets[0], False)] if buckets else [('summed', True)]
+
+    ordering = []
+    for name in order_by.split(','):
+        name = name.strip()
+        descending = name.startswith('-')
+        name = name.lstrip('-')
+        if name not in GROUP_METRICS and name not in dimensions:
+            raise ValueError(f'cannot order by {name}')
+        ordering.append((name, descending))
+    return ordering
+
+
+def parse_top(top: str) -> Optional[int]:
+    """
+    Parse the top parameter, the number of groups to return
+
+    return: Positive int or None if top wasn't given, raises ValueError otherwise
+    """
+    if not top:
+        return None
+    try:
+        parsed = int(top)
+    except ValueError:
+        raise ValueError(f'top {top} is not a number')
+    if parsed < 1:
+        raise ValueError('top must be at least 1')
+    return parsed
+
+
+def to_decimal(value, places: Decimal) -> Optional[Decimal]:
+    # aggregates over the raw SQL come back as floats on SQLite
+    if value is None:
+        return None
+    return Decimal(str(value)).quantize(places)
+
+
+def grouped_stats(query: QuerySet, dimensions: List[str], ordering: List[Tuple[str, bool]],
+                  top: Optional[int] = None) -> List[Dict]:
+    """
+    Compute count/summed/mean/median/min/max of the transaction totals in query for every group of dimensions,
+    in a single query. The filtered rows are numbered by total within their group with window functions
+    (ROW_NUMBER/COUNT OVER PARTITION BY) and an outer GROUP BY aggregates each group, taking the median as the
+    average of its one or two middle rows, so the whole breakdown is one pass over the table however many groups
+    there are
+
+    params:
+    query(QuerySet): Filtered transactions
+    dimensions(list): Dimensions to group by, as returned by parse_group_by
+    ordering(list): Order of the groups, as returned by parse_order_by
+    top(int): Return only the first top groups
+
+    return: List of dicts, one per group, holding the dimension values and the stats
+    """
+    tzinfo = timezone.get_current_timezone()
+    columns = {}
+    for name in dimensions:
+        if name in TIME_BUCKETS:
+            columns[f'group_{name}'] = Trunc('date_time', TIME_BUCKETS[name], tzinfo=tzinfo)
+        else:
+            columns[f'group_{name}'] = F(GROUP_FIELDS[name])
+    partition = [F(alias) for alias in columns]
+
+    ranked = query.order_by().annotate(**columns).annotate(
+        group_row=Window(RowNumber(), partition_by=partition, order_by=F('total').asc()),
+        group_size=Window(Count('id'), partition_by=partition),
+    ).values(*columns, 'total', 'group_row', 'group_size')
+    inner_sql, params = ranked.query.sql_with_params()
+
+    connection = connections[query.db]
+    quote = connection.ops.quote_name
+    # break ties on the dimensions so that top=N always picks the same groups
+    ordered = {name for name, _ in ordering}
+    ordering = ordering + [(name, False) for name in dimensions if name not in ordered]
+    group_columns = ', '.join(quote(alias) for alias in columns)
+    order_columns = ', '.join(
+        f'{quote("group_" + name if name in dimensions else name)} {"DESC" if descending else "ASC"}'
+        for name, descending in ordering
+    )
+    sql = (
+        f'SELECT {group_columns}, COUNT(*) AS {quote("count")}, SUM(total) AS {quote("summed")}, '
+        f'AVG(total) AS {quote("mean")}, '
+        # the middle row, or the two middle rows of an even sized group
+        f'AVG(CASE WHEN group_row IN ((group_size + 1) / 2, (group_size + 2) / 2) THEN total END) '
+        f'AS {quote("median")}, '
+        f'MIN(total) AS {quote("min")}, MAX(total) AS {quote("max")} '
+        f'FROM ({inner_sql}) ranked GROUP BY {group_columns} ORDER BY {order_columns}'
+    )
+    if top:
+        sql += ' LIMIT %s'
+        params = params + (top,)
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+
+    groups = []
+    for row in rows:
+        values = row[:len(dimensions)]
+        count, summed, mean, median, minimum, maximum = row[len(dimensions):]
+        group = {}
+        for name, value in zip(dimensions, values):
+            if name in TIME_BUCKETS and isinstance(value, str):
+                # SQLite returns the truncated timestamp as text in the bucket timezone
+                value = timezone.make_aware(datetime.datetime.fromisoformat(value), tzinfo)
+            group[name] = value
+        group.update({
+            'count': count,
+            'summed': to_decimal(summed, CENTS),
+            'mean': to_decimal(mean, MEAN_PLACES),
+            'median': to_decimal(median, CENTS / 10),
+            'min': to_decimal(minimum, CENTS),
+            'max': to_decimal(maximum, CENTS),
+        })
+        groups.append(group)
+    return groups
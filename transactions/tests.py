@@ -1,8 +1,51 @@
-from django.test import TestCase, Client
+import asyncio
+import csv
+import datetime
+import io
+import itertools
+import json
+import tempfile
+import threading
+import time
+import zoneinfo
+from decimal import Decimal
+
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError, OperationalError, connection, connections, transaction
+from django.db.migrations.executor import MigrationExecutor
+from django.db.migrations.recorder import MigrationRecorder
+from django.db.models import Q, Sum
+from unittest import skipUnless
+
+from django.test import TestCase, Client, RequestFactory, TransactionTestCase, override_settings
 
 # Create your tests here.
-from transactions.models import FBATransaction
-from transactions.views import convert_string_to_datetime, TransactionsListView
+from transactions.archive import archive_month
+from transactions.asgi import (AGGREGATE_POOL, QUERY_POOL, TransactionsASGIHandler, get_pool, request_pool,
+                               shutdown_pools)
+from transactions.benchmarks import asgi_get, filter_matrix, synthesize_report
+from transactions.bulk_import import bulk_import
+from transactions.cache import get_cache, get_generation
+from transactions.columnar import ColumnarSnapshot, np
+from transactions.database import TransactionsRouter
+from transactions.dateparse import (convert_string_to_datetime, legacy_pdt_timestamps, parse_timestamp,
+                                    parse_timestamps)
+from transactions.ingest import import_rows, iter_csv_rows
+from transactions.jobs import create_import_job, resume_import_jobs
+from transactions.models import (ArchivedMonth, ArchivedTransaction, FBATransaction, FBATransactionDailyRollup, ImportJob,
+                                 Location, Product, TransactionHistory)
+from transactions.renderers import pa
+from transactions.rollups import rebuild_rollups, rollup_query, rollup_sketch
+from transactions.sketches import RELATIVE_ACCURACY, QuantileSketch, merge_sketches
+from transactions.filters import filter_transactions, parse_filters
+from transactions.metrics import expose_metrics
+from transactions.partitions import partition_model
+from transactions.search import parse_search
+from transactions.stats import compute_stats
+from transactions.views import do_filtering, TransactionsListView
 
 
 class Transactions(TestCase):
@@ -39,6 +82,11 @@ class Transactions(TestCase):
         lightsaber_orm = FBATransaction.objects.get(sku='bled-kyber')
         assert lightsaber_orm.order_id == '66'
 
+    def test_former_column_lookups(self):
+        assert FBATransaction.objects.filter(sku__startswith='bled').count() == 1
+        assert FBATransaction.objects.get(Q(order_state='Core') & ~Q(order_postal='Executor')).order_id == '67'
+        assert not FBATransaction.objects.exclude(Q(sku='bled-kyber') | Q(order_city='Coruscant')).exists()
+
     def add_x_wing(self):
         x_wing_orm = FBATransaction(
             date_time=convert_string_to_datetime('Dec 2, 2020 12:23:30 AM PDT'),
@@ -120,3 +168,1399 @@ class Transactions(TestCase):
         assert data.get('mean') != data.get('median')
         assert data.get('summed') != data.get('median')
 
+
+    def test_get_stats_aggregates(self):
+        c = Client(HTTP_USER_AGENT='Mozilla/5.0')
+        self.add_x_wing()
+
+        resp = c.get('/api/transactions/stats/?percentiles=0,25,100')
+        data = resp.data
+        assert data.get('count') == 3
+        assert data.get('summed') == Decimal('2243.67')
+        assert data.get('min') == Decimal('455.65')
+        assert data.get('max') == Decimal('999.01')
+        assert data.get('median') == Decimal('789.01')
+        assert data.get('percentiles') == {
+            '0': Decimal('455.65'),
+            '25': Decimal('622.33'),
+            '100': Decimal('999.01'),
+        }
+
+        resp = c.get('/api/transactions/stats/?start=May 10, 2002 12:23:30 AM PDT&end=May 21, 2005 12:23:30 AM PDT')
+        assert resp.data.get('count') == 0
+
+        resp = c.get('/api/transactions/stats/?percentiles=101')
+        assert resp.status_code == 400
+
+    def test_get_stats_grouped(self):
+        c = Client(HTTP_USER_AGENT='Mozilla/5.0')
+        self.add_x_wing()
+
+        resp = c.get('/api/transactions/stats/?group_by=type')
+        data = resp.data
+        assert data.get('group_by') == ['type']
+        assert [group.get('type') for group in data.get('groups')] == ['Order', 'Refund']  # biggest summed first
+        order = data.get('groups')[0]
+        assert order.get('count') == 2
+        assert order.get('summed') == Decimal('1454.66')
+        assert order.get('median') == order.get('mean') == Decimal('727.33')
+        assert order.get('min') == Decimal('455.65') and order.get('max') == Decimal('999.01')
+
+        resp = c.get('/api/transactions/stats/?group_by=type,month&order_by=-count&top=1')
+        groups = resp.data.get('groups')
+        assert len(groups) == 1
+        assert groups[0].get('type') == 'Order'
+        assert groups[0].get('month') == datetime.datetime(2020, 11, 1, tzinfo=datetime.timezone.utc)
+
+        resp = c.get('/api/transactions/stats/?group_by=month')
+        assert [group.get('count') for group in resp.data.get('groups')] == [1, 2]  # time buckets oldest first
+
+        resp = c.get('/api/transactions/stats/?group_by=sku&type=Refund')
+        assert [group.get('sku') for group in resp.data.get('groups')] == ['tie-bomber']
+
+        for params in ('group_by=color', 'group_by=day,month', 'group_by=sku&order_by=color',
+                       'group_by=sku&top=0', 'group_by=sku&percentiles=90'):
+            resp = c.get(f'/api/transactions/stats/?{params}')
+            assert resp.status_code == 400
+
+    def test_get_timeseries(self):
+        c = Client(HTTP_USER_AGENT='Mozilla/5.0')
+        self.add_x_wing()
+
+        resp = c.get('/api/transactions/timeseries/', {
+            'interval': 'day', 'tz': 'America/Los_Angeles',
+            'start': 'Nov 1, 2020 12:00:00 AM PDT', 'end': 'Nov 3, 2020 11:59:59 PM PST',
+        })
+        buckets = resp.data.get('buckets')
+        pacific = zoneinfo.ZoneInfo('America/Los_Angeles')
+        assert [bucket.get('bucket') for bucket in buckets] == [
+            datetime.datetime(2020, 11, day, tzinfo=pacific) for day in (1, 2, 3)]
+        assert [bucket.get('count') for bucket in buckets] == [1, 0, 0]  # empty days are zero filled
+        assert [bucket.get('summed') for bucket in buckets] == [Decimal('455.65'), Decimal('0.00'), Decimal('0.00')]
+
+        resp = c.get('/api/transactions/timeseries/?interval=month')
+        assert [bucket.get('count') for bucket in resp.data.get('buckets')] == [1, 2]
+        assert resp.data.get('buckets')[1].get('summed') == Decimal('1788.02')
+
+        # 1 AM happens twice on the night DST ends, Trunc puts both in one bucket
+        resp = c.get('/api/transactions/timeseries/', {
+            'interval': 'hour', 'tz': 'America/Los_Angeles',
+            'start': 'Nov 1, 2020 12:00:00 AM PDT', 'end': 'Nov 1, 2020 2:59:59 AM PST',
+        })
+        assert [bucket.get('bucket').hour for bucket in resp.data.get('buckets')] == [0, 1, 2]
+
+        resp = c.get('/api/transactions/timeseries/?type=Nothing')
+        assert resp.data.get('buckets') == []
+
+        for params in ('interval=year', 'tz=Mars/Olympus_Mons',
+                       'interval=hour&start=Jan 1, 2000 12:00:00 AM PST&end=Jan 1, 2020 12:00:00 AM PST'):
+            resp = c.get(f'/api/transactions/timeseries/?{params}')
+            assert resp.status_code == 400
+
+    def test_multi_value_filters(self):
+        c = Client(HTTP_USER_AGENT='Mozilla/5.0')
+        self.add_x_wing()
+
+        resp = c.get('/api/transactions/?type=Order,Refund')
+        assert len(resp.data) == 3
+        resp = c.get('/api/transactions/?state=Core&state=Outer Rim')
+        assert sorted(row.get('sku') for row in resp.data) == ['tie-bomber', 'x-wing']
+        resp = c.get('/api/transactions/?city=Mos Espa,Yavin&type=Order')
+        assert sorted(row.get('sku') for row in resp.data) == ['bled-kyber', 'x-wing']
+
+        resp = c.get('/api/transactions/?min_total=500&max_total=999.01')
+        assert sorted(row.get('sku') for row in resp.data) == ['tie-bomber', 'x-wing']
+        resp = c.get('/api/transactions/stats/?max_total=500')
+        assert resp.data.get('count') == 1
+        resp = c.get('/api/transactions/?min_total=lots')
+        assert resp.status_code == 400
+
+        skus = [f'sku-{number}' for number in range(2000)] + ['x-wing', 'bled-kyber']
+        resp = c.get('/api/transactions/', {'skus': ','.join(skus)})
+        assert sorted(row.get('sku') for row in resp.data) == ['bled-kyber', 'x-wing']
+        resp = c.get('/api/transactions/stats/', {'skus': ','.join(skus), 'type': 'Order', 'min_total': '0'})
+        assert resp.data.get('count') == 2
+
+        assert parse_filters({'skus': 'b,a,b'}) == parse_filters({'skus': 'a,b'})
+
+    def test_get_paginated(self):
+        c = Client(HTTP_USER_AGENT='Mozilla/5.0')
+        self.add_x_wing()
+
+        resp = c.get('/api/transactions/?limit=2')
+        data = resp.data
+        assert [row.get('sku') for row in data.get('results')] == ['bled-kyber', 'tie-bomber']
+        assert data.get('next')
+
+        resp = c.get('/api/transactions/', {'limit': 2, 'cursor': data.get('next')})
+        data = resp.data
+        assert [row.get('sku') for row in data.get('results')] == ['x-wing']
+        assert data.get('next') is None
+
+        resp = c.get('/api/transactions/?limit=1&type=Order')
+        data = resp.data
+        resp = c.get('/api/transactions/', {'limit': 1, 'type': 'Order', 'cursor': data.get('next')})
+        assert [row.get('sku') for row in resp.data.get('results')] == ['x-wing']
+
+        resp = c.get('/api/transactions/?cursor=garbage')
+        assert resp.status_code == 400
+
+    def test_get_stream(self):
+        c = Client(HTTP_USER_AGENT='Mozilla/5.0')
+        resp = c.get('/api/transactions/?stream=true&start=Nov 1, 2020 12:23:30 AM PDT')
+        assert resp.streaming
+        data = json.loads(b''.join(resp.streaming_content))
+        assert [row.get('sku') for row in data] == ['bled-kyber', 'tie-bomber']
+        assert data[0].get('total') == 455.65
+
+        resp = c.get('/api/transactions/?stream=true&state=Nowhere')
+        assert json.loads(b''.join(resp.streaming_content)) == []
+
+    def test_get_bulk_formats(self):
+        c = Client(HTTP_USER_AGENT='Mozilla/5.0')
+        self.add_x_wing()
+
+        resp = c.get('/api/transactions/?format=ndjson&type=Order')
+        assert resp.streaming
+        assert resp['Content-Type'].startswith('application/x-ndjson')
+        lines = b''.join(resp.streaming_content).decode('utf-8').splitlines()
+        rows = [json.loads(line) for line in lines]
+        assert [row.get('sku') for row in rows] == ['bled-kyber', 'x-wing']
+        assert rows[0].get('total') == 455.65
+
+        resp = c.get('/api/transactions/?start=Nov 1, 2020 12:23:30 AM PDT', HTTP_ACCEPT='text/csv')
+        assert resp.streaming
+        rows = list(csv.DictReader(io.StringIO(b''.join(resp.streaming_content).decode('utf-8'))))
+        assert [row.get('sku') for row in rows] == ['bled-kyber', 'tie-bomber', 'x-wing']
+        assert rows[1].get('total') == '789.01'
+        assert rows[0].get('date_time') == '2020-11-01T07:23:30+00:00'
+
+        # a JSON response cached for the same filters isn't served in place of the stream
+        c.get('/api/transactions/?type=Order')
+        resp = c.get('/api/transactions/?type=Order', HTTP_ACCEPT='text/csv')
+        assert resp.streaming
+
+        resp = c.get('/api/transactions/?format=csv&state=Nowhere')
+        assert b''.join(resp.streaming_content).decode('utf-8').splitlines()[0].startswith('id,date_time')
+
+        resp = c.get('/api/transactions/?format=csv&start=garbage')
+        assert resp.status_code == 400
+        assert b'error' in resp.content
+
+        resp = c.get('/api/transactions/?format=xml')
+        assert resp.status_code == 404
+
+    @skipUnless(pa is not None, 'pyarrow is not installed')
+    def test_get_arrow(self):
+        c = Client(HTTP_USER_AGENT='Mozilla/5.0')
+        resp = c.get('/api/transactions/', HTTP_ACCEPT='application/vnd.apache.arrow.stream')
+        table = pa.ipc.open_stream(b''.join(resp.streaming_content)).read_all()
+        assert table.column('sku').to_pylist() == ['bled-kyber', 'tie-bomber']
+        assert table.column('total').to_pylist() == [Decimal('455.65'), Decimal('789.01')]
+        assert table.schema.field('date_time').type == pa.timestamp('us', tz='UTC')
+
+    def test_response_cache(self):
+        c = Client(HTTP_USER_AGENT='Mozilla/5.0')
+        get_cache().clear()
+
+        resp = c.get('/api/transactions/stats/?start=Nov 1, 2020 12:23:30 AM PDT&skus=bled-kyber,tie-bomber,x-wing')
+        assert resp['X-Cache'] == 'MISS'
+        resp = c.get('/api/transactions/stats/?skus=x-wing,tie-bomber,bled-kyber&start=Nov 1, 2020 12:23:30 AM PDT')
+        assert resp['X-Cache'] == 'HIT'
+        assert resp.data.get('count') == 2
+
+        resp = c.get('/api/transactions/?start=Nov 1, 2020 12:23:30 AM PDT')
+        assert resp['X-Cache'] == 'MISS'
+        resp = c.get('/api/transactions/?start=Nov 1, 2020 12:23:30 AM PDT')
+        assert resp['X-Cache'] == 'HIT'
+        assert len(resp.data) == 2
+
+        # saving a transaction or importing a report invalidates everything cached before it
+        self.add_x_wing()
+        resp = c.get('/api/transactions/stats/?start=Nov 1, 2020 12:23:30 AM PDT&skus=bled-kyber,tie-bomber,x-wing')
+        assert resp['X-Cache'] == 'MISS'
+        assert resp.data.get('count') == 3
+
+        import_rows([{'date/time': 'Dec 3, 2020 12:23:30 AM PST', 'type': 'Order', 'sku': 'x-wing', 'total': '1'}])
+        resp = c.get('/api/transactions/stats/?start=Nov 1, 2020 12:23:30 AM PDT&skus=bled-kyber,tie-bomber,x-wing')
+        assert resp['X-Cache'] == 'MISS'
+        assert resp.data.get('count') == 4
+
+        # stream=false isn't streamed and is cached like any other list
+        c.get('/api/transactions/?type=Order&stream=false')
+        assert c.get('/api/transactions/?type=Order&stream=false')['X-Cache'] == 'HIT'
+
+        with override_settings(TRANSACTIONS_CACHE_MAX_ROWS=1):
+            c.get('/api/transactions/?type=Order')
+            resp = c.get('/api/transactions/?type=Order')
+            assert resp['X-Cache'] == 'MISS'
+
+
+class TransactionsImport(TestCase):
+    CSV_REPORT = (
+        'date/time,type,order id,sku,description,quantity,order city,order state,order postal,total\n'
+        '"Nov 1, 2020 12:01:23 AM PDT",Order,113-9202030-9933827,N1N-ELDERBERRY-GUMMIES-FBA,'
+        '"Elderberry Gummies, Vitamin C & Zinc",1,MONROE,LA,71203-9757,11.09\n'
+        '"Nov 1, 2020 1:36:05 AM PST",FBA Inventory Fee,pAO6PNv6Ec,,FBA Removal Order: Disposal Fee,,,,,-0.75\n'
+        ',Order,113-0000000-0000000,N1N-TART-CHERRY-FBA,Tart Cherry,1,SAN DIEGO,CA,92126-4800,38.61\n'
+        '"Nov 1, 2020 12:27:30 AM PST",Order,112-4677698-5943468,N1N-BERBERINE-FBA,Berberine,1,,,,not-a-total\n'
+    )
+
+    def setUp(self):
+        self.media_root = tempfile.TemporaryDirectory()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root.name, TRANSACTIONS_IMPORT_RUNNER='worker')
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        self.media_root.cleanup()
+
+    def post_and_import(self, **kwargs):
+        c = Client(HTTP_USER_AGENT='Mozilla/5.0')
+        resp = c.post('/api/transactions/', **kwargs)
+        assert resp.status_code == 202
+        assert resp.data.get('status') == 'queued'
+
+        call_command('process_imports', '--once', stdout=io.StringIO())
+        resp = c.get(resp.data.get('url'))
+        assert resp.status_code == 200
+        return resp.data
+
+    def test_post_csv_body(self):
+        data = self.post_and_import(data=self.CSV_REPORT, content_type='text/csv')
+        assert data.get('status') == 'succeeded'
+        assert data.get('rows_processed') == 4
+        assert data.get('inserted') == 2
+        assert data.get('rejected') == 2
+        assert data.get('errors') == ['row 3: missing date/time', "row 4: invalid total 'not-a-total'"]
+        assert FBATransaction.objects.count() == 2
+
+        gummies = FBATransaction.objects.get(product__sku='N1N-ELDERBERRY-GUMMIES-FBA')
+        assert gummies.description == 'Elderberry Gummies, Vitamin C & Zinc'
+        assert gummies.quantity == 1
+        assert str(gummies.total) == '11.09'
+
+        # the stored report is removed once imported
+        assert not ImportJob.objects.get(id=data.get('id')).file
+
+    def test_post_csv_upload(self):
+        upload = SimpleUploadedFile('report.csv', self.CSV_REPORT.encode('utf-8'), content_type='text/csv')
+        data = self.post_and_import(data={'file': upload})
+        assert data.get('inserted') == 2
+        assert FBATransaction.objects.filter(order_id='pAO6PNv6Ec').exists()
+
+    def test_post_json(self):
+        rows = [{
+            'date/time': 'Nov 1, 2020 12:01:23 AM PDT',
+            'type': 'Order',
+            'order id': '113-9202030-9933827',
+            'sku': 'N1N-ELDERBERRY-GUMMIES-FBA',
+            'quantity': '1',
+            'total': '11.09',
+        }]
+        data = self.post_and_import(data=rows, content_type='application/json')
+        assert data.get('inserted') == 1
+
+    def test_failed_import(self):
+        upload = SimpleUploadedFile('report.json', b'{"not": "a list"}', content_type='application/json')
+        with self.assertLogs('transactions.jobs', 'ERROR'):
+            data = self.post_and_import(data={'file': upload})
+        assert data.get('status') == 'failed'
+        assert data.get('error') == 'expected a JSON array of transactions'
+
+    def test_inline_runner(self):
+        c = Client(HTTP_USER_AGENT='Mozilla/5.0')
+        with override_settings(TRANSACTIONS_IMPORT_RUNNER='inline'):
+            resp = c.post('/api/transactions/', data=self.CSV_REPORT, content_type='text/csv')
+        assert resp.status_code == 202
+        assert resp.data.get('status') == 'succeeded'
+        assert resp.data.get('inserted') == 2
+
+        resp = c.get('/api/transactions/imports/12345/')
+        assert resp.status_code == 404
+
+    def test_reimport_skips_duplicates(self):
+        with open(settings.BASE_DIR / 'example_transactions.csv', 'rb') as report:
+            lines = report.readlines()
+        first_half = lines[:len(lines) // 2]
+
+        result = import_rows(iter_csv_rows(first_half))
+        assert result.get('inserted') == len(first_half) - 1
+        assert result.get('duplicates') == 0
+
+        result = import_rows(iter_csv_rows(lines), batch_size=700)
+        assert result.get('accepted') == len(lines) - 1
+        assert result.get('inserted') == len(lines) - len(first_half)
+        assert result.get('duplicates') == len(first_half) - 1
+
+        # identical rows within a report are separate transactions and are kept
+        assert FBATransaction.objects.count() == len(lines) - 1
+        assert FBATransaction.objects.filter(order_id='113-8523497-1797039').count() > 1
+
+        result = import_rows(iter_csv_rows(lines))
+        assert result.get('inserted') == 0
+        assert FBATransactionDailyRollup.objects.aggregate(Sum('count')).get('count__sum') == len(lines) - 1
+
+    def test_requeue_running(self):
+        c = Client(HTTP_USER_AGENT='Mozilla/5.0')
+        resp = c.post('/api/transactions/', data=self.CSV_REPORT, content_type='text/csv')
+        # the worker stopped while the job was running
+        ImportJob.objects.filter(id=resp.data.get('id')).update(status=ImportJob.RUNNING)
+
+        call_command('process_imports', '--once', stdout=io.StringIO())
+        assert c.get(resp.data.get('url')).data.get('status') == 'running'
+
+        out = io.StringIO()
+        call_command('process_imports', '--once', '--requeue-running', stdout=out)
+        assert 'Queued 1 interrupted jobs again' in out.getvalue()
+        data = c.get(resp.data.get('url')).data
+        assert data.get('status') == 'succeeded'
+        assert data.get('inserted') == 2
+
+    def test_conflicting_insert(self):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "CREATE TEMP TRIGGER fba_race BEFORE INSERT ON fba_transactions WHEN NEW.order_id = '900' BEGIN "
+                "INSERT INTO fba_transactions (id, date_time, type, order_id, total, fingerprint) "
+                "VALUES (-1, NEW.date_time, NEW.type, 'meanwhile', NEW.total, NEW.fingerprint); END")
+        try:
+            # the chunk fails instead of counting and rolling up a row that wasn't stored
+            with self.assertRaises(IntegrityError):
+                import_rows([{'date/time': 'Nov 2, 2020 10:00:00 AM PST', 'type': 'Order', 'order id': order_id,
+                              'total': '1.00'} for order_id in ('900', '901')])
+        finally:
+            with connection.cursor() as cursor:
+                cursor.execute('DROP TRIGGER fba_race')
+        assert not FBATransaction.objects.exists()
+        assert not FBATransactionDailyRollup.objects.exists()
+
+    def test_import_batches(self):
+        rows = iter_csv_rows(io.BytesIO(self.CSV_REPORT.encode('utf-8')))
+        result = import_rows(rows, batch_size=1)
+        assert result.get('accepted') == 2
+        assert result.get('rejected') == 2
+        assert FBATransaction.objects.count() == 2
+
+
+class BulkImport(TestCase):
+    ROLLUP_FIELDS = ('day', 'sku', 'order_type', 'order_state', 'count', 'total_sum', 'total_min', 'total_max')
+
+    def stored(self):
+        return sorted(FBATransaction.objects.values_list(
+            'date_time', 'order_type', 'order_id', 'product__sku', 'product__description', 'quantity',
+            'location__city', 'location__state', 'location__postal', 'total', 'fingerprint'), key=str)
+
+    def rollups(self):
+        return sorted(FBATransactionDailyRollup.objects.values_list(*self.ROLLUP_FIELDS), key=str)
+
+    def test_import_command(self):
+        out = io.StringIO()
+        call_command('import_transactions', str(settings.BASE_DIR / 'example_transactions.csv'), '--workers', '2',
+                     '--chunk-size', '1000', '--commit-size', '3000', stdout=out)
+        assert FBATransaction.objects.count() == 7317
+        assert 'rows/sec' in out.getvalue()
+        assert 'Imported 7317 rows' in out.getvalue()
+        assert '7317 inserted' in out.getvalue()
+
+        bulk_loaded = self.stored()
+        bulk_rollups = self.rollups()
+        rebuild_rollups()
+        assert self.rollups() == bulk_rollups
+
+        # the same rows, fingerprints and rollups as an import through the API
+        FBATransaction.objects.all().delete()
+        FBATransactionDailyRollup.objects.all().delete()
+        with open(settings.BASE_DIR / 'example_transactions.csv', 'rb') as report:
+            import_rows(iter_csv_rows(report))
+        assert self.stored() == bulk_loaded
+        assert self.rollups() == bulk_rollups
+
+        result = bulk_import([str(settings.BASE_DIR / 'example_transactions.csv')], chunk_size=500)
+        assert result.get('inserted') == 0
+        assert result.get('duplicates') == 7317
+
+    def test_resumes_partial_import(self):
+        with open(settings.BASE_DIR / 'example_transactions.csv', 'rb') as report:
+            lines = report.readlines()
+        import_rows(iter_csv_rows(lines[:1000]))
+
+        result = bulk_import([str(settings.BASE_DIR / 'example_transactions.csv')], chunk_size=700)
+        assert result.get('rows') == len(lines) - 1
+        assert result.get('inserted') == len(lines) - 1000
+        assert result.get('duplicates') == 999
+        assert FBATransaction.objects.count() == len(lines) - 1
+
+    def test_json_and_rejected_rows(self):
+        with tempfile.TemporaryDirectory() as directory:
+            csv_path = f'{directory}/report.csv'
+            with open(csv_path, 'w') as report:
+                report.write(TransactionsImport.CSV_REPORT)
+            json_path = f'{directory}/report.json'
+            with open(json_path, 'w') as report:
+                json.dump([{'date/time': 'Nov 2, 2020 10:00:00 AM PST', 'type': 'Refund', 'order id': '1',
+                            'sku': 'N1N-TART-CHERRY-FBA', 'description': 'Tart Cherry', 'quantity': '1',
+                            'order city': 'SAN DIEGO', 'order state': 'CA', 'order postal': '92126-4800',
+                            'total': '-38.61'}, 'not a row'], report)
+
+            result = bulk_import([csv_path, json_path], workers=2, chunk_size=1)
+
+        assert result.get('rows') == 6
+        assert result.get('inserted') == 3
+        assert result.get('rejected') == 3
+        assert len(result.get('errors')) == 3
+        assert result.get('errors')[0].endswith('row 3: missing date/time')
+        assert Product.objects.filter(sku='N1N-TART-CHERRY-FBA').count() == 1
+        assert FBATransaction.objects.get(order_type='Refund').location.city == 'SAN DIEGO'
+
+
+    def test_rows_stored_meanwhile(self):
+        # a row with the same fingerprint is stored between the lookup of the existing fingerprints and the insert,
+        # as another process would
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "CREATE TEMP TRIGGER fba_race BEFORE INSERT ON fba_transactions WHEN NEW.order_id = '900' BEGIN "
+                "INSERT INTO fba_transactions (id, date_time, type, order_id, total, fingerprint) "
+                "VALUES (-1, NEW.date_time, NEW.type, 'meanwhile', NEW.total, NEW.fingerprint); END")
+        try:
+            with tempfile.TemporaryDirectory() as directory:
+                path = f'{directory}/report.json'
+                with open(path, 'w') as report:
+                    json.dump([{'date/time': 'Nov 2, 2020 10:00:00 AM PST', 'type': 'Order', 'order id': order_id,
+                                'total': '1.00'} for order_id in ('900', '901')], report)
+                result = bulk_import([path])
+        finally:
+            with connection.cursor() as cursor:
+                cursor.execute('DROP TRIGGER fba_race')
+
+        assert result.get('inserted') == 1
+        assert result.get('duplicates') == 1
+        assert sorted(FBATransaction.objects.values_list('order_id', flat=True)) == ['901', 'meanwhile']
+        # the other import rolls up its own row
+        assert FBATransactionDailyRollup.objects.aggregate(Sum('count')).get('count__sum') == 1
+
+
+class BulkImportIndexes(TransactionTestCase):
+    databases = {'default', 'replica'}
+
+    def test_drop_indexes(self):
+        call_command('import_transactions', str(settings.BASE_DIR / 'example_transactions.csv'), '--workers', '1',
+                     '--drop-indexes', stdout=io.StringIO())
+        assert FBATransaction.objects.count() == 7317
+
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(cursor, FBATransaction._meta.db_table)
+        for index in FBATransaction._meta.indexes:
+            assert index.name in constraints
+
+
+class DatabaseRouting(TransactionTestCase):
+    databases = {'default', 'replica'}
+
+    def test_reads_go_to_replica(self):
+        router = TransactionsRouter()
+        assert router.db_for_read(FBATransaction) == 'replica'
+        assert router.db_for_write(FBATransaction) == 'default'
+        with transaction.atomic():
+            assert router.db_for_read(FBATransaction) == 'default'
+        assert not router.allow_migrate('replica', 'transactions')
+
+        FBATransaction(date_time=parse_timestamp('Nov 1, 2020 12:01:23 AM PDT'), order_type='Order',
+                       sku='N1N-TART-CHERRY-FBA', total=Decimal('38.61')).save()
+        assert FBATransaction.objects.all().db == 'replica'
+        assert FBATransaction.objects.get().sku == 'N1N-TART-CHERRY-FBA'
+
+        c = Client(HTTP_USER_AGENT='Mozilla/5.0')
+        resp = c.get('/api/transactions/stats/', {'min_total': '0'})
+        assert resp.data.get('count') == 1
+
+    def test_concurrent_imports(self):
+        with open(settings.BASE_DIR / 'example_transactions.csv', newline='', encoding='utf-8-sig') as report:
+            rows = list(csv.DictReader(report))
+        results = [None, None]
+
+        def run(index, part):
+            try:
+                results[index] = import_rows(part, batch_size=500)
+            finally:
+                connections.close_all()
+
+        # two import jobs at once take turns writing their chunks instead of failing with "database is locked"
+        threads = [threading.Thread(target=run, args=(index, part))
+                   for index, part in enumerate((rows[:len(rows) // 2], rows[len(rows) // 2:]))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert sum(result.get('accepted') for result in results) == 7317
+        assert FBATransaction.objects.count() == sum(result.get('inserted') for result in results) == 7317
+
+    def test_resume_import_jobs(self):
+        report = TransactionsImport.CSV_REPORT.encode('utf-8')
+        with tempfile.TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root):
+            with override_settings(TRANSACTIONS_IMPORT_RUNNER='worker'):
+                queued = create_import_job(report, 'queued.csv')
+                running = create_import_job(report, 'running.csv')
+                assert resume_import_jobs() == []
+            # the web process was restarted while one job was queued and another running
+            ImportJob.objects.filter(id=running.id).update(status=ImportJob.RUNNING)
+
+            assert resume_import_jobs() == [queued.id, running.id]
+            deadline = time.monotonic() + 30
+            while ImportJob.objects.exclude(status=ImportJob.SUCCEEDED).exists() and time.monotonic() < deadline:
+                time.sleep(0.05)
+        assert set(ImportJob.objects.values_list('status', flat=True)) == {ImportJob.SUCCEEDED}
+        assert FBATransaction.objects.count() == 2
+
+    def test_concurrent_bulk_import(self):
+        with open(settings.BASE_DIR / 'example_transactions.csv', 'rb') as report:
+            lines = report.readlines()
+        results = {}
+
+        def run(name, load):
+            try:
+                results[name] = load()
+            finally:
+                connections.close_all()
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = f'{directory}/report.csv'
+            with open(path, 'wb') as report:
+                report.writelines(lines[:len(lines) // 2])
+            # a bulk load beside an upload imported by a thread of the same process
+            threads = [
+                threading.Thread(target=run, args=('bulk', lambda: bulk_import([path], chunk_size=500,
+                                                                               commit_size=500))),
+                threading.Thread(target=run, args=('api', lambda: import_rows(iter_csv_rows(lines), batch_size=500))),
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        assert results['bulk'].get('inserted') + results['api'].get('inserted') == 7317
+        assert FBATransaction.objects.count() == 7317
+        assert FBATransactionDailyRollup.objects.aggregate(Sum('count')).get('count__sum') == 7317
+
+    def test_shared_generation(self):
+        c = Client(HTTP_USER_AGENT='Mozilla/5.0')
+        row = {'date/time': 'Dec 3, 2020 12:23:30 AM PST', 'type': 'Order', 'sku': 'x-wing', 'total': '1'}
+        import_rows([row])
+        c.get('/api/transactions/stats/', {'skus': 'x-wing'})
+        assert c.get('/api/transactions/stats/', {'skus': 'x-wing'})['X-Cache'] == 'HIT'
+
+        def run():
+            # another process, with a cache of its own
+            other_cache = {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'other-process'}
+            try:
+                with override_settings(CACHES={**settings.CACHES, 'transactions': other_cache}):
+                    import_rows([{**row, 'order id': '2'}])
+            finally:
+                connections.close_all()
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        thread.join()
+        resp = c.get('/api/transactions/stats/', {'skus': 'x-wing'})
+        assert resp['X-Cache'] == 'MISS'
+        assert resp.data.get('count') == 2
+
+    def test_pragmas(self):
+        with connections['replica'].cursor() as cursor:
+            assert cursor.execute('PRAGMA query_only').fetchone()[0] == 1
+            assert cursor.execute('PRAGMA busy_timeout').fetchone()[0] == 5000
+            try:
+                cursor.execute('DELETE FROM fba_transactions')
+                assert False, 'replica accepted a write'
+            except OperationalError:
+                pass
+
+        with connections['default'].cursor() as cursor:
+            assert cursor.execute('PRAGMA query_only').fetchone()[0] == 0
+            # NORMAL
+            assert cursor.execute('PRAGMA synchronous').fetchone()[0] == 1
+
+        with tempfile.TemporaryDirectory() as directory:
+            settings_dict = dict(connections['default'].settings_dict, NAME=f'{directory}/wal.sqlite3')
+            wrapper = connections['default'].__class__(settings_dict, alias='wal_check')
+            try:
+                with wrapper.cursor() as cursor:
+                    assert cursor.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+            finally:
+                wrapper.close()
+
+
+class TransactionsIndexes(TestCase):
+    FILTERS = {
+        'type': 'Order',
+        'city': 'Mos Espa',
+        'state': 'Core',
+        'postal': 'Executor',
+        'skus': 'bled-kyber,tie-bomber',
+    }
+    DATE_FILTERS = [
+        {},
+        {'start': 'Nov 1, 2020 12:23:30 AM PDT'},
+        {'start': 'Nov 1, 2020 12:23:30 AM PDT', 'end': 'Nov 25, 2020 12:23:30 AM PDT'},
+    ]
+    INDEX_SEARCHES = ('SEARCH fba_transactions USING INDEX ', 'SEARCH fba_transactions USING COVERING INDEX ')
+
+    def query_plan(self, query_dict):
+        sql, params = do_filtering(query_dict=query_dict).query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            return [row[-1] for row in cursor.fetchall()]
+
+    def test_filters_use_index(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('EXPLAIN QUERY PLAN is SQLite specific')
+
+        for size in range(len(self.FILTERS) + 1):
+            for filter_names in itertools.combinations(self.FILTERS, size):
+                for date_filter in self.DATE_FILTERS:
+                    query_dict = {name: self.FILTERS[name] for name in filter_names}
+                    query_dict.update(date_filter)
+                    if not query_dict:
+                        continue
+                    plan = self.query_plan(query_dict)
+                    # the lookup tables are searched by their own indexes, what matters is how fba_transactions is read
+                    transactions_plan = [line for line in plan if line.split()[1:2] == ['fba_transactions']]
+                    assert len(transactions_plan) == 1, (query_dict, plan)
+                    assert transactions_plan[0].startswith(self.INDEX_SEARCHES), (query_dict, plan)
+
+    def test_large_value_sets_use_index(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('EXPLAIN QUERY PLAN is SQLite specific')
+
+        skus = ','.join(f'sku-{number}' for number in range(5000))
+        sql, params = do_filtering(query_dict={'skus': skus}).query.sql_with_params()
+        assert len(params) == 1  # one JSON array instead of 5000 bound parameters
+        plan = self.query_plan({'skus': skus})
+        assert 'SEARCH fba_transactions USING INDEX fba_product_date_time_idx (product_id=?)' in plan, plan
+
+
+class TimestampParsing(TestCase):
+    def utc(self, *args):
+        return datetime.datetime(*args, tzinfo=datetime.timezone.utc)
+
+    def test_parse(self):
+        assert parse_timestamp('Nov 1, 2020 12:01:23 AM PDT') == self.utc(2020, 11, 1, 7, 1, 23)
+        assert parse_timestamp('Nov 16, 2020 11:51:08 PM PST') == self.utc(2020, 11, 17, 7, 51, 8)
+        assert parse_timestamp('Nov 16, 2020 12:00:00 PM PST') == self.utc(2020, 11, 16, 20, 0, 0)
+        assert parse_timestamp('Jan 5, 2021 9:15:00 AM EST') == self.utc(2021, 1, 5, 14, 15, 0)
+        assert parse_timestamp('Nov 1, 2020 12:01:23 AM PDT') is parse_timestamp('Nov 1, 2020 12:01:23 AM PDT')
+
+        for invalid in ['Nov 1 2020', 'Foo 1, 2020 12:01:23 AM PDT', 'Nov 1, 2020 13:01:23 AM PDT',
+                        'Nov 31, 2020 12:01:23 AM PDT', 'Nov 1, 2020 12:01:23 AM XYZ']:
+            with self.assertRaises(ValueError):
+                parse_timestamp(invalid)
+
+    def test_dst_boundaries(self):
+        # Spring forward, 2:00 AM PST becomes 3:00 AM PDT so these are one second apart
+        spring_before = parse_timestamp('Mar 8, 2020 1:59:59 AM PST')
+        spring_after = parse_timestamp('Mar 8, 2020 3:00:00 AM PDT')
+        assert spring_before == self.utc(2020, 3, 8, 9, 59, 59)
+        assert (spring_after - spring_before).total_seconds() == 1
+
+        # Fall back, 1:30 AM happens twice, an hour apart
+        fall_first = parse_timestamp('Nov 1, 2020 1:30:00 AM PDT')
+        fall_second = parse_timestamp('Nov 1, 2020 1:30:00 AM PST')
+        assert fall_first == self.utc(2020, 11, 1, 8, 30, 0)
+        assert (fall_second - fall_first).total_seconds() == 3600
+
+    def test_parse_batch(self):
+        column = ['Nov 1, 2020 12:01:23 AM PDT', 'garbage', 'Nov 1, 2020 12:01:23 AM PDT']
+        parsed = parse_timestamps(column, strict=False)
+        assert parsed == [self.utc(2020, 11, 1, 7, 1, 23), None, self.utc(2020, 11, 1, 7, 1, 23)]
+        with self.assertRaises(ValueError):
+            parse_timestamps(column)
+
+    def test_legacy_pdt_timestamps(self):
+        # as the original parser stored them, PDT read as -0900
+        stored = [
+            (1, self.utc(2020, 10, 31, 18, 0, 0)),  # Oct 31 9:00 AM PDT
+            (2, self.utc(2020, 11, 1, 9, 1, 23)),  # 12:01 AM PDT
+            (3, self.utc(2020, 11, 1, 10, 55, 50)),  # 1:55 AM PDT
+            (4, self.utc(2020, 11, 1, 9, 7, 9)),  # 1:07 AM PST, time goes backwards
+            (5, self.utc(2020, 11, 1, 10, 13, 22)),  # 2:13 AM PST
+            (6, self.utc(2020, 11, 1, 11, 0, 0)),  # 3:00 AM PST
+            (7, self.utc(2020, 3, 8, 9, 59, 59)),  # Mar 8 1:59 AM PST
+            (8, self.utc(2020, 3, 8, 12, 0, 0)),  # Mar 8 3:00 AM PDT
+            (9, self.utc(2020, 11, 1, 9, 30, 0)),  # a second report, 12:30 AM PDT or 1:30 AM PST
+            (10, self.utc(2020, 11, 1, 9, 45, 0)),
+            (11, self.utc(2020, 11, 2, 8, 0, 0)),  # Nov 2 12:00 AM PST
+        ]
+        assert legacy_pdt_timestamps(stored) == ([1, 2, 3, 8], [9, 10])
+        assert legacy_pdt_timestamps([]) == ([], [])
+
+
+class TransactionsRollups(TestCase):
+    def setUp(self):
+        with open(settings.BASE_DIR / 'example_transactions.csv', 'rb') as report:
+            import_rows(iter_csv_rows(report), batch_size=500)
+
+    def assert_stats_match(self, query_dict):
+        filters = parse_filters(query_dict)
+        rollups = rollup_query(filters)
+        assert rollups is not None, query_dict
+        raw = compute_stats(filter_transactions(filters))
+        rolled_up = compute_stats(filter_transactions(filters), rollups=rollups)
+        for name in ('count', 'summed', 'min', 'max', 'median'):
+            assert raw.get(name) == rolled_up.get(name), (query_dict, name, raw, rolled_up)
+        if raw.get('count'):
+            assert abs(raw.get('mean') - rolled_up.get('mean')) < Decimal('0.000001')
+
+    def test_rollups_match_raw(self):
+        self.assert_stats_match({})
+        self.assert_stats_match({'type': 'Order'})
+        self.assert_stats_match({'state': 'CA', 'type': 'Refund'})
+        self.assert_stats_match({'skus': 'N1N-ELDERBERRY-GUMMIES-FBA,N1N-TART-CHERRY-FBA'})
+        self.assert_stats_match({'start': 'Nov 3, 2020 4:00:00 PM PST', 'end': 'Nov 10, 2020 3:59:59 PM PST'})
+        self.assert_stats_match({'start': 'Nov 20, 2020 4:00:00 PM PST', 'state': 'NY'})
+        self.assert_stats_match({'type': 'Order,Refund', 'state': 'CA,NY,TX'})
+        skus = Product.objects.exclude(sku=None).values_list('sku', flat=True)
+        self.assert_stats_match({'skus': ','.join(skus)})
+
+    def test_unaligned_filters_use_raw_table(self):
+        assert rollup_query(parse_filters({'city': 'New York'})) is None
+        assert rollup_query(parse_filters({'start': 'Nov 3, 2020 4:00:01 PM PST'})) is None
+        assert rollup_query(parse_filters({'end': 'Nov 3, 2020 4:00:00 PM PST'})) is None
+
+    def test_rebuild(self):
+        incremental = sorted(FBATransactionDailyRollup.objects.values_list(
+            'day', 'sku', 'order_type', 'order_state', 'count', 'total_sum', 'total_sum_squares', 'total_min',
+            'total_max', 'total_sketch'), key=str)
+        generation = get_generation()
+        rebuild_rollups()
+        # stats cached from the old rollups aren't served again
+        assert get_generation() != generation
+        rebuilt = sorted(FBATransactionDailyRollup.objects.values_list(
+            'day', 'sku', 'order_type', 'order_state', 'count', 'total_sum', 'total_sum_squares', 'total_min',
+            'total_max', 'total_sketch'), key=str)
+        assert incremental == rebuilt
+
+    def test_saved_and_deleted(self):
+        fields = ('day', 'sku', 'order_type', 'order_state', 'count', 'total_sum', 'total_sum_squares', 'total_min',
+                  'total_max', 'total_sketch')
+        FBATransaction(date_time=convert_string_to_datetime('Nov 4, 2020 10:00:00 AM PST'), order_type='Order',
+                       sku='N1N-TART-CHERRY-FBA', order_state='CA', total='1234.5').save()
+
+        # moved to another day and type, from the min of its rollup row
+        entry = FBATransaction.objects.filter(order_type='Order').order_by('total', 'id').first()
+        entry.date_time = convert_string_to_datetime('Nov 5, 2020 10:00:00 AM PST')
+        entry.order_type = 'Adjustment'
+        entry.total = 3.3
+        entry.save()
+
+        FBATransaction.objects.filter(order_type='Refund').order_by('-total')[0].delete()
+        FBATransaction.objects.filter(product__sku='N1N-ELDERBERRY-GUMMIES-FBA').delete()
+
+        incremental = sorted(FBATransactionDailyRollup.objects.values_list(*fields), key=str)
+        rebuild_rollups()
+        assert incremental == sorted(FBATransactionDailyRollup.objects.values_list(*fields), key=str)
+        self.assert_stats_match({})
+        self.assert_stats_match({'type': 'Adjustment'})
+
+    def test_approx_percentiles(self):
+        percentiles = [Decimal(pct) for pct in ('1', '10', '25', '75', '90', '99')]
+        for query_dict in ({}, {'type': 'Order'}, {'state': 'CA,NY,TX'}, {'type': 'Refund'},
+                           {'start': 'Nov 3, 2020 4:00:00 PM PST', 'end': 'Nov 10, 2020 3:59:59 PM PST'}):
+            filters = parse_filters(query_dict)
+            exact = compute_stats(filter_transactions(filters), percentiles=percentiles)
+            approx = compute_stats(filter_transactions(filters), percentiles=percentiles,
+                                   rollups=rollup_query(filters), approx=True)
+            assert approx.get('error_bound') == RELATIVE_ACCURACY
+            assert approx.get('count') == exact.get('count')
+            # merged in the database, the same as merging the stored sketches one by one
+            rollups = rollup_query(filters)
+            assert rollup_sketch(rollups).to_json() == merge_sketches(
+                rollups.values_list('total_sketch', flat=True)).to_json()
+            estimates = [(exact.get('median'), approx.get('median'))] + [
+                (exact['percentiles'][str(pct)], approx['percentiles'][str(pct)]) for pct in percentiles]
+            for expected, estimate in estimates:
+                # within the relative error, plus rounding to cents
+                assert abs(estimate - expected) <= abs(expected) * Decimal(RELATIVE_ACCURACY) + Decimal('0.01'), \
+                    (query_dict, expected, estimate)
+
+    def test_get_approx(self):
+        c = Client(HTTP_USER_AGENT='Mozilla/5.0')
+        resp = c.get('/api/transactions/stats/', {'type': 'Order', 'approx': 'true', 'percentiles': '90'})
+        assert resp.status_code == 200
+        assert resp.data.get('error_bound') == RELATIVE_ACCURACY
+        assert set(resp.data.get('percentiles')) == {'90'}
+
+        resp = c.get('/api/transactions/stats/', {'city': 'SAN DIEGO', 'approx': 'true', 'max_error': '0.01'})
+        assert resp.status_code == 200
+        assert resp.data.get('error_bound') == 0
+        assert resp.data.get('median') == compute_stats(filter_transactions({'city': 'SAN DIEGO'})).get('median')
+
+        resp = c.get('/api/transactions/stats/', {'approx': 'true', 'max_error': '0.001'})
+        assert resp.status_code == 400
+        resp = c.get('/api/transactions/stats/', {'approx': 'true', 'group_by': 'state'})
+        assert resp.status_code == 400
+        resp = c.get('/api/transactions/stats/', {'max_error': '0.01'})
+        assert resp.status_code == 400
+
+    def test_sketch_merge(self):
+        totals = [Decimal(value) / 100 for value in range(-5000, 100000, 37)] + [Decimal(0)] * 5
+        merged = QuantileSketch.of(totals[::2])
+        merged.merge(QuantileSketch.from_json(QuantileSketch.of(totals[1::2]).to_json()))
+        assert merged.to_json() == QuantileSketch.of(totals).to_json()
+        assert len(merged) == len(totals)
+
+        ordered = sorted(totals)
+        for rank in (0, 1, 100, len(ordered) // 2, len(ordered) - 1):
+            assert abs(merged.value_at_rank(rank) - float(ordered[rank])) <= abs(float(ordered[rank])) * RELATIVE_ACCURACY
+        assert QuantileSketch().quantile(50) is None
+
+
+class MonthArchive(TestCase):
+    QUERIES = (
+        {},
+        {'type': 'Order'},
+        {'state': 'CA', 'min_total': '10'},
+        {'start': 'Nov 3, 2020 4:00:00 PM PST', 'end': 'Nov 10, 2020 3:59:59 PM PST'},
+        {'start': 'Nov 20, 2020 4:00:00 PM PST', 'end': 'Dec 31, 2020 11:59:59 PM PST', 'type': 'Order,Refund'},
+        {'start': 'Dec 1, 2020 12:00:00 AM PST'},
+    )
+
+    def setUp(self):
+        with open(settings.BASE_DIR / 'example_transactions.csv', 'rb') as report:
+            import_rows(iter_csv_rows(report), batch_size=2000)
+        for order_id, day in (('900', 'Dec 2, 2020'), ('901', 'Dec 24, 2020')):
+            import_rows([{'date/time': f'{day} 10:00:00 AM PST', 'type': 'Order', 'order id': order_id,
+                          'sku': 'N1N-TART-CHERRY-FBA', 'quantity': '1', 'order state': 'CA', 'total': '38.61'}])
+
+    def responses(self):
+        c = Client(HTTP_USER_AGENT='Mozilla/5.0')
+        with override_settings(TRANSACTIONS_CACHE_ENABLED=False):
+            # unpaginated lists come in no particular order
+            return [(sorted(c.get('/api/transactions/', query).json(), key=lambda row: row['id']),
+                     c.get('/api/transactions/stats/', query).json(),
+                     c.get('/api/transactions/timeseries/', query).json()) for query in self.QUERIES]
+
+    def test_archive_month(self):
+        before = self.responses()
+        rollups = sorted(FBATransactionDailyRollup.objects.values_list('day', 'sku', 'order_type', 'count'), key=str)
+
+        out = io.StringIO()
+        call_command('archive_months', '--before', '2020-12', stdout=out)
+        assert '2020-11: 7317 transactions archived' in out.getvalue()
+        assert FBATransaction.objects.count() == 2
+        assert ArchivedTransaction.objects.count() == 7317
+        summary = ArchivedMonth.objects.get()
+        assert summary.month == datetime.date(2020, 11, 1)
+        assert summary.total_sum == compute_stats(ArchivedTransaction.objects.all()).get('summed')
+
+        # the same answers, from the partitions the range overlaps
+        assert self.responses() == before
+        assert partition_model() is TransactionHistory
+        assert partition_model(*map(convert_string_to_datetime, self.QUERIES[3].values())) is ArchivedTransaction
+        assert partition_model(convert_string_to_datetime('Dec 1, 2020 12:00:00 AM PST')) is FBATransaction
+
+        rebuild_rollups()
+        assert sorted(FBATransactionDailyRollup.objects.values_list('day', 'sku', 'order_type', 'count'),
+                      key=str) == rollups
+
+        # re-importing an archived month finds its transactions in the archive
+        with open(settings.BASE_DIR / 'example_transactions.csv', 'rb') as report:
+            assert import_rows(iter_csv_rows(report)).get('inserted') == 0
+
+        try:
+            call_command('archive_months', '2999-01', stdout=io.StringIO())
+            assert False, 'archived a month that has not ended'
+        except CommandError:
+            pass
+
+    def test_conflicting_rows(self):
+        late = FBATransaction.objects.filter(date_time__lt=datetime.datetime(2020, 12, 1, tzinfo=datetime.timezone.utc))
+        ArchivedTransaction.objects.create(**{field.attname: getattr(late.first(), field.attname)
+                                              for field in ArchivedTransaction._meta.concrete_fields})
+        # nothing is deleted from the hot table unless every row made it into the archive
+        with self.assertRaises(IntegrityError):
+            archive_month(datetime.date(2020, 11, 1))
+        assert late.count() == 7317
+        assert ArchivedTransaction.objects.count() == 1
+        assert not ArchivedMonth.objects.exists()
+
+    def test_drop_keeps_late_rows(self):
+        call_command('archive_months', '2020-11', stdout=io.StringIO())
+        import_rows([{'date/time': 'Nov 5, 2020 10:00:00 AM PST', 'type': 'Order', 'order id': '902',
+                      'sku': 'N1N-TART-CHERRY-FBA', 'total': '1.00'}])
+        call_command('archive_months', '2020-11', '--drop', stdout=io.StringIO())
+
+        rollups = sorted(FBATransactionDailyRollup.objects.values_list('day', 'sku', 'order_type', 'count'), key=str)
+        assert (datetime.date(2020, 11, 5), 'N1N-TART-CHERRY-FBA', 'Order', 1) in rollups
+        rebuild_rollups()
+        assert sorted(FBATransactionDailyRollup.objects.values_list('day', 'sku', 'order_type', 'count'),
+                      key=str) == rollups
+
+        # served from the rollups, the late row is counted
+        c = Client(HTTP_USER_AGENT='Mozilla/5.0')
+        with override_settings(TRANSACTIONS_CACHE_ENABLED=False):
+            resp = c.get('/api/transactions/stats/', {'start': 'Nov 1, 2020 12:00:00 AM UTC',
+                                                      'end': 'Nov 30, 2020 11:59:59 PM UTC'})
+        assert resp.data.get('count') == 1
+
+    def test_late_rows_and_drop(self):
+        call_command('archive_months', '2020-11', stdout=io.StringIO())
+        start, end = map(convert_string_to_datetime, self.QUERIES[3].values())
+        assert partition_model(start, end) is ArchivedTransaction
+
+        import_rows([{'date/time': 'Nov 5, 2020 10:00:00 AM PST', 'type': 'Order', 'order id': '902',
+                      'total': '1.00'}])
+        assert partition_model(start, end) is TransactionHistory
+        assert filter_transactions({'start': start, 'end': end}).filter(order_id='902').exists()
+
+        call_command('archive_months', '2020-11', stdout=io.StringIO())
+        assert partition_model(start, end) is ArchivedTransaction
+        assert ArchivedMonth.objects.get().count == 7318
+
+        call_command('archive_months', '2020-11', '--drop', stdout=io.StringIO())
+        assert not ArchivedTransaction.objects.exists()
+        assert not FBATransactionDailyRollup.objects.filter(day__lt=datetime.date(2020, 12, 1)).exists()
+        assert ArchivedMonth.objects.get().dropped_at is not None
+        assert ArchivedMonth.objects.get().count == 7318
+        assert partition_model(start, end) is FBATransaction
+        assert list(filter_transactions({'start': start, 'end': end})) == []
+        assert filter_transactions({}).count() == 2
+
+
+class TransactionsSearch(TestCase):
+    def setUp(self):
+        with open(settings.BASE_DIR / 'example_transactions.csv', 'rb') as report:
+            import_rows(iter_csv_rows(report))
+
+    def matching(self, *words, **filters):
+        query = FBATransaction.objects.filter(**filters)
+        for word in words:
+            query = query.filter(Q(product__sku__icontains=word) | Q(product__description__icontains=word))
+        return set(query.values_list('id', flat=True))
+
+    def test_search(self):
+        c = Client(HTTP_USER_AGENT='Mozilla/5.0')
+        rows = c.get('/api/transactions/', {'q': 'Elderberry'}).json()
+        assert {row['id'] for row in rows} == self.matching('elderberry')
+        # best matches first, the transactions of each product by date/time
+        assert rows[0]['sku'] == 'N1N-ELDERBERRY-GUMMIES-FBA'
+        skus = [sku for sku, _ in itertools.groupby(row['sku'] for row in rows)]
+        assert len(skus) == len(set(skus))
+
+        rows = c.get('/api/transactions/', {'q': 'tart cherry', 'type': 'Order', 'start': 'Nov 10, 2020 12:00:00 AM PST',
+                                            'end': 'Nov 20, 2020 11:59:59 PM PST'}).json()
+        assert rows and {row['id'] for row in rows} == self.matching(
+            'tart', 'cherry', order_type='Order', date_time__gte=convert_string_to_datetime('Nov 10, 2020 12:00:00 AM PST'),
+            date_time__lte=convert_string_to_datetime('Nov 20, 2020 11:59:59 PM PST'))
+
+        # prefixes, and words match whole words only
+        assert {row['id'] for row in c.get('/api/transactions/', {'q': 'elder*'}).json()} == self.matching('elder')
+        assert c.get('/api/transactions/', {'q': 'elder'}).json() == []
+
+        with override_settings(TRANSACTIONS_CACHE_ENABLED=False):
+            stats = c.get('/api/transactions/stats/', {'q': 'magnesium', 'state': 'CA'}).json()
+        expected = compute_stats(FBATransaction.objects.filter(id__in=self.matching('magnesium'),
+                                                               location__state='CA'))
+        assert stats.get('count') == expected.get('count') > 0
+        assert Decimal(str(stats.get('summed'))) == expected.get('summed')
+
+        assert c.get('/api/transactions/', {'q': '"*-'}).status_code == 400
+        # FTS5 syntax in the search text is searched for as words
+        assert c.get('/api/transactions/', {'q': 'elderberry OR NEAR(cherry'}).json() == []
+
+    def test_index_follows_products(self):
+        assert parse_search('Vitamin-C, vitamin') == ('c', 'vitamin')
+        import_rows([{'date/time': 'Dec 3, 2020 12:23:30 AM PST', 'type': 'Order', 'sku': 'X-WING-FBA',
+                      'description': 'Incom T-65 starfighter', 'total': '1'}])
+        assert [row['sku'] for row in do_filtering({'q': 'starfighter'})] == ['X-WING-FBA']
+
+        product = Product.objects.get(sku='X-WING-FBA')
+        product.description = 'Incom T-70'
+        product.save()
+        assert not do_filtering({'q': 'starfighter'}).exists()
+        assert do_filtering({'q': 't 70 wing'}).count() == 1
+
+
+class ChangeFeed(TestCase):
+    def setUp(self):
+        with open(settings.BASE_DIR / 'example_transactions.csv', 'rb') as report:
+            import_rows(iter_csv_rows(report))
+
+    def pull(self, since=None, limit=3000):
+        c = Client(HTTP_USER_AGENT='Mozilla/5.0')
+        batches = []
+        while True:
+            params = {'limit': limit, **({'since': since} if since else {})}
+            batch = c.get('/api/transactions/changes/', params).json()
+            batches.append(batch)
+            since = batch['next']
+            if not batch['has_more']:
+                return [row for batch in batches for row in batch['results']], since, batches
+
+    def test_changes(self):
+        rows, since, batches = self.pull()
+        assert [len(batch['results']) for batch in batches] == [3000, 3000, 1317]
+        assert [row['id'] for row in rows] == sorted(FBATransaction.objects.values_list('id', flat=True))
+        c = Client(HTTP_USER_AGENT='Mozilla/5.0')
+        assert rows == sorted(c.get('/api/transactions/').json(), key=lambda row: row['id'])
+
+        # nothing new, the same cursor comes back
+        assert self.pull(since) == ([], since, [{'results': [], 'next': since, 'has_more': False}])
+
+        # new rows follow in import order, whatever their date/time
+        for order_id, day in (('900', 'Dec 2, 2020'), ('901', 'Oct 24, 2020')):
+            import_rows([{'date/time': f'{day} 10:00:00 AM PST', 'type': 'Order', 'order id': order_id,
+                          'sku': 'N1N-TART-CHERRY-FBA', 'quantity': '1', 'order state': 'CA', 'total': '38.61'}])
+        new_rows, since, _ = self.pull(since)
+        assert [row['order_id'] for row in new_rows] == ['900', '901']
+
+        # archiving keeps the ids, a consumer that fell behind still gets every row
+        behind = batches[0]['next']
+        call_command('archive_months', '--before', '2020-12', stdout=io.StringIO())
+        assert [row['id'] for row in self.pull(behind)[0]] == [row['id'] for row in rows[3000:] + new_rows]
+
+        assert c.get('/api/transactions/changes/', {'since': 'bm90IGEgY3Vyc29y'}).status_code == 400
+        assert c.get('/api/transactions/changes/', {'limit': '0'}).status_code == 400
+
+
+class OrderTotals(TestCase):
+    def setUp(self):
+        with open(settings.BASE_DIR / 'example_transactions.csv', 'rb') as report:
+            import_rows(iter_csv_rows(report))
+
+    def expected(self, **filters):
+        kinds = {'Order': 'gross', 'Refund': 'refunded', 'Order_Retrocharge': 'fees', 'FBA Customer Return Fee': 'fees',
+                 'FBA Inventory Fee': 'fees', 'Adjustment': 'adjustments'}
+        orders = {}
+        for order_id, order_type, total in (FBATransaction.objects.filter(**filters).exclude(order_id__isnull=True)
+                                            .exclude(order_id='').values_list('order_id', 'order_type', 'total')):
+            order = orders.setdefault(order_id, {'order_id': order_id, 'transactions': 0, 'gross': Decimal(0),
+                                                 'refunded': Decimal(0), 'fees': Decimal(0),
+                                                 'adjustments': Decimal(0), 'net': Decimal(0)})
+            order['transactions'] += 1
+            order['net'] += total
+            if order_type in kinds:
+                order[kinds[order_type]] += total
+        return [orders[order_id] for order_id in sorted(orders)]
+
+    def pull(self, **params):
+        c = Client(HTTP_USER_AGENT='Mozilla/5.0')
+        orders, cursor = [], None
+        while True:
+            page = c.get('/api/transactions/orders/', {**params, **({'cursor': cursor} if cursor else {})}).json()
+            orders.extend({name: value if name in ('order_id', 'transactions') else Decimal(str(value))
+                           for name, value in order.items()} for order in page['results'])
+            cursor = page['next']
+            if cursor is None:
+                return orders
+
+    def test_orders(self):
+        orders = self.pull(limit=2000)
+        assert len(orders) == 6574
+        assert orders == self.expected()
+        order = next(order for order in orders if order['order_id'] == '114-9209879-7933038')
+        assert order['transactions'] == 10
+        assert order['net'] == order['gross'] + order['refunded'] + order['fees'] + order['adjustments']
+
+        # the filters select the transactions that are summed
+        refunded = self.pull(type='Refund', state='CA')
+        assert refunded == self.expected(order_type='Refund', location__state='CA')
+        assert all(order['gross'] == 0 and order['refunded'] == order['net'] < 0 for order in refunded)
+
+        c = Client(HTTP_USER_AGENT='Mozilla/5.0')
+        assert c.get('/api/transactions/orders/', {'cursor': 'bm90IGEgY3Vyc29y'}).status_code == 400
+        assert c.get('/api/transactions/orders/', {'start': 'yesterday'}).status_code == 400
+
+
+class BenchmarkReport(TestCase):
+    def test_synthesized_report(self):
+        with open(settings.BASE_DIR / 'example_transactions.csv', newline='', encoding='utf-8-sig') as sample:
+            sample_rows = list(csv.DictReader(sample))[:200]
+
+        rows = list(synthesize_report(sample_rows, copies=3, seed=1))
+        assert len(rows) == 600
+        assert rows == list(synthesize_report(sample_rows, copies=3, seed=1))
+
+        result = import_rows(rows)
+        assert result.get('inserted') == 600
+        assert result.get('rejected') == 0
+        # each copy is shifted by the whole days the sample spans
+        sample_span = parse_timestamp(sample_rows[-1]['date/time']) - parse_timestamp(sample_rows[0]['date/time'])
+        copy_shift = parse_timestamp(rows[400]['date/time']) - parse_timestamp(rows[0]['date/time'])
+        assert copy_shift == datetime.timedelta(days=2 * (sample_span.days + 1))
+
+    def test_filter_matrix_days(self):
+        with open(settings.BASE_DIR / 'example_transactions.csv', newline='', encoding='utf-8-sig') as sample:
+            sample_rows = list(csv.DictReader(sample))
+
+        ranges = [filters for filters in filter_matrix(sample_rows) if filters.get('start') and filters.get('end')]
+        from_rollups = [rollup_query(parse_filters(filters)) is not None for filters in ranges]
+        # the whole days in TIME_ZONE, not the range starting at a Pacific midnight
+        assert from_rollups == [True, True, False, True]
+
+
+@skipUnless(np is not None, 'numpy is not installed')
+class ColumnarStats(TestCase):
+    def setUp(self):
+        with open(settings.BASE_DIR / 'example_transactions.csv', 'rb') as report:
+            import_rows(iter_csv_rows(report))
+
+    def assert_stats_match(self, snapshot, query_dict):
+        filters = parse_filters(query_dict)
+        percentiles = [Decimal(10), Decimal('33.3'), Decimal(99)]
+        expected = compute_stats(filter_transactions(filters), percentiles=percentiles)
+        actual = snapshot.stats(filters, percentiles=percentiles)
+        for name in ('count', 'summed', 'min', 'max', 'median'):
+            assert expected.get(name) == actual.get(name), (query_dict, name, expected, actual)
+        if expected.get('count'):
+            assert abs(expected.get('mean') - actual.get('mean')) < Decimal('0.000001')
+            for pct, value in expected.get('percentiles').items():
+                assert abs(value - actual.get('percentiles').get(pct)) < Decimal('0.000001')
+
+    def test_matches_database(self):
+        snapshot = ColumnarSnapshot()
+        self.assert_stats_match(snapshot, {})
+        self.assert_stats_match(snapshot, {'type': 'Order', 'state': 'CA'})
+        self.assert_stats_match(snapshot, {'city': 'New York', 'postal': '10033-3736'})
+        self.assert_stats_match(snapshot, {'skus': 'N1N-ELDERBERRY-GUMMIES-FBA,N1N-TART-CHERRY-FBA,unknown'})
+        self.assert_stats_match(snapshot, {'start': 'Nov 3, 2020 4:12:00 PM PST', 'end': 'Nov 10, 2020 3:59:59 AM PST'})
+        self.assert_stats_match(snapshot, {'state': 'Nowhere'})
+        self.assert_stats_match(snapshot, {'type': 'Order,Refund', 'min_total': '-5.5', 'max_total': '30'})
+        self.assert_stats_match(snapshot, {'q': 'elderberry', 'type': 'Order'})
+
+    def test_incremental_refresh(self):
+        snapshot = ColumnarSnapshot()
+        assert snapshot.stats({}).get('count') == 7317
+
+        import_rows([{'date/time': 'Dec 3, 2020 12:23:30 AM PST', 'type': 'Order', 'sku': 'x-wing', 'total': '1'}])
+        assert snapshot.stats({}).get('count') == 7318
+        assert snapshot.stats({'skus': ('x-wing',)}).get('summed') == Decimal('1.00')
+
+        FBATransaction.objects.filter(product__sku='x-wing').delete()
+        assert snapshot.stats({}).get('count') == 7317
+
+    def test_refresh_keeps_state(self):
+        snapshot = ColumnarSnapshot()
+        snapshot.refresh()
+        state = snapshot.state
+        skus = dict(state.dictionaries['sku'].codes)
+
+        import_rows([{'date/time': 'Dec 3, 2020 12:23:30 AM PST', 'type': 'Order', 'sku': 'x-wing', 'total': '1'}])
+        snapshot.refresh()
+        assert snapshot.state is not state
+        assert len(snapshot) == 7318
+        assert len(state.columns['id']) == 7317
+        assert state.dictionaries['sku'].codes == skus
+        assert snapshot.stats({}).get('count') == 7318
+
+    def test_stats_view(self):
+        c = Client(HTTP_USER_AGENT='Mozilla/5.0')
+        with override_settings(TRANSACTIONS_STATS_ENGINE='columnar', TRANSACTIONS_CACHE_ENABLED=False):
+            resp = c.get('/api/transactions/stats/?type=Refund&percentiles=50')
+        expected = compute_stats(filter_transactions({'type': 'Refund'}))
+        assert resp.data.get('count') == expected.get('count')
+        assert resp.data.get('summed') == expected.get('summed')
+        assert resp.data.get('percentiles') == {'50': expected.get('median')}
+
+
+def metric_value(name: str, **labels) -> float:
+    """
+    Value of one series in the /api/metrics exposition, 0 if it wasn't recorded yet
+    """
+    for line in expose_metrics().splitlines():
+        series, _, value = line.rpartition(' ')
+        if series.split('{')[0] == name and all(f'{key}="{label}"' in series for key, label in labels.items()):
+            return float(value)
+    return 0
+
+
+class ApiMetrics(TestCase):
+    def setUp(self):
+        for order_id, state, total in (('1', 'CA', '11.09'), ('2', 'NY', '-0.75'), ('3', 'CA', '38.61')):
+            FBATransaction(date_time=convert_string_to_datetime('Nov 1, 2020 12:23:30 AM PDT'), order_type='Order',
+                           order_id=order_id, sku='N1N-TART-CHERRY-FBA', order_state=state,
+                           total=Decimal(total)).save()
+
+    def test_request_metrics(self):
+        c = Client(HTTP_USER_AGENT='Mozilla/5.0')
+        stats = {'endpoint': '/api/transactions/stats/', 'filters': 'min_total+state'}
+        listed = {'endpoint': '/api/transactions/', 'filters': 'state'}
+        requests_before = metric_value('transactions_http_requests_total', status='200', **stats)
+        rows_before = metric_value('transactions_rows_per_request_sum', **listed)
+        streamed_rows_before = metric_value('transactions_rows_per_request_sum', endpoint='/api/transactions/',
+                                            filters='type')
+
+        resp = c.get('/api/transactions/stats/', {'state': 'CA', 'min_total': '0'})
+        assert resp.status_code == 200
+        resp = c.get('/api/transactions/', {'state': 'CA'})
+        assert len(resp.data) == 2
+        resp = c.get('/api/transactions/', {'type': 'Order', 'format': 'ndjson'})
+        assert len(b''.join(resp.streaming_content).splitlines()) == 3
+
+        assert metric_value('transactions_http_requests_total', status='200', **stats) == requests_before + 1
+        assert metric_value('transactions_db_queries_per_request_count', **stats) >= 1
+        assert metric_value('transactions_db_queries_per_request_bucket', le='+Inf', **stats) >= 1
+        assert metric_value('transactions_rows_per_request_sum', **listed) == rows_before + 2
+        assert metric_value('transactions_rows_per_request_sum', endpoint='/api/transactions/',
+                            filters='type') == streamed_rows_before + 3
+        assert metric_value('transactions_response_bytes_sum', endpoint='/api/transactions/', filters='type') > 0
+        assert metric_value('transactions_serialize_seconds_count', **listed) >= 1
+
+        resp = c.get('/api/metrics')
+        assert resp.status_code == 200
+        assert resp['Content-Type'].startswith('text/plain; version=0.0.4')
+        assert '# TYPE transactions_http_request_seconds histogram' in resp.content.decode()
+
+    def test_slow_query_log(self):
+        c = Client(HTTP_USER_AGENT='Mozilla/5.0')
+        with override_settings(TRANSACTIONS_SLOW_QUERY_SECONDS=0):
+            with self.assertLogs('transactions.slow_queries', 'WARNING') as logs:
+                c.get('/api/transactions/', {'state': 'CA', 'min_total': '1'})
+        assert any('SELECT' in message and "'state': ['CA']" in message for message in logs.output)
+        assert metric_value('transactions_slow_queries_total', endpoint='/api/transactions/') >= 1
+
+    def test_import_metrics(self):
+        rows_before = metric_value('transactions_import_rows_total', source='api')
+        c = Client(HTTP_USER_AGENT='Mozilla/5.0')
+        with tempfile.TemporaryDirectory() as media_root:
+            with override_settings(TRANSACTIONS_IMPORT_RUNNER='inline', MEDIA_ROOT=media_root):
+                resp = c.post('/api/transactions/', data=TransactionsImport.CSV_REPORT, content_type='text/csv')
+        assert resp.data.get('status') == 'succeeded'
+        assert metric_value('transactions_import_rows_total', source='api') == rows_before + 4
+        assert metric_value('transactions_import_rows_per_second', source='api') > 0
+
+
+class LegacyUpgrade(TransactionTestCase):
+    """
+    Upgrading a database filled by the original code, which stored PDT timestamps at -0900
+    """
+    databases = {'default', 'replica'}
+    BASELINE = '0002_alter_fbatransaction_date_time'
+    ROWS = 200
+
+    @staticmethod
+    def migrate(target=None):
+        executor = MigrationExecutor(connection)
+        target = target or executor.loader.graph.leaf_nodes('transactions')[0][1]
+        executor.migrate([('transactions', target)])
+        return MigrationExecutor(connection).loader.project_state(('transactions', target)).apps
+
+    def setUp(self):
+        apps = self.migrate(self.BASELINE)
+        model = apps.get_model('transactions', 'FBATransaction')
+        with open(settings.BASE_DIR / 'example_transactions.csv', newline='', encoding='utf-8-sig') as report:
+            self.report = list(itertools.islice(csv.DictReader(report), self.ROWS))
+        for row in self.report:
+            # as the original POST handler stored them
+            date_string = row['date/time'].replace(', ', ' ').replace(' PDT', ' -0900').replace(' PST', ' -0800')
+            model(date_time=datetime.datetime.strptime(date_string, '%b %d %Y %I:%M:%S %p %z'),
+                  order_type=row['type'], order_id=row['order id'], sku=row['sku'], description=row['description'],
+                  quantity=int(row['quantity']) if row['quantity'] else None, order_city=row['order city'],
+                  order_state=row['order state'], order_postal=row['order postal'],
+                  total=float(row['total'])).save()
+
+    def tearDown(self):
+        self.migrate()
+
+    def test_timestamps_corrected(self):
+        self.migrate()
+        stored = list(FBATransaction.objects.order_by('id').values_list('date_time', flat=True))
+        assert stored == [parse_timestamp(row['date/time']) for row in self.report]
+
+    def test_migrated_before(self):
+        self.migrate('0012_data_generation')
+        # 0003 applied by an earlier run, rows imported since by the current parser would be indistinguishable
+        MigrationRecorder(connection).migration_qs.filter(name='0003_fbatransaction_filter_indexes').update(
+            applied=datetime.datetime(2021, 1, 1, tzinfo=datetime.timezone.utc))
+        stored = list(FBATransaction.objects.order_by('id').values_list('date_time', flat=True))
+        with self.assertLogs('transactions.migrations', 'WARNING'):
+            self.migrate()
+        assert list(FBATransaction.objects.order_by('id').values_list('date_time', flat=True)) == stored
+
+    def test_reimport_after_upgrade(self):
+        self.migrate()
+        with open(settings.BASE_DIR / 'example_transactions.csv', 'rb') as report:
+            result = import_rows(iter_csv_rows(itertools.islice(report, self.ROWS + 1)))
+        assert result.get('inserted') == 0
+        assert result.get('duplicates') == self.ROWS
+        assert FBATransaction.objects.count() == self.ROWS
+
+    def test_rollups_backfilled(self):
+        self.migrate()
+        fields = ('day', 'sku', 'order_type', 'order_state', 'count', 'total_sum', 'total_sum_squares', 'total_min',
+                  'total_max', 'total_sketch')
+        migrated = sorted(FBATransactionDailyRollup.objects.values_list(*fields), key=str)
+        assert sum(row[4] for row in migrated) == self.ROWS
+        rebuild_rollups()
+        assert migrated == sorted(FBATransactionDailyRollup.objects.values_list(*fields), key=str)
+
+
+class AsgiViews(TransactionTestCase):
+    databases = {'default', 'replica'}
+
+    def setUp(self):
+        with open(settings.BASE_DIR / 'example_transactions.csv', 'rb') as report:
+            import_rows(iter_csv_rows(report))
+
+    def tearDown(self):
+        # the pool threads' connections would otherwise outlive the test database
+        shutdown_pools()
+
+    def test_same_responses(self):
+        application = TransactionsASGIHandler()
+        c = Client(HTTP_USER_AGENT='Mozilla/5.0')
+        requests = [
+            ('/api/transactions/', {'state': 'CA'}),
+            ('/api/transactions/', {'type': 'Order', 'limit': 100}),
+            ('/api/transactions/', {'skus': 'N1N-TART-CHERRY-FBA', 'stream': 'true'}),
+            ('/api/transactions/', {'format': 'csv'}),
+            ('/api/transactions/', {'start': 'yesterday'}),
+            ('/api/transactions/stats/', {'type': 'Order,Refund', 'percentiles': '50,99', 'min_total': '0'}),
+            ('/api/transactions/timeseries/', {'interval': 'week', 'tz': 'America/Los_Angeles'}),
+        ]
+        stats = {'endpoint': '/api/transactions/stats/', 'filters': 'min_total+type'}
+        streamed = {'endpoint': '/api/transactions/', 'filters': 'none'}
+        requests_before = metric_value('transactions_http_requests_total', status='200', **stats)
+        queries_before = metric_value('transactions_db_queries_per_request_sum', **stats)
+        rows_before = metric_value('transactions_rows_per_request_sum', **streamed)
+
+        with override_settings(TRANSACTIONS_CACHE_ENABLED=False):
+            for path, params in requests:
+                status, body = async_to_sync(asgi_get)(application, path, params)
+                expected = c.get(path, params)
+                content = b''.join(expected.streaming_content) if expected.streaming else expected.content
+                assert (status, body) == (expected.status_code, content), (path, params)
+
+        # the metrics of the pooled views count the SQL run in the pool threads, and the rows streamed
+        assert metric_value('transactions_http_requests_total', status='200', **stats) == requests_before + 2
+        assert metric_value('transactions_db_queries_per_request_sum', **stats) >= queries_before + 2
+        assert metric_value('transactions_rows_per_request_sum', **streamed) == rows_before + 2 * 7317
+
+
+class PooledViews(TransactionTestCase):
+    databases = {'default', 'replica'}
+
+    def test_pools(self):
+        application = TransactionsASGIHandler()
+        release = threading.Event()
+        factory = RequestFactory()
+        assert request_pool(factory.get('/api/transactions/stats/')) == AGGREGATE_POOL
+        assert request_pool(factory.get('/api/transactions/timeseries/')) == AGGREGATE_POOL
+        assert request_pool(factory.get('/api/transactions/')) == QUERY_POOL
+        assert request_pool(factory.get('/nowhere/')) == QUERY_POOL
+
+        async def serve():
+            # occupy every thread of the aggregate pool, the query pool keeps answering
+            for _ in range(2):
+                get_pool(AGGREGATE_POOL).submit(release.wait, 10)
+            stats = asyncio.ensure_future(asgi_get(application, '/api/transactions/stats/'))
+            status, _ = await asyncio.wait_for(asgi_get(application, '/api/transactions/', {'limit': 10}), 5)
+            assert status == 200
+            assert not stats.done()
+            release.set()
+            return await asyncio.wait_for(stats, 5)
+
+        try:
+            with override_settings(TRANSACTIONS_ASYNC_WORKERS={'aggregate': 2}):
+                status, _ = async_to_sync(serve)()
+        finally:
+            release.set()
+            shutdown_pools()
+        assert status == 200
@@ -0,0 +1,136 @@
+import datetime
+import zoneinfo
+from decimal import Decimal
+from typing import Dict, Iterator, List, Optional
+
+from django.db.models import Count, QuerySet, Sum
+from django.db.models.functions import Trunc
+from django.utils import timezone
+
+INTERVALS = ('hour', 'day', 'week', 'month')
+
+# Refuse series longer than this rather than zero filling e.g. ten years of hours
+MAX_BUCKETS = 10000
+
+ZERO = Decimal('0.00')
+CENTS = Decimal('0.01')
+
+
+def parse_interval(interval: Optional[str]) -> str:
+    """
+    Parse the interval query parameter, defaults to day
+
+    return: One of INTERVALS, raises ValueError otherwise
+    """
+    if not interval:
+        return 'day'
+    if interval not in INTERVALS:
+        raise ValueError(f'interval must be one of {", ".join(INTERVALS)}')
+    return interval
+
+
+def parse_timezone(name: Optional[str]) -> datetime.tzinfo:
+    """
+    Parse the tz query parameter, an IANA timezone name such as America/Los_Angeles. Defaults to TIME_ZONE
+
+    return: The timezone, raises ValueError if it doesn't exist
+    """
+    if not name:
+        return timezone.get_current_timezone()
+    try:
+        return zoneinfo.ZoneInfo(name)
+    except (zoneinfo.ZoneInfoNotFoundError, ValueError):
+        raise ValueError(f'unknown timezone {name}')
+
+
+def truncate(value: datetime.datetime, interval: str, tzinfo: datetime.tzinfo) -> datetime.datetime:
+    """
+    Start of the bucket value falls in, as a naive wall clock time in tzinfo. Matches what Trunc does in the database
+    """
+    local = value.astimezone(tzinfo).replace(tzinfo=None)
+    if interval == 'hour':
+        return local.replace(minute=0, second=0, microsecond=0)
+    local = local.replace(hour=0, minute=0, second=0, microsecond=0)
+    if interval == 'week':
+        return local - datetime.timedelta(days=local.weekday())
+    if interval == 'month':
+        return local.replace(day=1)
+    return local
+
+
+def iter_buckets(first: datetime.datetime, last: datetime.datetime, interval: str,
+                 tzinfo: datetime.tzinfo) -> Iterator[datetime.datetime]:
+    """
+    Every bucket start from first to last inclusive, both given as naive wall clock times in tzinfo
+    """
+    if interval == 'hour':
+        # step in UTC so that hours repeated or skipped by DST changes appear exactly as often as Trunc produces them
+        current = timezone.make_aware(first, tzinfo).astimezone(datetime.timezone.utc)
+        previous = None
+        while True:
+            bucket = truncate(current, interval, tzinfo)
+            if bucket > last:
+                return
+            if bucket != previous:
+                yield bucket
+                previous = bucket
+            current += datetime.timedelta(hours=1)
+
+    current = first
+    while current <= last:
+        yield current
+        if interval == 'month':
+            current = current.replace(year=current.year + current.month // 12, month=current.month % 12 + 1)
+        elif interval == 'week':
+            current += datetime.timedelta(weeks=1)
+        else:
+            current += datetime.timedelta(days=1)
+
+
+def timeseries(query: QuerySet, interval: str, tzinfo: datetime.tzinfo,
+               start: Optional[datetime.datetime] = None, end: Optional[datetime.datetime] = None) -> List[Dict]:
+    """
+    Count and sum the transactions in query per time bucket. The bucketing and aggregation is one GROUP BY query
+    on Trunc(date_time) so only one row per non-empty bucket leaves the database. Empty buckets are filled in
+    with zeros, from the bucket of start (or of the first transaction) to the bucket of end (or of the last one)
+
+    params:
+    query(QuerySet): Filtered transactions
+    interval(str): One of INTERVALS
+    tzinfo(tzinfo): Timezone whose wall clock the buckets follow
+    start(datetime): Start of the filtered range, if any
+    end(datetime): End of the filtered range, if any
+
+    return: List of dicts holding the bucket start, count and summed, oldest first. Raises ValueError if the
+        range spans more than MAX_BUCKETS buckets
+    """
+    rows = (query.order_by()
+            .annotate(bucket=Trunc('date_time', interval, tzinfo=tzinfo))
+            .values('bucket')
+            .annotate(count=Count('id'), summed=Sum('total'))
+            .order_by('bucket'))
+    filled = {row['bucket'].replace(tzinfo=None): row for row in rows}
+
+    if start is not None:
+        first = truncate(start, interval, tzinfo)
+    elif filled:
+        first = min(filled)
+    else:
+        return []
+    if end is not None:
+        last = truncate(end, interval, tzinfo)
+    else:
+        last = max(filled) if filled else first
+
+    series = []
+    for bucket in iter_buckets(first, last, interval, tzinfo):
+        if len(series) == MAX_BUCKETS:
+            raise ValueError(f'more than {MAX_BUCKETS} buckets, narrow start/end or use a longer interval')
+        row = filled.get(bucket)
+        series.append({
+            'bucket': timezone.make_aware(bucket, tzinfo),
+            'count': row['count'] if row else 0,
+            # SQLite sums the totals as floating point, round them back to cents
+            'summed': row['summed'].quantize(CENTS) if row else ZERO,
+        })
+    return series
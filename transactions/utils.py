@@ -0,0 +1,17 @@
+"""
+Small helpers shared by the import and the rendering code, kept free of model imports
+"""
+from itertools import islice
+from typing import Iterable, Iterator, List
+
+
+def chunked(iterable: Iterable, size: int) -> Iterator[List]:
+    """
+    Split iterable into lists of at most size items without materializing it
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
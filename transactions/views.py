@@ -1,83 +1,31 @@
-import datetime
+import json
 
-from django.http import HttpRequest
+from django.http import HttpRequest, StreamingHttpResponse
 from django.utils.dateparse import parse_date
 from django.views.decorators.csrf import csrf_exempt
 from rest_framework import status
 from rest_framework.generics import GenericAPIView
 from rest_framework.permissions import AllowAny
+from rest_framework.settings import api_settings
 from rest_framework.response import Response
-from typing import Dict
-from statistics import mean,median
 
 # *** This will be highly relevant ***
 # https://docs.djangoproject.com/en/3.1/topics/db/queries/
-from transactions.models import FBATransaction
-
-
-def convert_string_to_datetime(date_string: str):
-    """
-    Given a date_string with a format like Nov 1, 2020 12:23:30 AM PDT, convert it to a datetime.
-    This code takes advantage of the sample data only having PDT and PST, obviously in a production
-    design that would not be sufficient
-
-    params:
-    date_string(str): The string to be converted into a datetime expected format Nov 1, 2020 12:23:30 AM PDT
-
-    return: Python datetime object
-    """
-    date_string = date_string.replace(', ', ' ')
-    date_string = date_string.replace(' PDT', ' -0900')
-    date_string = date_string.replace(' PST', ' -0800')
-    dt = datetime.datetime.strptime(date_string, '%b %d %Y %I:%M:%S %p %z')
-    return dt
-
-
-def do_filtering(query_dict: Dict):
-    """
-    Go through the query_dict and perform any of the queries that are specified in it.
-    Take advantage of the lazy query characteristic of django and build the query iteratively
-
-    params:
-    query_dict(dict): Dictionary of filters apply
-
-    return: Query result
-    """
-
-    query = FBATransaction.objects.all()
-
-    order_type = query_dict.get('type')
-    if order_type:
-        query = query.filter(order_type=order_type)
-
-    city = query_dict.get('city')
-    if city:
-        query = query.filter(order_city=city)
-
-    state = query_dict.get('state')
-    if state:
-        query = query.filter(order_state=state)
-
-    postal = query_dict.get('postal')
-    if postal:
-        query = query.filter(order_postal=postal)
-
-    skus = query_dict.get('skus')
-    if skus:
-        split_skus = skus.split(',')
-        query = query.filter(sku__in=split_skus)
-
-    start_date = query_dict.get('start')
-    if start_date:
-        parsed_start = convert_string_to_datetime(start_date)
-        query = query.filter(date_time__gte=parsed_start)
-
-    end_date = query_dict.get('end')
-    if end_date:
-        parsed_end = convert_string_to_datetime(end_date)
-        query = query.filter(date_time__lte=parsed_end)
-
-    return query.values()
+from transactions.asgi import AGGREGATE_POOL
+from transactions.cache import cached_response
+from transactions.changes import changes_after
+from transactions.columnar import COLUMNAR, get_snapshot, stats_engine
+from transactions.filters import TRANSACTION_COLUMNS, do_filtering, filter_transactions, parse_filters
+from transactions.jobs import create_import_job, job_status
+from transactions.metrics import count_rows
+from transactions.models import ImportJob
+from transactions.orders import order_totals
+from transactions.pagination import iter_json_array, iter_keyset, paginate, parse_limit
+from transactions.renderers import STREAMING_RENDERERS, StreamingRenderer, stream_rows
+from transactions.rollups import rollup_query
+from transactions.stats import (compute_stats, grouped_stats, parse_approx, parse_group_by, parse_order_by,
+                                parse_percentiles, parse_top)
+from transactions.timeseries import parse_interval, parse_timezone, timeseries
 
 
 class TransactionsListView(GenericAPIView):
@@ -86,23 +34,56 @@ class TransactionsListView(GenericAPIView):
     """
 
     permission_classes = (AllowAny,)
+    renderer_classes = list(api_settings.DEFAULT_RENDERER_CLASSES) + STREAMING_RENDERERS
 
+    @cached_response
     def get(self, request: HttpRequest):
         """
         Returns a list of transactions by the given filters
 
+        Besides JSON the transactions can be requested as newline delimited JSON, CSV or an Apache Arrow IPC stream
+        (if pyarrow is installed), with an Accept header of application/x-ndjson, text/csv or
+        application/vnd.apache.arrow.stream or with format=ndjson|csv|arrow. Those are always streamed, ordered by
+        date/time, starting after cursor if one is given
+
         params:
-        type (str): Returns transactions of this type
+        type (str): Returns transactions of this type, or of any of several comma separated types
         skus (list): Returns transactions with this SKU, should be sent/parsed as a comma separated string if multiple SKU's
         start (str): Returns transactions occurring after this date/time
         end (str): Returns transactions occurring before this date/time
-        city (str): Returns transactions in this city
-        state (str): Returns transactions in this state
-        postal (str): Returns transactions in this postal address
+        city (str): Returns transactions in this city, several can be given comma separated
+        state (str): Returns transactions in this state, several can be given comma separated
+        postal (str): Returns transactions in this postal address, several can be given comma separated
+        min_total (decimal): Returns transactions with a total of at least this
+        max_total (decimal): Returns transactions with a total of at most this
+        q (str): Returns transactions whose product SKU or description contains all of these words, a word ending
+            in * matches any word starting with it. Without limit/cursor/stream the best matches come first
+        limit (int): Return at most this many transactions, ordered by date/time, along with a "next" cursor
+        cursor (str): Return the page following the one that returned this "next" cursor
+        stream (bool): Stream every matching transaction ordered by date/time instead of building the whole
+            response in memory
         """
         # Dictionary containing all parameters sent in the query string
         request_data = request.GET
-        query_result = do_filtering(query_dict=request_data)
+        cursor = request_data.get('cursor')
+        try:
+            query_result = do_filtering(query_dict=request_data)
+            renderer = request.accepted_renderer
+            if isinstance(renderer, StreamingRenderer):
+                rows = count_rows(request, iter_keyset(query_result.values_list(*TRANSACTION_COLUMNS), cursor))
+                content_type = f'{renderer.media_type}; charset={renderer.charset}' if renderer.charset \
+                    else renderer.media_type
+                return StreamingHttpResponse(stream_rows(renderer, TRANSACTION_COLUMNS, rows), content_type=content_type)
+
+            if request_data.get('stream') in ('1', 'true'):
+                rows = count_rows(request, iter_keyset(query_result, cursor))
+                return StreamingHttpResponse(iter_json_array(rows), content_type='application/json')
+
+            if request_data.get('limit') or cursor:
+                page = paginate(query_result, parse_limit(request_data.get('limit')), cursor)
+                return Response(page, status=status.HTTP_200_OK)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
         return Response(query_result, status=status.HTTP_200_OK)
 
@@ -110,46 +91,39 @@ class TransactionsListView(GenericAPIView):
     @csrf_exempt
     def post(self, request: HttpRequest):
         """
-        Imports a CSV file of transactions
-
-        NOTE - This POST caused me an inordinate amount of pain. I've never used Django before this'
-        and I'm certain that there's something really obvious I missed to allow me to upload a CSV.
-        However, whenever I tried to do so I ran into problems with text/csv - I kept running into
-        problems with rendering the csv as opposed to a json. I experimented a little bit with
-        using https://github.com/mjumbewu/django-rest-framework-csv but that didn't quite work though
-        I think I was on the right track. However since this was described as intended to a relatively
-        brief exercise I felt I'd well exceeded a reasonable amount of time searching for a solution.
-        Were I in the office I'd probably be posting a slack along the lines of "what one line
-        fix am I missing or where can I find this in stack overflow..."
-
-        That said I did want to have some mechanism to take the data and insert it in the database
-        so I went with the extremely brute-force method of changing this to accept a massive json blob
-        that I converted from the sample csv file
+        Imports a report of transactions
+
+        The report can be sent as
+        - a text/csv body, e.g. curl --data-binary @example_transactions.csv -H 'Content-Type: text/csv'
+        - a multipart/form-data upload of the csv (or JSON) file (field name "file")
+        - the original JSON array of row objects keyed by the csv column headers
+
+        The report is stored and imported in the background (see transactions.jobs), the response is returned
+        straight away with the id of the import job. Its progress can be followed at /api/transactions/imports/<id>/
+
+        return: The status of the import job
         """
 
         # https://docs.djangoproject.com/en/3.1/ref/request-response/#django.http.HttpRequest.FILES
+        content_type = request.content_type or ''
+        if content_type.startswith('text/csv'):
+            job = create_import_job(request.stream or b'', 'report.csv')
+        elif content_type.startswith('multipart/form-data'):
+            upload = request.FILES.get('file') or next(iter(request.FILES.values()), None)
+            if upload is None:
+                return Response({'error': 'no file uploaded'}, status=status.HTTP_400_BAD_REQUEST)
+            file_format = ImportJob.JSON if upload.name.lower().endswith('.json') else ImportJob.CSV
+            job = create_import_job(upload, upload.name, file_format)
+        else:
+            rows = request.data
+            if not isinstance(rows, list):
+                return Response({'error': 'expected a JSON array of transactions'},
+                                status=status.HTTP_400_BAD_REQUEST)
+            job = create_import_job(json.dumps(rows).encode('utf-8'), 'report.json', ImportJob.JSON)
 
-        for curr_row in request.data:
-            curr_date = curr_row.get('date/time')
-            if  curr_date:
-                dt = convert_string_to_datetime(curr_date)
-            else:
-                continue
-
-            entry_orm = FBATransaction(
-                date_time=dt,
-                order_type=curr_row.get('type'),
-                order_id=curr_row.get('order id'),
-                sku=curr_row.get('sku'),
-                description=curr_row.get('description'),
-                quantity=int(curr_row.get('quantity')) if curr_row.get('quantity') else None,
-                order_city=curr_row.get('order city'),
-                order_state=curr_row.get('order state'),
-                order_postal=curr_row.get('order postal'),
-                total=float(curr_row.get('total')) if curr_row.get('total') else None,
-            )
-            entry_orm.save()
-        return Response("ok", status=status.HTTP_200_OK)
+        result = job_status(job)
+        result['url'] = f'/api/transactions/imports/{job.id}/'
+        return Response(result, status=status.HTTP_202_ACCEPTED)
 
 
 class TransactionsStatsView(GenericAPIView):
@@ -161,37 +135,195 @@ class TransactionsStatsView(GenericAPIView):
     """
 
     permission_classes = (AllowAny,)
+    # aggregations run in their own thread pool under ASGI, see transactions.asgi
+    asgi_pool = AGGREGATE_POOL
 
+    @cached_response
     def get(self, request: HttpRequest):
         """
-        Returns a response containing the summed, average, and median totals for transactions using any given filters.
+        Returns a response containing the summed, average, and median totals for transactions using any given filters,
+        along with the count, min and max. Everything is computed in the database.
 
         params:
-        type (str): Returns transactions of this type
+        type (str): Returns transactions of this type, or of any of several comma separated types
         skus (list): Returns transactions with this SKU, should be sent/parsed as a comma separated string if multiple SKU's
         start (str): Returns transactions occurring after this date/time
         end (str): Returns transactions occurring before this date/time
-        city (str): Returns transactions in this city
-        state (str): Returns transactions in this state
-        postal (str): Returns transactions in this postal address
+        city (str): Returns transactions in this city, several can be given comma separated
+        state (str): Returns transactions in this state, several can be given comma separated
+        postal (str): Returns transactions in this postal address, several can be given comma separated
+        min_total (decimal): Returns transactions with a total of at least this
+        max_total (decimal): Returns transactions with a total of at most this
+        q (str): Returns transactions whose product SKU or description contains all of these words
+        percentiles (list): Additional percentiles of the totals to return, comma separated e.g. 90,99
+        group_by (list): Break the stats down by any of sku, type, state, city, postal and one time bucket of
+            hour, day, week or month, comma separated e.g. state,month. Returns {"group_by": [...], "groups": [...]}
+            with the count, summed, mean, median, min and max of every group
+        order_by (list): Order of the groups, any of count, summed, mean, median, min, max or a group_by dimension,
+            prefixed with - for descending. Defaults to the time bucket, or -summed without one
+        top (int): Return only the first top groups
+        approx (bool): Estimate the median and percentiles from the quantile sketches of the daily rollups instead
+            of sorting the totals, when the filters can be answered from the rollups. Adds error_bound, the
+            relative error of the estimates (0 if they were computed exactly)
+        max_error (decimal): With approx, the largest relative error acceptable. 400 if the sketches can't
+            guarantee it
         """
         # Contains all parameters sent in the query string
         request_data = request.GET
-        query_result = do_filtering(query_dict=request_data)
-        for curr_entry in query_result:
-            print(curr_entry)
-        totals = [curr_entry.get('total') for curr_entry in query_result]
-        if totals:
-            stats = {
-                'summed': sum(totals),
-                'mean':  mean(totals),
-                'median': median(totals),
-            }
+        try:
+            percentiles = parse_percentiles(request_data.get('percentiles'))
+            filters = parse_filters(request_data)
+            dimensions = parse_group_by(request_data.get('group_by'))
+            approx = parse_approx(request_data.get('approx'), request_data.get('max_error'))
+            if dimensions:
+                if percentiles:
+                    raise ValueError('percentiles are not supported with group_by')
+                if approx:
+                    raise ValueError('approx is not supported with group_by')
+                ordering = parse_order_by(request_data.get('order_by'), dimensions)
+                top = parse_top(request_data.get('top'))
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        if dimensions:
+            groups = grouped_stats(filter_transactions(filters), dimensions, ordering, top=top)
+            return Response({'group_by': dimensions, 'groups': groups}, status=status.HTTP_200_OK)
+
+        rollups = rollup_query(filters)
+        if stats_engine() == COLUMNAR and not (approx and rollups is not None):
+            stats = get_snapshot().stats(filters, percentiles=percentiles)
+            if approx:
+                stats['error_bound'] = 0
         else:
-            stats = {
-                'summed': None,
-                'mean':  None,
-                'median': None,
-            }
+            query_result = filter_transactions(filters)
+            stats = compute_stats(query_result, percentiles=percentiles, rollups=rollups, approx=approx)
 
         return Response(stats, status=status.HTTP_200_OK)
+
+
+class TransactionsTimeseriesView(GenericAPIView):
+    """
+    Returns the count and summed totals of transactions per time bucket, for charting
+    """
+
+    permission_classes = (AllowAny,)
+    # aggregations run in their own thread pool under ASGI, see transactions.asgi
+    asgi_pool = AGGREGATE_POOL
+
+    @cached_response
+    def get(self, request: HttpRequest):
+        """
+        Returns {"interval": ..., "tz": ..., "buckets": [...]} with the start, count and summed total of every
+        bucket between start and end, including the empty ones, oldest first
+
+        params:
+        type (str): Returns transactions of this type, or of any of several comma separated types
+        skus (list): Returns transactions with this SKU, should be sent/parsed as a comma separated string if multiple SKU's
+        start (str): Returns transactions occurring after this date/time
+        end (str): Returns transactions occurring before this date/time
+        city (str): Returns transactions in this city, several can be given comma separated
+        state (str): Returns transactions in this state, several can be given comma separated
+        postal (str): Returns transactions in this postal address, several can be given comma separated
+        min_total (decimal): Returns transactions with a total of at least this
+        max_total (decimal): Returns transactions with a total of at most this
+        q (str): Returns transactions whose product SKU or description contains all of these words
+        interval (str): Bucket size, one of hour, day, week or month. Defaults to day
+        tz (str): IANA timezone the buckets follow, e.g. America/Los_Angeles. Defaults to UTC
+        """
+        request_data = request.GET
+        try:
+            filters = parse_filters(request_data)
+            interval = parse_interval(request_data.get('interval'))
+            tzinfo = parse_timezone(request_data.get('tz'))
+            buckets = timeseries(filter_transactions(filters), interval, tzinfo,
+                                 start=filters.get('start'), end=filters.get('end'))
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response({'interval': interval, 'tz': str(tzinfo), 'buckets': buckets}, status=status.HTTP_200_OK)
+
+
+class TransactionsOrdersView(GenericAPIView):
+    """
+    Reconciles the transactions of every order
+    """
+
+    permission_classes = (AllowAny,)
+    # aggregations run in their own thread pool under ASGI, see transactions.asgi
+    asgi_pool = AGGREGATE_POOL
+
+    @cached_response
+    def get(self, request: HttpRequest):
+        """
+        Returns {"results": [...], "next": ...} with a page of the orders, ordered by order id. Every order has the
+        number of its transactions matching the filters and their summed totals by kind: gross (Order), refunded
+        (Refund), fees (Order_Retrocharge and FBA fees), adjustments (Adjustment) and net (all of them). Refunds
+        and fees are negative as in the report. Computed in one grouped query (see transactions.orders)
+
+        params:
+        type (str): Sums only transactions of this type, or of any of several comma separated types
+        skus (list): Sums only transactions with this SKU, should be sent/parsed as a comma separated string if
+            multiple SKU's
+        start (str): Sums only transactions occurring after this date/time
+        end (str): Sums only transactions occurring before this date/time
+        city (str): Sums only transactions in this city, several can be given comma separated
+        state (str): Sums only transactions in this state, several can be given comma separated
+        postal (str): Sums only transactions in this postal address, several can be given comma separated
+        min_total (decimal): Sums only transactions with a total of at least this
+        max_total (decimal): Sums only transactions with a total of at most this
+        q (str): Sums only transactions whose product SKU or description contains all of these words
+        limit (int): Return at most this many orders, along with a "next" cursor
+        cursor (str): Return the page following the one that returned this "next" cursor
+        """
+        request_data = request.GET
+        try:
+            filters = parse_filters(request_data)
+            page = order_totals(filters, parse_limit(request_data.get('limit')), request_data.get('cursor'))
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response(page, status=status.HTTP_200_OK)
+
+
+class TransactionsChangesView(GenericAPIView):
+    """
+    Incremental feed of newly imported transactions, for downstream syncs
+    """
+
+    permission_classes = (AllowAny,)
+
+    def get(self, request: HttpRequest):
+        """
+        Returns {"results": [...], "next": ..., "has_more": ...} with the transactions imported after since, in the
+        order they were imported (see transactions.changes). Keep "next" and send it as since to get what was
+        imported after this batch, right away while has_more is true
+
+        params:
+        since (str): The "next" cursor of the previous batch. Without it the feed starts at the first transaction
+        limit (int): Return at most this many transactions
+        """
+        request_data = request.GET
+        try:
+            batch = changes_after(request_data.get('since'), parse_limit(request_data.get('limit')))
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response(batch, status=status.HTTP_200_OK)
+
+
+class ImportJobView(GenericAPIView):
+    """
+    Reports the progress of a background import
+    """
+
+    permission_classes = (AllowAny,)
+
+    def get(self, request: HttpRequest, job_id: int):
+        """
+        Returns the status of the import job, the number of rows processed, inserted, duplicated and rejected so far,
+        the import throughput in rows per second and the reasons rows were rejected
+        """
+        job = ImportJob.objects.filter(id=job_id).first()
+        if job is None:
+            return Response({'error': 'no such import'}, status=status.HTTP_404_NOT_FOUND)
+        return Response(job_status(job), status=status.HTTP_200_OK)